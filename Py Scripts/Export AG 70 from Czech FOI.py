@@ -1,12 +1,17 @@
 import pandas as pd
 import os
 
+from czechfoi.data import resolve_input
+
 # === CONFIGURATION ===
+# The input may also be compressed (.gz / .zst / .xz); it is decompressed while reading, not to disk.
+# A compressed OUTPUT_CSV name (e.g. '..._AG70.csv.gz') writes a compressed export.
 INPUT_CSV = r"C:\CzechFOI-DRATE_NOBIAS\TERRA\Vesely_106_202403141131.csv"
 OUTPUT_CSV = r"C:\CzechFOI-DRATE_NOBIAS\TERRA\Vesely_106_202403141131_AG70.csv"
 REFERENCE_YEAR = 2023
 DOSE_DATE_COLS = [f'Datum_{i}' for i in range(1, 8)]
 NEEDED_COLS = ['Rok_narozeni', 'DatumUmrti'] + DOSE_DATE_COLS
+CHUNK_ROWS = 1_000_000  # Rows read at a time; only the AG70 rows are kept in memory
 
 # === FUNCTIONS ===
 def parse_dates(df):
@@ -25,15 +30,16 @@ def format_dates_for_csv(df):
 
 # === MAIN ===
 def filter_and_save_age_70():
-    print("📥 Loading input CSV...")
-    df = pd.read_csv(INPUT_CSV, usecols=NEEDED_COLS, dtype=str)
-
-    print("📆 Parsing dates and calculating age...")
-    df = parse_dates(df)
-    df = calculate_age(df)
-
-    print("🔎 Filtering to Age == 70...")
-    df_ag70 = df[df["Age"] == 70].copy()
+    input_csv = resolve_input(INPUT_CSV)
+    print(f"📥 Streaming input CSV {os.path.basename(input_csv)}...")
+    parts = []
+    for chunk in pd.read_csv(input_csv, usecols=NEEDED_COLS, dtype=str, chunksize=CHUNK_ROWS):
+        # Only the birth year is needed to filter, dates are parsed for the kept rows
+        chunk = calculate_age(chunk)
+        parts.append(chunk[chunk["Age"] == 70])
+
+    print("📆 Parsing dates of the Age == 70 rows...")
+    df_ag70 = parse_dates(pd.concat(parts, ignore_index=True))
 
     print(f"💾 Saving {len(df_ag70)} rows to output...")
     df_ag70 = format_dates_for_csv(df_ag70)
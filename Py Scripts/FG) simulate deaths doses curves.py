@@ -2,6 +2,10 @@ import pandas as pd
 import numpy as np
 import os
 
+from czechfoi.data import resolve_input
+from czechfoi.schedules import ScheduleTable
+from czechfoi.kernels import first_eligible
+
 # === CONFIGURABLE CONSTANTS ===
 INPUT_CSV = r"C:\CzechFOI-DRATE-NOBIAS\Terra\Vesely_106_202403141131_AG70.csv"
 OUTPUT_FOLDER = r"C:\CzechFOI-DRATE-NOBIAS\Terra"
@@ -13,7 +17,7 @@ NEEDED_COLS = ['Rok_narozeni', 'DatumUmrti'] + DOSE_DATE_COLS
 RETRIES = 10000
 BASE_RNG_SEED = 42
 
-np.random.seed(BASE_RNG_SEED)
+CASE3_CSV = "FG) case3_sim_deaths_sim_real_doses_with_constraint.csv"
 
 # === UTILITIES ===
 
@@ -50,23 +54,21 @@ def simulate_deaths(df, end_measure, death_rate):
 
 def assign_doses_real_curve_random(df_target, df_source, retries=10000):
     df_target = df_target.copy()
-    df_target[DOSE_DATE_COLS] = pd.NaT
 
-    dose_sets = df_source[DOSE_DATE_COLS].dropna(how='all').values.tolist()
+    # Dose schedules of the vaccinated source rows as IDs into the table of distinct schedules
+    source_days = np.column_stack([to_day_number(df_source[col]) for col in DOSE_DATE_COLS]).astype(float)
+    schedules = ScheduleTable.encode(source_days[~np.isnan(source_days).all(axis=1)])
+    last_dose_days = schedules.last_day()
     death_day_arr = df_target["death_day"].to_numpy()
     vax_stat_arr = np.zeros(len(death_day_arr), dtype=np.int8)
+    assigned = np.full(len(death_day_arr), -1)  # Schedule ID per target row, -1 = no doses
     rng = np.random.default_rng(BASE_RNG_SEED)
 
-    updates = []
+    n_assigned = 0
     skip_count = 0
 
-    for dose_dates in dose_sets:
-        valid_dates = [d for d in dose_dates if pd.notna(d)]
-        if not valid_dates:
-            continue
-
-        valid_days = np.array(to_day_number(pd.Series(valid_dates)))
-        last_dose_day = valid_days.max()
+    for schedule_id in schedules.ids:
+        last_dose_day = last_dose_days[schedule_id]
 
         eligible_indices = np.where(vax_stat_arr == 0)[0]
         if eligible_indices.size == 0:
@@ -76,24 +78,23 @@ def assign_doses_real_curve_random(df_target, df_source, retries=10000):
         rng.shuffle(eligible_indices)
         trial_pool = rng.choice(eligible_indices, size=min(retries, len(eligible_indices)), replace=False)
 
-        selected_pos = None
-        for trial_pos in trial_pool:
-            if np.isnan(death_day_arr[trial_pos]) or death_day_arr[trial_pos] > last_dose_day:
-                selected_pos = trial_pos
-                break
+        # First trial candidate who does not die before the last dose (JIT-compiled if numba is installed)
+        selected_pos = first_eligible(trial_pool, death_day_arr, last_dose_day)
 
-        if selected_pos is not None:
-            updates.append((selected_pos, dose_dates))
+        if selected_pos >= 0:
+            assigned[selected_pos] = schedule_id
             vax_stat_arr[selected_pos] = 1
+            n_assigned += 1
         else:
             skip_count += 1
 
-    for pos, dose_dates in updates:
-        for j, d in enumerate(dose_dates):
-            if pd.notna(d):
-                df_target.iloc[pos, df_target.columns.get_loc(DOSE_DATE_COLS[j])] = pd.Timestamp(d)
+    # Write all assigned schedules at once, back as dates
+    target_days = np.full((len(df_target), len(DOSE_DATE_COLS)), np.nan)
+    target_days[assigned >= 0] = schedules.person_days(assigned[assigned >= 0])
+    for j, col in enumerate(DOSE_DATE_COLS):
+        df_target[col] = START_DATE + pd.to_timedelta(target_days[:, j], unit='D')
 
-    print(f"Assigned {len(updates)} doses, Skipped {skip_count})")
+    print(f"Assigned {n_assigned} doses, Skipped {skip_count})")
     return df_target
 
 # === OUTPUT ===
@@ -103,18 +104,20 @@ def format_and_save(df, out_path):
         df[col] = pd.to_datetime(df[col], errors='coerce').dt.strftime('%Y-%m-%d').fillna('')
     df.to_csv(out_path, index=False)
 
-def save_case(df, filename):
-    out_path = os.path.join(OUTPUT_FOLDER, filename)
+def save_case(df, filename, output_folder=OUTPUT_FOLDER):
+    out_path = os.path.join(output_folder, filename)
     format_and_save(df, out_path)
     print(f"Saved: {out_path}")
     return out_path
 
 # === MAIN ===
 
-def run_all_cases():
-    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+def run_all_cases(input_csv=INPUT_CSV, output_folder=OUTPUT_FOLDER):
+    np.random.seed(BASE_RNG_SEED)
+    os.makedirs(output_folder, exist_ok=True)
     print("📥 Loading data...")
-    df = pd.read_csv(INPUT_CSV, usecols=NEEDED_COLS, dtype=str)
+    # Compressed inputs (.gz/.zst/.xz) are decompressed while reading
+    df = pd.read_csv(resolve_input(input_csv), usecols=NEEDED_COLS, dtype=str)
     df = parse_dates(df)
 
     max_death_day = to_day_number(df["DatumUmrti"]).max()
@@ -126,9 +129,10 @@ def run_all_cases():
 
     # Case 3: Sim deaths, simulated doses with constraint
     df_case3 = assign_doses_real_curve_random(df_sim_deaths.copy(), df)
-    save_case(df_case3, "FG) case3_sim_deaths_sim_real_doses_with_constraint.csv")
+    out_path = save_case(df_case3, CASE3_CSV, output_folder)
 
     print("✅ All cases processed and saved.")
+    return out_path
 
 if __name__ == "__main__":
     run_all_cases()
@@ -1,8 +1,13 @@
 import pandas as pd
 import numpy as np
-import plotly.graph_objects as go
-from lifelines import KaplanMeierFitter
-from scipy.ndimage import gaussian_filter1d
+
+# lifelines, plotly and scipy.ndimage are imported where they are used, so the count-only
+# replicate simulation does not load them
+from czechfoi.data import carry_weights, weight_array
+from czechfoi.cohort import Cohort
+from czechfoi.collapse import WEIGHT_COL, weights
+from czechfoi import figures, rolling
+from czechfoi.kernels import lag_episodes
 
 """
 Script: AG70 Bias vs Observed vs Adjusted Kaplan-Meier Death Rate Analysis
@@ -15,10 +20,21 @@ Kaplan-Meier survival estimates for vaccinated vs unvaccinated individuals in th
 It calculates daily death rate differences, adjusts for simulated bias, applies Gaussian smoothing, 
 and plots the results along with daily vaccine dose counts. 
 
+To quantify the simulation noise of the bias baseline, the FG simulation (random death days and
+real dose schedules assigned with the constraint death day > last dose day) is repeated
+N_REPLICATES times in memory, using vectorized sampling and count-based Kaplan-Meier estimates.
+Percentile bands of the baseline and of the adjusted effect are added to the plot.
+
+Below the daily curves, a second panel shows the vaccinated vs unvaccinated hazard ratio in sliding
+calendar windows (ROLLING_WINDOW_DAYS days, every ROLLING_STEP_DAYS days) for the real and the
+simulated data and their ratio (bias-adjusted HR). The windows are running sums of per-day counts
+(Mantel-Haenszel over daily risk sets, see czechfoi.rolling), not refits per window.
+
 Outputs:
 --------
 1. A Plotly HTML visualization of daily death rate differences 
-   (bias baseline, observed effect, adjusted effect) with dose counts.
+   (bias baseline, observed effect, adjusted effect) with dose counts,
+   and the rolling-window HR of the real and simulated data.
 2. A Kaplan-Meier survival curve comparison (real data only).
 """
 
@@ -28,85 +44,47 @@ REAL_CSV = r"C:\CzechFOI-DRATE-NOBIAS\Terra\Vesely_106_202403141131_AG70.csv"
 OUTPUT_HTML = r"C:\CzechFOI-DRATE-NOBIAS\Plot Results\FJ) bias vs observed vs adjusted KM death rate\AG70_bias_vs_observed_vs_adjusted_KM_death_rate.html"
 OUTPUT_SURV_DIFF_HTML = r"C:\CzechFOI-DRATE-NOBIAS\Plot Results\FJ) bias vs observed vs adjusted KM death rate\AG70_KM_survival_difference.html"
 
+TITLE = "Daily Death Rate Difference (Vaccinated - Unvaccinated) for Age 70"
+SURV_TITLE = "Kaplan-Meier Survival Curves for Age 70 (Real Data)"
+
 # Analysis parameters
-START_DATE = pd.Timestamp('2020-01-01')  # Reference day zero
-REFERENCE_YEAR = 2023                    # Used to calculate age
-MAX_AGE = 113                            # Maximum allowed age
 LAG_DAYS = 0                             # Vaccination lag adjustment
 
-# Vaccination dose columns (up to 7 doses available in data)
-dose_cols = [f'Datum_{i}' for i in range(1, 8)]
+# Simulation-noise bands (in-memory re-simulation of the FG bias baseline)
+N_REPLICATES = 200                       # Number of simulated baseline curves (0 disables the bands)
+BAND_PERCENTILES = (2.5, 97.5)           # Lower/upper percentile of the bands
+RESIM_SEED = 42                          # Seed for the replicate random generator
+SIGMA = 3                                # Gaussian smoothing of the daily curves and dose counts
+
+# Rolling-window hazard ratio panel
+ROLLING_WINDOW_DAYS = 30                 # Window length in days (0 disables the panel)
+ROLLING_STEP_DAYS = 7                    # Days between window starts
 
-def preprocess_data(filepath):
+def preprocess_data(df):
     """
-    Load and preprocess vaccination/death data for Kaplan-Meier analysis.
+    Preprocess vaccination/death data for Kaplan-Meier analysis.
 
-    - Filters to max age
-    - Forces all individuals into AG70 group
-    - Computes death day and dose days relative to START_DATE
+    - Takes a cohort of data filtered to max age (see czechfoi.cohort, day numbers relative to START_DATE)
+    - Forces all individuals into AG70 group (a view with a constant age column)
     - Constructs time-varying survival dataset (tv_df)
     """
-    df = pd.read_csv(
-        filepath,
-        usecols=['Rok_narozeni', 'DatumUmrti'] + dose_cols,
-        parse_dates=['DatumUmrti'] + dose_cols,
-        dayfirst=False
-    )
-    df.columns = [col.lower().strip() for col in df.columns]
-    dose_cols_lower = [col.lower() for col in dose_cols]
-
-    # Derive age (forced to 70 for AG70 analysis)
-    df['birth_year'] = pd.to_numeric(df['rok_narozeni'], errors='coerce')
-    df['age'] = REFERENCE_YEAR - df['birth_year']
-    df = df[df['age'].between(0, MAX_AGE)].copy()
-    df['age'] = 70  
-
-    # Convert absolute dates to relative day counts
-    to_day = lambda col: (df[col] - START_DATE).dt.days
-    df['death_day'] = to_day('datumumrti')
-    for col in dose_cols_lower:
-        df[col + '_day'] = to_day(col)
-
-    # Extract first dose day and dose indicators
-    dose_day_cols = [col + '_day' for col in dose_cols_lower]
-    df['first_dose_day'] = df[dose_day_cols].min(axis=1, skipna=True)
-    df['has_any_dose'] = df[dose_day_cols].notna().any(axis=1)
+    df = df.assign(age=70)
 
     # Last day for measuring outcomes
-    END_MEASURE = int(df['death_day'].dropna().max())
-    df['end_day'] = df['death_day'].fillna(END_MEASURE)
-
-    # Build time-varying dataset for KM fitting
-    tv_data = []
-    for idx, row in df.iterrows():
-        pid = idx
-        death_day = row['death_day']
-        end_day = row['end_day']
-        dose_day = row['first_dose_day']
-        has_dose = row['has_any_dose']
-
-        # Unvaccinated interval (before vaccination or until death)
-        unvax_stop = min(end_day, dose_day + LAG_DAYS) if has_dose else end_day
-        tv_data.append({
-            'id': pid,
-            'start': 0,
-            'stop': unvax_stop,
-            'event': int(death_day == unvax_stop),
-            'vaccinated': 0
-        })
-
-        # Vaccinated interval (after first dose + lag)
-        if has_dose and dose_day + LAG_DAYS < end_day:
-            tv_data.append({
-                'id': pid,
-                'start': dose_day + LAG_DAYS,
-                'stop': end_day,
-                'event': int(death_day == end_day),
-                'vaccinated': 1
-            })
-
-    # Build DataFrame of intervals
-    tv_df = pd.DataFrame(tv_data)
+    END_MEASURE = df.end_measure
+
+    # Build time-varying dataset for KM fitting: an unvaccinated interval (before vaccination + lag
+    # or until death) and, if vaccinated before the end, a vaccinated interval (see czechfoi.kernels)
+    person, start, stop, event, vaccinated = lag_episodes(df['death_day'], df['first_dose_day'],
+                                                          df.end_day(END_MEASURE), LAG_DAYS)
+    tv_df = pd.DataFrame({
+        'id': df.index.to_numpy()[person],
+        'start': start,
+        'stop': stop,
+        'event': event,
+        'vaccinated': vaccinated
+    })
+    carry_weights(tv_df, df, person)
 
     # Fix edge cases where start == stop and event=1
     tv_df.loc[(tv_df["start"] == tv_df["stop"]) & (tv_df["event"] == 1), "stop"] += 0.5
@@ -120,14 +98,17 @@ def fit_km(tv_df):
     """
     Fit Kaplan-Meier survival curves separately for unvaccinated and vaccinated groups.
     """
+    from lifelines import KaplanMeierFitter
     kmf_uvx = KaplanMeierFitter()
     kmf_uvx.fit(tv_df.loc[tv_df['vaccinated'] == 0, 'duration'],
                 event_observed=tv_df.loc[tv_df['vaccinated'] == 0, 'event'],
+                weights=weights(tv_df[tv_df['vaccinated'] == 0]),
                 label="Unvaccinated")
 
     kmf_vx = KaplanMeierFitter()
     kmf_vx.fit(tv_df.loc[tv_df['vaccinated'] == 1, 'duration'],
                event_observed=tv_df.loc[tv_df['vaccinated'] == 1, 'event'],
+               weights=weights(tv_df[tv_df['vaccinated'] == 1]),
                label="Vaccinated")
 
     return kmf_uvx, kmf_vx
@@ -153,111 +134,355 @@ def compute_daily_dose_counts(df, end_day):
     """
     Compute daily counts of first doses and all doses administered.
     """
-    first_dose_counts = df['first_dose_day'].value_counts().reindex(range(end_day+1), fill_value=0).sort_index()
-    all_dose_days = pd.Series(np.concatenate([
-        df[f'datum_{i}_day'].dropna().values for i in range(1, 8)
-    ])).astype(int)
-    all_dose_counts = all_dose_days.value_counts().reindex(range(end_day+1), fill_value=0).sort_index()
+    # Counts are sums of the row weights (1 per person outside preview mode)
+    w = pd.Series(weight_array(df), index=df.index)
+    first_dose_counts = w.groupby(df['first_dose_day']).sum().reindex(range(end_day+1), fill_value=0).sort_index()
+    dose_cols = [f'datum_{i}_day' for i in range(1, 8)]
+    all_dose_days = pd.Series(np.concatenate([df[col].values for col in dose_cols]))
+    all_weights = pd.Series(np.tile(w.values, len(dose_cols)))
+    all_dose_counts = all_weights.groupby(all_dose_days).sum().reindex(range(end_day+1), fill_value=0).sort_index()
     return first_dose_counts, all_dose_counts
 
+def km_death_rate_diff(prep):
+    """
+    Fit the KM curves of a preprocessed dataset and compute its daily death rate difference.
+    Returns (days, diff, END_MEASURE, kmf_uvx, kmf_vx).
+    """
+    _, tv_df, end = prep
+    kmf_uvx, kmf_vx = fit_km(tv_df)
+    days, diff = compute_daily_death_rate_diff(kmf_uvx, kmf_vx, end)
+    return days, diff, end, kmf_uvx, kmf_vx
 
-# === Main Analysis ===
+def daily_dose_counts(prep):
+    """
+    Daily first and all dose counts of a preprocessed dataset up to its END_MEASURE.
+    """
+    df, _, end = prep
+    return compute_daily_dose_counts(df, end)
 
-# Process simulated data
-df_sim, tv_df_sim, end_sim = preprocess_data(SIM_CSV)
-kmf_uvx_sim, kmf_vx_sim = fit_km(tv_df_sim)
-days_sim, diff_sim = compute_daily_death_rate_diff(kmf_uvx_sim, kmf_vx_sim, end_sim)
-
-# Process real data
-df_real, tv_df_real, end_real = preprocess_data(REAL_CSV)
-kmf_uvx_real, kmf_vx_real = fit_km(tv_df_real)
-days_real, diff_real = compute_daily_death_rate_diff(kmf_uvx_real, kmf_vx_real, end_real)
-
-# Align real vs simulated and compute adjusted difference
-max_day = min(end_sim, end_real)
-days_common = np.arange(max_day + 1)
-diff_sim_aligned = pd.Series(diff_sim, index=days_sim).reindex(days_common, fill_value=0).values
-diff_real_aligned = pd.Series(diff_real, index=days_real).reindex(days_common, fill_value=0).values
-diff_adjusted = diff_real_aligned - diff_sim_aligned
-
-# Smooth differences using Gaussian filter
-sigma = 3
-diff_sim_smooth = gaussian_filter1d(diff_sim_aligned, sigma=sigma)
-diff_real_smooth = gaussian_filter1d(diff_real_aligned, sigma=sigma)
-diff_adjusted_smooth = gaussian_filter1d(diff_adjusted, sigma=sigma)
-
-# Dose counts (real data only)
-first_dose_real, all_dose_real = compute_daily_dose_counts(df_real, max_day)
-vax_start_day = first_dose_real[first_dose_real > 0].index.min()  # First vaccination day
-
-
-# === Plot Death Rate Difference and Dose Counts ===
-fig = go.Figure()
-
-# Raw death rate differences
-fig.add_trace(go.Scatter(x=days_common, y=diff_sim_aligned, name='Bias Baseline (Simulated)', line=dict(color='gray')))
-fig.add_trace(go.Scatter(x=days_common, y=diff_real_aligned, name='Observed Effect (Real Data)', line=dict(color='blue')))
-fig.add_trace(go.Scatter(x=days_common, y=diff_adjusted, name='Adjusted Effect', line=dict(color='green')))
-
-# Smoothed differences
-fig.add_trace(go.Scatter(x=days_common, y=diff_sim_smooth, name='Bias Baseline Smoothed', line=dict(width=0.8, color='gray', dash='solid')))
-fig.add_trace(go.Scatter(x=days_common, y=diff_real_smooth, name='Observed Effect Smoothed', line=dict(width=0.8, color='blue', dash='solid')))
-fig.add_trace(go.Scatter(x=days_common, y=diff_adjusted_smooth, name='Adjusted Effect Smoothed', line=dict(width=0.8, color='green', dash='solid')))
-
-# Smoothed dose counts (secondary y-axis)
-sigma_dose = 3
-first_dose_smooth = gaussian_filter1d(first_dose_real.values, sigma=sigma_dose)
-all_dose_smooth = gaussian_filter1d(all_dose_real.values, sigma=sigma_dose)
-fig.add_trace(go.Scatter(x=days_common, y=first_dose_smooth, name='First Doses (smoothed)', yaxis='y2', line=dict(width=0.8, color='orangered', dash='solid')))
-fig.add_trace(go.Scatter(x=days_common, y=all_dose_smooth, name='All Doses (smoothed)', yaxis='y2', line=dict(width=0.8, color='orange', dash='solid')))
-
-# Vertical line marking vaccination start day
-fig.add_trace(go.Scatter(
-    x=[vax_start_day, vax_start_day],
-    y=[min(diff_adjusted_smooth), max(diff_adjusted_smooth)],
-    mode='lines',
-    name='Vaccination Start',
-    line=dict(color='red', width=2, dash='dot'),
-    hoverinfo='x+name'
-))
-
-# Layout adjustments
-fig.update_layout(
-    title="Daily Death Rate Difference (Vaccinated - Unvaccinated) for Age 70",
-    xaxis_title="Days since Jan 1, 2020",
-    yaxis=dict(title="Death Rate Difference"),
-    yaxis2=dict(title="Dose Counts", overlaying='y', side='right', showgrid=False),
-    template='plotly_white',
-    hovermode='x unified',
-    legend=dict(
-        orientation="v",
-        yanchor="top", y=1,
-        xanchor="left", x=1.02,
-        bgcolor='rgba(255,255,255,0.8)',
-        bordercolor='lightgray',
-        borderwidth=1
+def rolling_hr(prep, window_days=ROLLING_WINDOW_DAYS, step_days=ROLLING_STEP_DAYS, lag_days=LAG_DAYS):
+    """
+    Vaccinated vs unvaccinated HR of a preprocessed dataset in sliding calendar windows
+    (see czechfoi.rolling.rolling_rate_ratio), or None if the panel is disabled.
+    """
+    if window_days <= 0:
+        return None
+    df, _, end = prep
+    return rolling.rolling_rate_ratio(rolling.daily_counts(df, end, lag_days), window_days, step_days)
+
+
+def km_daily_death_rate(durations, events, max_day):
+    """
+    Daily death rate (survival step differences) of a Kaplan-Meier curve, computed from count arrays.
+
+    Gives the same result as fitting lifelines' KaplanMeierFitter and reindexing its survival
+    function to days 0..max_day (as in compute_daily_death_rate_diff). Durations are multiples
+    of 0.5 days (zero-length intervals with an event are extended by 0.5), so the estimator is
+    evaluated on a half-day grid.
+    """
+    grid = np.round(np.asarray(durations, dtype=float) * 2).astype(np.int64)
+    n_grid = max(2 * int(max_day) + 1, int(grid.max()) + 1 if grid.size else 1)
+    removed = np.bincount(grid, minlength=n_grid)
+    deaths = np.bincount(grid, weights=np.asarray(events, dtype=float), minlength=n_grid)
+
+    # Number at risk at each grid time: all intervals with duration >= t
+    at_risk = removed[::-1].cumsum()[::-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hazard = np.where(at_risk > 0, deaths / at_risk, 0.0)
+    survival = np.cumprod(1.0 - hazard)
+
+    # Survival at integer days (forward filled), then daily step differences
+    surv_daily = survival[0:2 * int(max_day) + 1:2]
+    death_rate = np.append(surv_daily[:-1] - surv_daily[1:], 0)
+    return death_rate
+
+def assign_dose_sets_vectorized(death_day, set_first_day, set_last_day, rng):
+    """
+    Vectorized version of FG's assign_doses_real_curve_random.
+
+    Each real dose set (given by its first and last dose day) is assigned to a random person not yet
+    vaccinated whose simulated death day is after the last dose day (or who does not die).
+    Instead of trying random candidates one by one, every pending dose set draws directly from its
+    eligible persons in one array operation per round; collisions are resolved in favour of the
+    earlier dose set (as in FG's sequential loop) and the losers draw again in the next round.
+    Dose sets without any eligible person left are skipped.
+
+    Returns the first dose day per person (NaN if not assigned) and the number of skipped dose sets.
+    """
+    n = len(death_day)
+    horizon = np.where(np.isnan(death_day), np.inf, death_day)
+
+    # Sort persons by horizon (random order within ties) so eligible persons form a suffix
+    order = np.lexsort((rng.random(n), horizon))
+    horizon_sorted = horizon[order]
+    free = np.ones(n, dtype=bool)  # in sorted order
+    first_dose = np.full(n, np.nan)
+
+    pending = np.arange(len(set_last_day))
+    eligible_start = np.searchsorted(horizon_sorted, set_last_day, side='right')
+    skip_count = 0
+
+    while pending.size:
+        free_cum = np.concatenate(([0], np.cumsum(free)))
+        start = eligible_start[pending]
+        n_eligible = free_cum[-1] - free_cum[start]
+
+        infeasible = n_eligible == 0
+        skip_count += int(infeasible.sum())
+        pending, start, n_eligible = pending[~infeasible], start[~infeasible], n_eligible[~infeasible]
+        if not pending.size:
+            break
+
+        # Draw the k-th free person inside each eligible suffix
+        rank = free_cum[start] + (rng.random(pending.size) * n_eligible).astype(np.int64)
+        candidate = np.searchsorted(free_cum, rank, side='right') - 1
+
+        # First (earliest) dose set wins each candidate
+        _, winner = np.unique(candidate, return_index=True)
+        free[candidate[winner]] = False
+        first_dose[order[candidate[winner]]] = set_first_day[pending[winner]]
+
+        keep = np.ones(pending.size, dtype=bool)
+        keep[winner] = False
+        pending = pending[keep]
+
+    return first_dose, skip_count
+
+def simulate_baseline_replicates(df, end_measure, n_replicates=N_REPLICATES, seed=RESIM_SEED):
+    """
+    Re-simulate the FG bias baseline n_replicates times in memory and return the daily death rate
+    differences (vaccinated - unvaccinated) as an array of shape (n_replicates, end_measure + 1).
+
+    Only death days and dose assignments are redrawn: the death rate, END_MEASURE and the real
+    dose schedules are taken from the real data, as FG does. On a preview sample the n simulated
+    persons weigh the same, so the death rate and the share of vaccinated persons are weighted
+    and the dose sets are redrawn in proportion to their rows' weights.
+    """
+    print(f"Simulating {n_replicates} bias baseline replicates...")
+    rng = np.random.default_rng(seed)
+    n = len(df)
+    w = weight_array(df)
+    death_rate = np.clip((w * df['death_day'].notna().to_numpy()).sum() / w.sum(), 1e-4, 0.999)
+
+    # Real dose sets in source order, reduced to first and last dose day
+    dose_day_cols = [f'datum_{i}_day' for i in range(1, 8)]
+    vaccinated = df['has_any_dose'].to_numpy()
+    dose_days = df[dose_day_cols].to_numpy(dtype=float)[vaccinated]
+    if WEIGHT_COL in df and len(dose_days):
+        set_w = w[vaccinated]
+        n_sets = int(round(n * set_w.sum() / w.sum()))
+        dose_days = dose_days[np.sort(rng.choice(len(dose_days), n_sets, p=set_w / set_w.sum()))]
+    set_first_day = np.nanmin(dose_days, axis=1)
+    set_last_day = np.nanmax(dose_days, axis=1)
+
+    replicates = np.zeros((n_replicates, end_measure + 1))
+    for r in range(n_replicates):
+        will_die = rng.random(n) < death_rate
+        death_day = np.where(will_die, rng.integers(0, end_measure + 1, size=n), np.nan)
+        first_dose_day, _ = assign_dose_sets_vectorized(death_day, set_first_day, set_last_day, rng)
+
+        # Same interval construction as preprocess_data, on arrays
+        end_rep = int(np.nanmax(death_day)) if will_die.any() else end_measure
+        end_day = np.where(np.isnan(death_day), end_rep, death_day)
+        has_dose = ~np.isnan(first_dose_day)
+        vax_start = first_dose_day + LAG_DAYS
+
+        unvax_stop = np.where(has_dose, np.minimum(end_day, vax_start), end_day)
+        unvax_event = death_day == unvax_stop
+        unvax_duration = unvax_stop + 0.5 * (unvax_event & (unvax_stop == 0))
+
+        vax_mask = has_dose & (vax_start < end_day)
+        vax_duration = end_day[vax_mask] - vax_start[vax_mask]
+        vax_event = death_day[vax_mask] == end_day[vax_mask]
+
+        rate_uvx = km_daily_death_rate(unvax_duration, unvax_event, end_rep)
+        rate_vx = km_daily_death_rate(vax_duration, vax_event, end_rep)
+        diff = rate_vx - rate_uvx
+
+        n_days = min(len(diff), end_measure + 1)
+        replicates[r, :n_days] = diff[:n_days]
+
+    return replicates
+
+def baseline_replicates(prep, n_replicates=N_REPLICATES, seed=RESIM_SEED):
+    """
+    Re-simulated baselines for a preprocessed real dataset (see simulate_baseline_replicates),
+    or None if no replicates are requested.
+    """
+    if n_replicates <= 0:
+        return None
+    df, _, end = prep
+    return simulate_baseline_replicates(df, end, n_replicates, seed)
+
+def add_band(fig, x, lower, upper, name, color, yaxis='y'):
+    """
+    Add a filled percentile band (lower to upper) to a figure.
+    """
+    import plotly.graph_objects as go
+    fig.add_trace(go.Scatter(x=x, y=upper, mode='lines', line=dict(width=0), showlegend=False,
+                             legendgroup=name, hoverinfo='skip', yaxis=yaxis))
+    fig.add_trace(go.Scatter(x=x, y=lower, mode='lines', line=dict(width=0), fill='tonexty',
+                             fillcolor=color, name=name, legendgroup=name, yaxis=yaxis))
+
+def add_rolling_panel(fig, rolling_sim, rolling_real, window_days):
+    """
+    Add the rolling-window HRs (real, simulated, real / simulated) with 95% CIs on the lower panel (y3).
+    """
+    import plotly.graph_objects as go
+    adjusted = rolling.adjusted_ratio(rolling_real, rolling_sim)
+    label = f"{window_days}-day window"
+    for result, name, color, fill in ((rolling_sim, 'Rolling HR Simulated', 'gray', 'rgba(128,128,128,0.2)'),
+                                      (rolling_real, 'Rolling HR Real', 'blue', 'rgba(0,0,255,0.15)'),
+                                      (adjusted, 'Rolling HR Adjusted (Real / Simulated)', 'green', 'rgba(0,128,0,0.15)')):
+        add_band(fig, result['day'], result['hr_lower'], result['hr_upper'], f'{name} 95% CI', fill, yaxis='y3')
+        fig.add_trace(go.Scatter(x=result['day'], y=result['hr'], name=f'{name} ({label})', yaxis='y3',
+                                 mode='lines+markers', marker=dict(size=3), line=dict(width=1.2, color=color)))
+    days = rolling_real['day']
+    fig.add_trace(go.Scatter(x=[days.min(), days.max()], y=[1, 1], mode='lines', name='HR = 1', yaxis='y3',
+                             line=dict(color='black', width=1, dash='dash'), hoverinfo='skip'))
+
+
+# === Plot Results ===
+
+def plot_results(sim, real, replicates, dose_counts_real, rolling_sim=None, rolling_real=None,
+                 output_html=OUTPUT_HTML, output_surv_html=OUTPUT_SURV_DIFF_HTML,
+                 sigma=SIGMA, band_percentiles=BAND_PERCENTILES, window_days=ROLLING_WINDOW_DAYS,
+                 title=TITLE, surv_title=SURV_TITLE):
+    """
+    Plot bias baseline, observed and adjusted death rate differences (with optional replicate bands
+    and rolling-window HR panel) and the KM survival curves of the real data.
+    """
+    import plotly.graph_objects as go
+    from scipy.ndimage import gaussian_filter1d
+    days_sim, diff_sim, end_sim, _, _ = sim
+    days_real, diff_real, end_real, kmf_uvx_real, kmf_vx_real = real
+
+    # Align real vs simulated and compute adjusted difference
+    max_day = min(end_sim, end_real)
+    days_common = np.arange(max_day + 1)
+    diff_sim_aligned = pd.Series(diff_sim, index=days_sim).reindex(days_common, fill_value=0).values
+    diff_real_aligned = pd.Series(diff_real, index=days_real).reindex(days_common, fill_value=0).values
+    diff_adjusted = diff_real_aligned - diff_sim_aligned
+
+    # Smooth differences using Gaussian filter
+    diff_sim_smooth = gaussian_filter1d(diff_sim_aligned, sigma=sigma)
+    diff_real_smooth = gaussian_filter1d(diff_real_aligned, sigma=sigma)
+    diff_adjusted_smooth = gaussian_filter1d(diff_adjusted, sigma=sigma)
+
+    # Simulation-noise bands from in-memory re-simulated baselines (smoothed like the curves above)
+    if replicates is not None:
+        n_replicates = len(replicates)
+        baseline_reps = np.zeros((n_replicates, max_day + 1))
+        n_days = min(replicates.shape[1], max_day + 1)
+        baseline_reps[:, :n_days] = replicates[:, :n_days]
+        baseline_reps_smooth = gaussian_filter1d(baseline_reps, sigma=sigma, axis=1)
+        adjusted_reps_smooth = diff_real_smooth - baseline_reps_smooth
+        baseline_band = np.percentile(baseline_reps_smooth, band_percentiles, axis=0)
+        adjusted_band = np.percentile(adjusted_reps_smooth, band_percentiles, axis=0)
+
+    # Dose counts (real data only)
+    first_dose_real, all_dose_real = (counts.iloc[:max_day + 1] for counts in dose_counts_real)
+    vax_start_day = first_dose_real[first_dose_real > 0].index.min()  # First vaccination day
+
+
+    # === Plot Death Rate Difference and Dose Counts ===
+    fig = go.Figure()
+
+    # Raw death rate differences
+    fig.add_trace(go.Scatter(x=days_common, y=diff_sim_aligned, name='Bias Baseline (Simulated)', line=dict(color='gray')))
+    fig.add_trace(go.Scatter(x=days_common, y=diff_real_aligned, name='Observed Effect (Real Data)', line=dict(color='blue')))
+    fig.add_trace(go.Scatter(x=days_common, y=diff_adjusted, name='Adjusted Effect', line=dict(color='green')))
+
+    # Smoothed differences
+    fig.add_trace(go.Scatter(x=days_common, y=diff_sim_smooth, name='Bias Baseline Smoothed', line=dict(width=0.8, color='gray', dash='solid')))
+    fig.add_trace(go.Scatter(x=days_common, y=diff_real_smooth, name='Observed Effect Smoothed', line=dict(width=0.8, color='blue', dash='solid')))
+    fig.add_trace(go.Scatter(x=days_common, y=diff_adjusted_smooth, name='Adjusted Effect Smoothed', line=dict(width=0.8, color='green', dash='solid')))
+
+    # Percentile bands of the re-simulated baseline and adjusted effect
+    if replicates is not None:
+        band_label = f"{band_percentiles[0]:g}-{band_percentiles[1]:g}% of {n_replicates} simulations"
+        add_band(fig, days_common, baseline_band[0], baseline_band[1],
+                 f'Bias Baseline Smoothed ({band_label})', 'rgba(128,128,128,0.25)')
+        add_band(fig, days_common, adjusted_band[0], adjusted_band[1],
+                 f'Adjusted Effect Smoothed ({band_label})', 'rgba(0,128,0,0.2)')
+
+    # Smoothed dose counts (secondary y-axis)
+    first_dose_smooth = gaussian_filter1d(first_dose_real.values, sigma=sigma)
+    all_dose_smooth = gaussian_filter1d(all_dose_real.values, sigma=sigma)
+    fig.add_trace(go.Scatter(x=days_common, y=first_dose_smooth, name='First Doses (smoothed)', yaxis='y2', line=dict(width=0.8, color='orangered', dash='solid')))
+    fig.add_trace(go.Scatter(x=days_common, y=all_dose_smooth, name='All Doses (smoothed)', yaxis='y2', line=dict(width=0.8, color='orange', dash='solid')))
+
+    # Vertical line marking vaccination start day
+    fig.add_trace(go.Scatter(
+        x=[vax_start_day, vax_start_day],
+        y=[min(diff_adjusted_smooth), max(diff_adjusted_smooth)],
+        mode='lines',
+        name='Vaccination Start',
+        line=dict(color='red', width=2, dash='dot'),
+        hoverinfo='x+name'
+    ))
+
+    # Rolling-window HRs on a lower panel sharing the day axis
+    has_rolling = rolling_sim is not None and rolling_real is not None
+    if has_rolling:
+        add_rolling_panel(fig, rolling_sim, rolling_real, window_days)
+
+    # Layout adjustments
+    fig.update_layout(
+        title=title,
+        xaxis=dict(title="Days since Jan 1, 2020", anchor='y3' if has_rolling else 'y'),
+        yaxis=dict(title="Death Rate Difference", domain=[0.4, 1] if has_rolling else [0, 1]),
+        yaxis2=dict(title="Dose Counts", overlaying='y', side='right', showgrid=False),
+        template='plotly_white',
+        hovermode='x unified',
+        legend=dict(
+            orientation="v",
+            yanchor="top", y=1,
+            xanchor="left", x=1.02,
+            bgcolor='rgba(255,255,255,0.8)',
+            bordercolor='lightgray',
+            borderwidth=1
+        )
+    )
+    if has_rolling:
+        fig.update_layout(yaxis3=dict(title="Rolling HR (Vx / Uvx)", type='log', domain=[0, 0.32], anchor='x'))
+    fig.add_annotation(
+        text="Dose counts are plotted on the secondary y-axis on the right.<br>Both first doses per day and all doses per day are included.",
+        xref="paper", yref="paper", x=0.5, y=-0.2, showarrow=False, align="center"
     )
-)
-fig.add_annotation(
-    text="Dose counts are plotted on the secondary y-axis on the right.<br>Both first doses per day and all doses per day are included.",
-    xref="paper", yref="paper", x=0.5, y=-0.2, showarrow=False, align="center"
-)
-fig.write_html(OUTPUT_HTML)
-print(f"Plot saved to {OUTPUT_HTML}")
-
-
-# === Kaplan-Meier Survival Plot ===
-fig_surv = go.Figure()
-fig_surv.add_trace(go.Scatter(x=kmf_uvx_real.survival_function_.index, y=kmf_uvx_real.survival_function_['Unvaccinated'], name='Unvaccinated', line=dict(color='red')))
-fig_surv.add_trace(go.Scatter(x=kmf_vx_real.survival_function_.index, y=kmf_vx_real.survival_function_['Vaccinated'], name='Vaccinated', line=dict(color='blue')))
-
-fig_surv.update_layout(
-    title="Kaplan-Meier Survival Curves for Age 70 (Real Data)",
-    xaxis_title="Days",
-    yaxis_title="Survival Probability",
-    template="plotly_white",
-    hovermode="x unified",
-    yaxis=dict(range=[0, 1]),
-)
-fig_surv.write_html(OUTPUT_SURV_DIFF_HTML)
-print(f"Plot saved to {OUTPUT_SURV_DIFF_HTML}")
+    figures.compress_traces(fig)
+    figures.write_html(fig, output_html)
+    print(f"Plot saved to {output_html}")
+
+
+    # === Kaplan-Meier Survival Plot ===
+    fig_surv = go.Figure()
+    fig_surv.add_trace(go.Scatter(x=kmf_uvx_real.survival_function_.index, y=kmf_uvx_real.survival_function_['Unvaccinated'], name='Unvaccinated', line=dict(color='red')))
+    fig_surv.add_trace(go.Scatter(x=kmf_vx_real.survival_function_.index, y=kmf_vx_real.survival_function_['Vaccinated'], name='Vaccinated', line=dict(color='blue')))
+
+    fig_surv.update_layout(
+        title=surv_title,
+        xaxis_title="Days",
+        yaxis_title="Survival Probability",
+        template="plotly_white",
+        hovermode="x unified",
+        yaxis=dict(range=[0, 1]),
+    )
+    figures.compress_traces(fig_surv, steps=True)
+    figures.write_html(fig_surv, output_surv_html)
+    print(f"Plot saved to {output_surv_html}")
+
+
+# === Main Analysis ===
+
+def main():
+    # Process simulated and real data
+    prep_sim = preprocess_data(Cohort.from_csv(SIM_CSV))
+    prep_real = preprocess_data(Cohort.from_csv(REAL_CSV))
+
+    replicates = baseline_replicates(prep_real)
+    plot_results(km_death_rate_diff(prep_sim), km_death_rate_diff(prep_real), replicates, daily_dose_counts(prep_real),
+                 rolling_hr(prep_sim), rolling_hr(prep_real))
+
+if __name__ == "__main__":
+    main()
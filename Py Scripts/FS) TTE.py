@@ -1,8 +1,13 @@
 import pandas as pd
 import numpy as np
-from lifelines import CoxTimeVaryingFitter, KaplanMeierFitter
-import plotly.graph_objects as go
-import sys
+
+# lifelines and plotly are imported in the fit and report functions (fast startup)
+from czechfoi.data import carry_weights
+from czechfoi.cohort import Cohort, end_measure
+from czechfoi.collapse import collapse_intervals, weight_col, weights, scaled_penalizer, WEIGHT_COL
+from czechfoi.instrument import run_log
+from czechfoi.kernels import lag_episodes
+from czechfoi import figures
 
 # === Constants ===
 
@@ -14,178 +19,124 @@ OUTPUT_TXT = r"C:\CzechFOI-DRATE-NOBIAS\Plot Results\FS) TTE\FS-FG) case3_sim_de
 #OUTPUT_HTML = r"C:\CzechFOI-DRATE-NOBIAS\Plot Results\FS) TTE\FS) Vesely_106_202403141131_AG70 TTE.html"
 #OUTPUT_TXT = r"C:\CzechFOI-DRATE-NOBIAS\Plot Results\FS) TTE\FS) Vesely_106_202403141131_AG70 TTE.TXT"
 
-START_DATE = pd.Timestamp('2020-01-01')
-REFERENCE_YEAR = 2023
-MAX_AGE = 113
 IMMUNITY_LAG = 0  # days after dose until immunity starts
-DOSE_COLS = [f'Datum_{i}' for i in range(1, 8)]
-
-class Tee:
-    def __init__(self, *files):
-        self.files = files
-
-    def write(self, data):
-        for f in self.files:
-            f.write(data)
-            f.flush()
-
-    def flush(self):
-        for f in self.files:
-            f.flush()
-
-# Save original stdout/stderr to restore later if needed
-original_stdout = sys.stdout
-original_stderr = sys.stderr
-
-log_file_path = fr"{OUTPUT_TXT}"
-log_file = open(log_file_path, "w", encoding="utf-8")
-
-# Set up teeing
-tee = Tee(sys.stdout, log_file)
-sys.stdout = tee
-sys.stderr = tee
+COLLAPSE = True   # merge identical censored intervals into weighted rows before fitting
 
-# === Load data ===
-needed_cols = ['Rok_narozeni', 'DatumUmrti'] + DOSE_COLS
-df = pd.read_csv(INPUT_CSV, usecols=needed_cols, parse_dates=['DatumUmrti'] + DOSE_COLS)
-df.columns = [col.strip().lower() for col in df.columns]
-DOSE_COLS = [col.lower() for col in DOSE_COLS]
-
-df['birth_year'] = pd.to_numeric(df['rok_narozeni'], errors='coerce')
-df['age'] = REFERENCE_YEAR - df['birth_year']
-df = df[df['age'].between(0, MAX_AGE)].copy()
-
-# === Convert dates to days since START_DATE ===
-def to_day_number(date_series):
-    return (date_series - START_DATE).dt.days
-
-df['death_day'] = to_day_number(df['datumumrti'])
-for col in DOSE_COLS:
-    df[col + '_day'] = to_day_number(df[col])
-
-df['first_dose_day'] = df[[col + '_day' for col in DOSE_COLS]].min(axis=1, skipna=True)
-df['has_any_dose'] = df[[col + '_day' for col in DOSE_COLS]].notna().any(axis=1)
-
-# Define end of observation: max death day or administrative censoring day
-END_MEASURE = int(df['death_day'].dropna().max())
-print(f"END_MEASURE (max death day): {END_MEASURE}")
-
-df['end_day'] = df['death_day'].fillna(END_MEASURE)
-df['event'] = (~df['death_day'].isna()).astype(int)
+TITLE = "Stratified Survival Curves by Dose (Vaccinated vs Unvaccinated)"
 
 # === Prepare Target Trial Emulation (TTE) structure ===
-records = []
-
-for _, row in df.iterrows():
-    pid = row.name
-    end = int(row['end_day'])
-    event = row['event']
-    death_day = row['death_day'] if not np.isnan(row['death_day']) else np.inf
-    dose_day = row['first_dose_day']
-    
-    if np.isnan(dose_day):
-        # Never vaccinated: entire follow-up unvaccinated
-        records.append({
-            'id': pid,
-            'start': 0,
-            'stop': end,
-            'vaccinated': 0,
-            'event': int(death_day == end)
-        })
-    else:
-        immune_start = int(dose_day + IMMUNITY_LAG)
-        
-        # Interval 1: unvaccinated time [0, immune_start)
-        unvax_stop = min(immune_start, end)
-        event_unvax = int(death_day == unvax_stop)
-        records.append({
-            'id': pid,
-            'start': 0,
-            'stop': unvax_stop,
-            'vaccinated': 0,
-            'event': event_unvax
-        })
-
-        if immune_start < end:
-            # Interval 2: vaccinated time [immune_start, end]
-            event_vax = int(death_day == end)
-            records.append({
-                'id': pid,
-                'start': immune_start,
-                'stop': end,
-                'vaccinated': 1,
-                'event': event_vax
-            })
-
-tte_df = pd.DataFrame(records)
-
-# Fix for zero-length intervals with event
-tte_df.loc[
-    (tte_df["start"] == tte_df["stop"]) & (tte_df["event"] == 1),
-    "stop"
-] += 0.5
+def build_tte(df, end_measure, immunity_lag=IMMUNITY_LAG):
+    # End of observation: death day or administrative censoring day (the cohort's end_day column)
+    end_day = df.end_day(end_measure)
+
+    # Unvaccinated time [0, immune_start), vaccinated time [immune_start, end] if immune_start < end
+    # (never vaccinated: entire follow-up unvaccinated), see czechfoi.kernels
+    person, start, stop, event, vaccinated = lag_episodes(df['death_day'], df['first_dose_day'], end_day,
+                                                          immunity_lag)
+    tte_df = pd.DataFrame({
+        'id': df.index.to_numpy()[person],
+        'start': start.astype(np.int64),
+        'stop': stop.astype(np.int64),
+        'vaccinated': vaccinated,
+        'event': event
+    })
+    carry_weights(tte_df, df, person)
+
+    # Fix for zero-length intervals with event
+    tte_df.loc[
+        (tte_df["start"] == tte_df["stop"]) & (tte_df["event"] == 1),
+        "stop"
+    ] += 0.5
+    return tte_df
 
 # === Fit time-dependent Cox model ===
-ctv = CoxTimeVaryingFitter(penalizer=0.1)
-ctv.fit(tte_df, id_col="id", start_col="start", stop_col="stop", event_col="event")
-ctv.print_summary()
+def fit_cox(tte_df):
+    from lifelines import CoxTimeVaryingFitter
+    ctv = CoxTimeVaryingFitter(penalizer=scaled_penalizer(tte_df, 0.1))
+    ctv.fit(tte_df, id_col="id", start_col="start", stop_col="stop", event_col="event", weights_col=weight_col(tte_df))
+    return ctv
 
 # === Plot stratified survival curves by dose using Kaplan-Meier estimators ===
-
-kmf_vax = KaplanMeierFitter()
-kmf_unvax = KaplanMeierFitter()
-
-# Aggregate data per individual for KM plot
-# We use the maximum stop time per individual in vaccinated and unvaccinated states, with event if event happened during that state
-
-# For unvaccinated:
-unvax_df = tte_df[tte_df['vaccinated'] == 0].groupby('id').agg({
-    'stop': 'max',
-    'event': 'max'
-}).reset_index()
-
-# For vaccinated:
-vax_df = tte_df[tte_df['vaccinated'] == 1].groupby('id').agg({
-    'stop': 'max',
-    'event': 'max'
-}).reset_index()
-
-# Fit KM curves
-kmf_unvax.fit(durations=unvax_df['stop'], event_observed=unvax_df['event'], label='Unvaccinated')
-kmf_vax.fit(durations=vax_df['stop'], event_observed=vax_df['event'], label='Vaccinated')
-
-# Prepare Plotly figure
-fig = go.Figure()
-
-fig.add_trace(go.Scatter(
-    x=kmf_unvax.survival_function_.index,
-    y=kmf_unvax.survival_function_['Unvaccinated'],
-    mode='lines',
-    name='Unvaccinated',
-    line=dict(color='red')
-))
-
-fig.add_trace(go.Scatter(
-    x=kmf_vax.survival_function_.index,
-    y=kmf_vax.survival_function_['Vaccinated'],
-    mode='lines',
-    name='Vaccinated',
-    line=dict(color='green')
-))
-
-fig.update_layout(
-    title="Stratified Survival Curves by Dose (Vaccinated vs Unvaccinated)",
-    xaxis_title="Days since Start",
-    yaxis_title="Survival Probability",
-    yaxis=dict(range=[0, 1]),
-    template="plotly_white"
-)
-
-# Save interactive plot to HTML
-fig.write_html(OUTPUT_HTML)
-print(f"Interactive survival curves plot saved to {OUTPUT_HTML}")
-
-# close logging console and restore original streams at end
-sys.stdout = original_stdout
-sys.stderr = original_stderr
-log_file.close()
\ No newline at end of file
+def fit_km(tte_df):
+    from lifelines import KaplanMeierFitter
+    kmf_vax = KaplanMeierFitter()
+    kmf_unvax = KaplanMeierFitter()
+
+    # Aggregate data per individual for KM plot
+    # We use the maximum stop time per individual in vaccinated and unvaccinated states, with event if event happened during that state
+
+    # A collapsed table (see czechfoi.collapse) keeps its weights: one row still stands for one interval
+    per_id = {'stop': 'max', 'event': 'max'}
+    if WEIGHT_COL in tte_df:
+        per_id[WEIGHT_COL] = 'first'
+
+    # For unvaccinated:
+    unvax_df = tte_df[tte_df['vaccinated'] == 0].groupby('id').agg(per_id).reset_index()
+
+    # For vaccinated:
+    vax_df = tte_df[tte_df['vaccinated'] == 1].groupby('id').agg(per_id).reset_index()
+
+    # Fit KM curves
+    kmf_unvax.fit(durations=unvax_df['stop'], event_observed=unvax_df['event'], weights=weights(unvax_df),
+                  label='Unvaccinated')
+    kmf_vax.fit(durations=vax_df['stop'], event_observed=vax_df['event'], weights=weights(vax_df), label='Vaccinated')
+    return kmf_unvax, kmf_vax
+
+def report(end_measure, ctv, kmfs, output_html=OUTPUT_HTML, title=TITLE):
+    import plotly.graph_objects as go
+    kmf_unvax, kmf_vax = kmfs
+    print(f"END_MEASURE (max death day): {end_measure}")
+    ctv.print_summary()
+
+    # Prepare Plotly figure
+    fig = go.Figure()
+
+    fig.add_trace(go.Scatter(
+        x=kmf_unvax.survival_function_.index,
+        y=kmf_unvax.survival_function_['Unvaccinated'],
+        mode='lines',
+        name='Unvaccinated',
+        line=dict(color='red')
+    ))
+
+    fig.add_trace(go.Scatter(
+        x=kmf_vax.survival_function_.index,
+        y=kmf_vax.survival_function_['Vaccinated'],
+        mode='lines',
+        name='Vaccinated',
+        line=dict(color='green')
+    ))
+
+    fig.update_layout(
+        title=title,
+        xaxis_title="Days since Start",
+        yaxis_title="Survival Probability",
+        yaxis=dict(range=[0, 1]),
+        template="plotly_white"
+    )
+
+    # Save interactive plot to HTML
+    figures.compress_traces(fig, steps=True)   # KM curves: keep the change points
+    figures.write_html(fig, output_html)
+    print(f"Interactive survival curves plot saved to {output_html}")
+
+def main():
+    # Console output is duplicated into OUTPUT_TXT; stage timings go to the run record next to it
+    with run_log(OUTPUT_TXT, script="FS", input_csv=INPUT_CSV, immunity_lag=IMMUNITY_LAG) as run:
+        with run.stage("load") as st:
+            df = st.count(Cohort.from_csv(INPUT_CSV))
+        end = end_measure(df)
+        with run.stage("intervals") as st:
+            tte_df = st.count(build_tte(df, end))
+        if COLLAPSE:
+            with run.stage("collapse") as st:
+                tte_df = st.count(collapse_intervals(tte_df))
+        with run.stage("cox"):
+            ctv = fit_cox(tte_df)
+        with run.stage("km"):
+            kmfs = fit_km(tte_df)
+        with run.stage("report"):
+            report(end, ctv, kmfs)
+
+if __name__ == "__main__":
+    main()
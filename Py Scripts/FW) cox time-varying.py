@@ -1,9 +1,14 @@
 import pandas as pd
 import numpy as np
-import plotly.graph_objects as go
-from lifelines import CoxTimeVaryingFitter, KaplanMeierFitter
-from scipy.integrate import simps  # for numerical integration
-import sys
+
+# lifelines, plotly and scipy are imported inside the functions that use them, so loading
+# the script (pipeline runner, cache hits) stays fast
+from czechfoi.data import carry_weights
+from czechfoi.cohort import Cohort, end_measure
+from czechfoi.collapse import collapse_intervals, weight_col, weights, scaled_penalizer
+from czechfoi.instrument import run_log
+from czechfoi.kernels import lag_episodes
+from czechfoi import figures, stratified
 
 """
 Time-Varying Cox Regression and Survival Analysis on Vaccination and Death Data
@@ -16,21 +21,21 @@ Major steps include:
 1. Loading individual-level data including vaccination and death dates.
 2. Preprocessing to calculate age and convert date fields to numeric day indices.
 3. Creating time-varying segments for each individual with vaccinated/unvaccinated periods.
-4. Fitting a Cox time-varying model using lifelines.
-5. Plotting Kaplan-Meier survival curves for both exposure groups using Plotly.
-6. Estimating life-years saved using numerical integration.
+4. Merging identical censored segments into weighted rows (see czechfoi.collapse).
+5. Fitting a Cox time-varying model using lifelines.
+6. Plotting Kaplan-Meier survival curves for both exposure groups using Plotly.
+7. Estimating life-years saved using numerical integration.
+
+Each step is a function, so the pipeline runner (czechfoi.pipeline) can cache them as separate stages.
+
+With STRATIFIED = True, all ages are fitted in one Cox model instead of AGE alone: one baseline hazard
+per birth year and a shared vaccination HR, plus a per-age HR from the same Newton iterations
+(see czechfoi.stratified). The strata are accumulated in STRATIFIED_WORKERS processes.
 
 Required:
 - Input CSV with 'Rok_narozeni', 'DatumUmrti', and 'Datum_1' to 'Datum_7'
 """
 
-import pandas as pd
-import numpy as np
-import plotly.graph_objects as go
-from lifelines import CoxTimeVaryingFitter, KaplanMeierFitter
-from scipy.integrate import simps  # for numerical integration
-import sys
-
 # === Constants for I/O and analysis configuration ===
 
 # Select one of the input/output paths depending on the dataset being analyzed
@@ -40,237 +45,212 @@ import sys
 #OUTPUT_HTML = r"C:\CzechFOI-DRATE-NOBIAS\Plot Results\FW) cox time-varying\FW-FG) case3_sim_deaths_sim_real_doses_with_constraint AG70 cox time-varying.html"
 #OUTPUT_TXT = r"C:\CzechFOI-DRATE-NOBIAS\Plot Results\FW) cox time-varying\FW-FG) case3_sim_deaths_sim_real_doses_with_constraint AG70 cox time-varying.TXT"
 
-# real czech data 
+# real czech data
 INPUT_CSV = r"C:\CzechFOI-DRATE-NOBIAS\Terra\Vesely_106_202403141131_AG70.csv"
 OUTPUT_HTML = r"C:\CzechFOI-DRATE-NOBIAS\Plot Results\FW) cox time-varying\FW) Vesely_106_202403141131_AG70 cox time-varying.html"
 OUTPUT_TXT = r"C:\CzechFOI-DRATE-NOBIAS\Plot Results\FW) cox time-varying\FW) Vesely_106_202403141131_AG70 cox time-varying.TXT"
 
-START_DATE = pd.Timestamp('2020-01-01')  # Reference date for calculating relative day indices
-REFERENCE_YEAR = 2023                   # Used to calculate age from year of birth
-MAX_AGE = 113                           # Age filtering threshold
 LAG_DAYS = 0                            # Immunization lag (e.g., 14 days) after vaccination
 AGE = 70                                # Filter to certain AG for faster testing
+COLLAPSE = True                         # Fit on identical censored intervals merged into weighted rows
+STRATIFIED = False                      # All ages in one age-stratified model instead of AGE
+STRATIFIED_WORKERS = 1                  # Processes accumulating the age strata (0 = the whole CPU budget)
 
-original_stdout = sys.stdout  # Backup original stdout
-
-# === Logging Setup ===
-
-class Tee:
-    """Helper class to duplicate stdout/stderr to both console and log file"""
-    def __init__(self, *files):
-        self.files = files
-
-    def write(self, data):
-        for f in self.files:
-            f.write(data)
-            f.flush()
-
-    def flush(self):
-        for f in self.files:
-            f.flush()
-
-# Redirect stdout/stderr to both console and log file
-original_stdout = sys.stdout
-original_stderr = sys.stderr
-log_file_path = fr"{OUTPUT_TXT}"
-log_file = open(log_file_path, "w", encoding="utf-8")
-tee = Tee(sys.stdout, log_file)
-sys.stdout = tee
-sys.stderr = tee
+TITLE = "Survival curves by vaccination state (Time-Varying Cox Model)"
 
 # === Load CSV and preprocess ===
 
-# Define vaccination date columns
-dose_cols = [f'Datum_{i}' for i in range(1, 8)]
-
-# Load only necessary columns and parse dates
-df = pd.read_csv(
-    INPUT_CSV,
-    usecols=['Rok_narozeni', 'DatumUmrti'] + dose_cols,
-    parse_dates=['DatumUmrti'] + dose_cols,
-    dayfirst=False
-)
-
-# Normalize column names
-df.columns = [col.lower().strip() for col in df.columns]
-dose_cols = [col.lower() for col in dose_cols]
-
-# Calculate age and drop invalid rows
-df['birth_year'] = pd.to_numeric(df['rok_narozeni'], errors='coerce')
-df['age'] = REFERENCE_YEAR - df['birth_year']
-df = df[df['age'].between(0, MAX_AGE)].copy()
-df.dropna(subset=['age'], inplace=True)
-
-# Filter for AG 
-df = df[df['age'] == AGE].copy()
-
-# === Convert all date columns to integer day numbers ===
-to_day = lambda col: (df[col] - START_DATE).dt.days
-df['death_day'] = to_day('datumumrti')
-for col in dose_cols:
-    df[col + '_day'] = to_day(col)
-
-# Identify first dose day and whether any dose exists
-dose_day_cols = [col + '_day' for col in dose_cols]
-df['first_dose_day'] = df[dose_day_cols].min(axis=1, skipna=True)
-df['has_any_dose'] = df[dose_day_cols].notna().any(axis=1)
-
-# Define the last measurement day (for censoring)
-END_MEASURE = int(df['death_day'].dropna().max())
-df['end_day'] = df['death_day'].fillna(END_MEASURE)
-print(f"END_MEASURE (max death day): {END_MEASURE}")
+def select_age(df, age=AGE):
+    """View of one age group of the cohort (see czechfoi.cohort); rows without an age are never selected"""
+    return df.view(ages=age)
 
 # === Create Time-Varying Format for Cox Model ===
 
-tv_data = []
-for idx, row in df.iterrows():
-    pid = idx  # Use index as patient ID
-    death_day = row['death_day']
-    end_day = row['end_day']
-    dose_day = row['first_dose_day']
-    has_dose = row['has_any_dose']
-
-    # Segment 1: Pre-vaccination period (until dose+lag or death)
-    unvax_stop = min(end_day, dose_day + LAG_DAYS) if has_dose else end_day
-    tv_data.append({
-        'id': pid,
-        'start': 0,
-        'stop': unvax_stop,
-        'event': int(death_day == unvax_stop),
-        'vaccinated': 0,
-        't': unvax_stop
+def build_intervals(df, end_measure, lag_days=LAG_DAYS):
+    """Split each person into an unvaccinated and (if dosed) a vaccinated interval"""
+    # Last measurement day (for censoring): the cohort's end_day column for this END_MEASURE
+    end_day = df.end_day(end_measure)
+
+    # Segment 1: pre-vaccination period (until dose+lag or death),
+    # segment 2: post-vaccination period (dose+lag to death or censoring), see czechfoi.kernels
+    person, start, stop, event, vaccinated = lag_episodes(df['death_day'], df['first_dose_day'], end_day, lag_days)
+    tv_df = pd.DataFrame({
+        'id': df.index.to_numpy()[person],  # Use index as patient ID
+        'start': start,
+        'stop': stop,
+        'event': event,
+        'vaccinated': vaccinated,
+        't': stop.copy()
     })
+    carry_weights(tv_df, df, person)  # preview sample weights, if any
 
-    # Segment 2: Post-vaccination period (dose+lag to death or censoring)
-    if has_dose and dose_day + LAG_DAYS < end_day:
-        tv_data.append({
-            'id': pid,
-            'start': dose_day + LAG_DAYS,
-            'stop': end_day,
-            'event': int(death_day == end_day),
-            'vaccinated': 1,
-            't': end_day
-        })
-
-tv_df = pd.DataFrame(tv_data)
-
-# Adjust rows where start == stop and event==1 to avoid 0-duration intervals
-tv_df.loc[(tv_df["start"] == tv_df["stop"]) & (tv_df["event"] == 1), "stop"] += 0.5
+    # Adjust rows where start == stop and event==1 to avoid 0-duration intervals
+    tv_df.loc[(tv_df["start"] == tv_df["stop"]) & (tv_df["event"] == 1), "stop"] += 0.5
 
-# Add a time-dependent interaction term
-tv_df['vaccinated_time'] = tv_df['vaccinated'] * (tv_df['stop'] - tv_df['start'])
+    # Add a time-dependent interaction term
+    tv_df['vaccinated_time'] = tv_df['vaccinated'] * (tv_df['stop'] - tv_df['start'])
 
-# Clean NaNs and infinities before fitting
-tv_df.replace([np.inf, -np.inf], np.nan, inplace=True)
-tv_df.dropna(inplace=True)
+    # Clean NaNs and infinities before fitting
+    tv_df.replace([np.inf, -np.inf], np.nan, inplace=True)
+    tv_df.dropna(inplace=True)
+    return tv_df
 
 # === Fit Cox Time-Varying Model ===
 
-ctv = CoxTimeVaryingFitter(penalizer=0.1)
-ctv.fit(tv_df, id_col="id", start_col="start", stop_col="stop", event_col="event", show_progress=True)
-
-# Print model summary
-print(ctv.summary)
-
-# === Compute Hazard Ratios with Confidence Intervals ===
-
-hr = ctv.hazard_ratios_
-ci = ctv.confidence_intervals_
-
-# Identify columns for confidence interval bounds
-lower_col = [col for col in ci.columns if "lower" in col.lower()][0]
-upper_col = [col for col in ci.columns if "upper" in col.lower()][0]
-
-# Output HRs with 95% CI
-print("\nHazard Ratios and 95% Confidence Intervals:")
-for cov in hr.index:
-    lb = ci.loc[cov, lower_col]
-    ub = ci.loc[cov, upper_col]
-    print(f"{cov}: HR = {hr[cov]:.3f} (95% CI: {np.exp(lb):.3f} - {np.exp(ub):.3f})")
-
-# === Plot Kaplan-Meier Survival Curves using Plotly ===
-
-# Fit KM model to unvaccinated intervals
-kmf_uvx = KaplanMeierFitter()
-mask_uvx = tv_df['vaccinated'] == 0
-durations_uvx = tv_df.loc[mask_uvx, 'stop'] - tv_df.loc[mask_uvx, 'start']
-events_uvx = tv_df.loc[mask_uvx, 'event']
-kmf_uvx.fit(durations=durations_uvx, event_observed=events_uvx, label="Unvaccinated")
-
-# Fit KM model to vaccinated intervals
-kmf_vx = KaplanMeierFitter()
-mask_vx = tv_df['vaccinated'] == 1
-durations_vx = tv_df.loc[mask_vx, 'stop'] - tv_df.loc[mask_vx, 'start']
-events_vx = tv_df.loc[mask_vx, 'event']
-kmf_vx.fit(durations=durations_vx, event_observed=events_vx, label="Vaccinated")
-
-fig = go.Figure()
-
-# Add unvaccinated survival trace
-fig.add_trace(go.Scatter(
-    x=kmf_uvx.survival_function_.index,
-    y=kmf_uvx.survival_function_['Unvaccinated'],
-    mode='lines',
-    name='Unvaccinated',
-    line=dict(color='blue')
-))
-
-# Add vaccinated survival trace
-fig.add_trace(go.Scatter(
-    x=kmf_vx.survival_function_.index,
-    y=kmf_vx.survival_function_['Vaccinated'],
-    mode='lines',
-    name='Vaccinated',
-    line=dict(color='red')
-))
-
-# Layout adjustments
-fig.update_layout(
-    title="Survival curves by vaccination state (Time-Varying Cox Model)",
-    xaxis_title="Days under exposure",
-    yaxis_title="Survival probability",
-    template='plotly_white',
-    hovermode="x unified"
-)
-
-# === Calculate Life Years Saved by Integration ===
-
-# Define max integration limit across both curves
-max_day_uvx = kmf_uvx.survival_function_.index.max()
-max_day_vx = kmf_vx.survival_function_.index.max()
-max_day = min(END_MEASURE, max_day_uvx, max_day_vx)
-
-# Truncate survival curves to same time range
-surv_uvx = kmf_uvx.survival_function_.loc[:max_day, 'Unvaccinated']
-surv_vx = kmf_vx.survival_function_.loc[:max_day, 'Vaccinated']
-
-# Time axis
-time_uvx = surv_uvx.index.values
-time_vx = surv_vx.index.values
-
-# Numerical integration to compute expected survival time
-expected_surv_uvx = simps(surv_uvx.values, time_uvx)
-expected_surv_vx = simps(surv_vx.values, time_vx)
-
-# Difference in expected survival time = life-years saved
-life_years_saved = (expected_surv_vx - expected_surv_uvx) / 365
-print(f"Life years saved (vaccinated vs unvaccinated) up to day {max_day}: {life_years_saved:.4f} years")
-
-# Add annotation to survival plot
-fig.add_annotation(
-    x=max_day * 0.7,
-    y=0.1,
-    text=f"Life Years Saved: {life_years_saved:.3f} years",
-    showarrow=False,
-    font=dict(size=14, color="green"),
-    bgcolor="rgba(255,255,255,0.8)"
-)
-
-# Save final plot as HTML
-fig.write_html(OUTPUT_HTML)
-print(f"Plot saved to {OUTPUT_HTML} with life years saved annotation")
-
-# === Cleanup: Restore original stdout/stderr and close log ===
-sys.stdout = original_stdout
-sys.stderr = original_stderr
-log_file.close()
+def fit_cox(tv_df):
+    from lifelines import CoxTimeVaryingFitter
+    ctv = CoxTimeVaryingFitter(penalizer=scaled_penalizer(tv_df, 0.1))
+    ctv.fit(tv_df, id_col="id", start_col="start", stop_col="stop", event_col="event", weights_col=weight_col(tv_df),
+            show_progress=True)
+    return ctv
+
+# === Kaplan-Meier Survival Curves ===
+
+def fit_km(tv_df):
+    from lifelines import KaplanMeierFitter
+    # Fit KM model to unvaccinated intervals
+    kmf_uvx = KaplanMeierFitter()
+    mask_uvx = tv_df['vaccinated'] == 0
+    durations_uvx = tv_df.loc[mask_uvx, 'stop'] - tv_df.loc[mask_uvx, 'start']
+    events_uvx = tv_df.loc[mask_uvx, 'event']
+    kmf_uvx.fit(durations=durations_uvx, event_observed=events_uvx, weights=weights(tv_df[mask_uvx]), label="Unvaccinated")
+
+    # Fit KM model to vaccinated intervals
+    kmf_vx = KaplanMeierFitter()
+    mask_vx = tv_df['vaccinated'] == 1
+    durations_vx = tv_df.loc[mask_vx, 'stop'] - tv_df.loc[mask_vx, 'start']
+    events_vx = tv_df.loc[mask_vx, 'event']
+    kmf_vx.fit(durations=durations_vx, event_observed=events_vx, weights=weights(tv_df[mask_vx]), label="Vaccinated")
+    return kmf_uvx, kmf_vx
+
+# === Report: HRs, survival plot and life years saved ===
+
+def report(end_measure, ctv, kmfs, output_html=OUTPUT_HTML, title=TITLE):
+    import plotly.graph_objects as go
+    from scipy.integrate import simpson  # numerical integration
+    kmf_uvx, kmf_vx = kmfs
+    print(f"END_MEASURE (max death day): {end_measure}")
+
+    # Print model summary
+    print(ctv.summary)
+
+    # === Compute Hazard Ratios with Confidence Intervals ===
+
+    hr = ctv.hazard_ratios_
+    ci = ctv.confidence_intervals_
+
+    # Identify columns for confidence interval bounds
+    lower_col = [col for col in ci.columns if "lower" in col.lower()][0]
+    upper_col = [col for col in ci.columns if "upper" in col.lower()][0]
+
+    # Output HRs with 95% CI
+    print("\nHazard Ratios and 95% Confidence Intervals:")
+    for cov in hr.index:
+        lb = ci.loc[cov, lower_col]
+        ub = ci.loc[cov, upper_col]
+        print(f"{cov}: HR = {hr[cov]:.3f} (95% CI: {np.exp(lb):.3f} - {np.exp(ub):.3f})")
+
+    # === Plot Kaplan-Meier Survival Curves using Plotly ===
+
+    fig = go.Figure()
+
+    # Add unvaccinated survival trace
+    fig.add_trace(go.Scatter(
+        x=kmf_uvx.survival_function_.index,
+        y=kmf_uvx.survival_function_['Unvaccinated'],
+        mode='lines',
+        name='Unvaccinated',
+        line=dict(color='blue')
+    ))
+
+    # Add vaccinated survival trace
+    fig.add_trace(go.Scatter(
+        x=kmf_vx.survival_function_.index,
+        y=kmf_vx.survival_function_['Vaccinated'],
+        mode='lines',
+        name='Vaccinated',
+        line=dict(color='red')
+    ))
+
+    # Layout adjustments
+    fig.update_layout(
+        title=title,
+        xaxis_title="Days under exposure",
+        yaxis_title="Survival probability",
+        template='plotly_white',
+        hovermode="x unified"
+    )
+
+    # === Calculate Life Years Saved by Integration ===
+
+    # Define max integration limit across both curves
+    max_day_uvx = kmf_uvx.survival_function_.index.max()
+    max_day_vx = kmf_vx.survival_function_.index.max()
+    max_day = min(end_measure, max_day_uvx, max_day_vx)
+
+    # Truncate survival curves to same time range
+    surv_uvx = kmf_uvx.survival_function_.loc[:max_day, 'Unvaccinated']
+    surv_vx = kmf_vx.survival_function_.loc[:max_day, 'Vaccinated']
+
+    # Time axis
+    time_uvx = surv_uvx.index.values
+    time_vx = surv_vx.index.values
+
+    # Numerical integration to compute expected survival time
+    expected_surv_uvx = simpson(surv_uvx.values, x=time_uvx)
+    expected_surv_vx = simpson(surv_vx.values, x=time_vx)
+
+    # Difference in expected survival time = life-years saved
+    life_years_saved = (expected_surv_vx - expected_surv_uvx) / 365
+    print(f"Life years saved (vaccinated vs unvaccinated) up to day {max_day}: {life_years_saved:.4f} years")
+
+    # Add annotation to survival plot
+    fig.add_annotation(
+        x=max_day * 0.7,
+        y=0.1,
+        text=f"Life Years Saved: {life_years_saved:.3f} years",
+        showarrow=False,
+        font=dict(size=14, color="green"),
+        bgcolor="rgba(255,255,255,0.8)"
+    )
+
+    # Save final plot as HTML
+    figures.compress_traces(fig, steps=True)   # KM curves: keep the change points
+    figures.write_html(fig, output_html)
+    print(f"Plot saved to {output_html} with life years saved annotation")
+
+# === Main ===
+
+def report_stratified(fit):
+    print(fit.summary())
+    print("\nPer-age hazard ratios (vaccinated vs unvaccinated):")
+    print(fit.per_age.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+def main_stratified():
+    with run_log(OUTPUT_TXT, script="FW", input_csv=INPUT_CSV, stratified=True, lag_days=LAG_DAYS) as run:
+        with run.stage("stratified cox"):
+            fit = stratified.fit_csv(INPUT_CSV, LAG_DAYS, workers=STRATIFIED_WORKERS)
+        report_stratified(fit)
+
+def main():
+    if STRATIFIED:
+        return main_stratified()
+    # Console output is duplicated into OUTPUT_TXT; stage timings go to the run record next to it
+    with run_log(OUTPUT_TXT, script="FW", input_csv=INPUT_CSV, age=AGE, lag_days=LAG_DAYS) as run:
+        with run.stage("load") as st:
+            df = st.count(select_age(Cohort.from_csv(INPUT_CSV)))
+        end = end_measure(df)
+        with run.stage("intervals") as st:
+            tv_df = st.count(build_intervals(df, end))
+        if COLLAPSE:
+            with run.stage("collapse") as st:
+                tv_df = st.count(collapse_intervals(tv_df))
+        with run.stage("cox"):
+            ctv = fit_cox(tv_df)
+        with run.stage("km"):
+            kmfs = fit_km(tv_df)
+        with run.stage("report"):
+            report(end, ctv, kmfs)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""
+Shared helpers for the CzechFOI-DRATE-NOBIAS analysis scripts.
+
+Modules:
+- bench: benchmark suite timing every stage on synthetic cohorts
+- chunked: out-of-core mode, chunked loading reduced into per-age/day accumulators
+- cohort: lazily derived, memoized cohort columns with shared age/lag views and an optional on-disk cache
+- collapse: frequency-weighted collapsing of identical intervals before model fitting
+- cube: persistent age x day x dose x time-since-dose count cube with a query API
+- data: loading of the Czech FOI CSV files, day-number derivation and weighted preview samples
+- dosetime: smoothed hazard ratio by time since first dose from per-day counts (all ages)
+- estimate: dry-run row and peak-memory estimates per stage from a streamed cohort summary
+- figures: standalone or slim HTML output (shared plotly.js, typed-array traces) and multi-figure reports
+- golden: golden-output regression check of all analyses on a fixed synthetic cohort, with time/memory budgets
+- incremental: incremental count cube update for a new FOI release (record diff)
+- instrument: per-stage timing/memory run records and the console-to-log tee
+- kernels: per-person interval splitting and FG's constraint check, numba-compiled if available, else NumPy
+- multistate: dose-transition counts and Aalen-Johansen state occupancy (unvaccinated, dose 1..7, dead)
+- pipeline: declarative pipeline runner with content-hashed stage caching
+- rolling: vaccinated vs unvaccinated rate ratio in sliding calendar windows from per-day counts
+- scheduler: shared CPU/memory budget for worker processes, BLAS thread pinning and memory-packed tasks
+- schedules: dictionary encoding of the dose schedules (schedule table + ID per person)
+- stratified: age-stratified time-varying Cox model with per-stratum score/information in worker processes
+- synth: synthetic FOI-shaped cohort generator
+"""
@@ -0,0 +1,184 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from czechfoi import data, pipeline, synth
+from czechfoi.instrument import RunRecord
+
+"""
+Benchmark suite on synthetic FOI-shaped cohorts (see czechfoi.synth), runs offline.
+
+For each cohort size the synthetic file is generated once (cached under .bench/data), then every
+stage of the selected analyses is run through the pipeline runner without its cache and timed:
+load, derive, cohort selection, interval/person-day build, aggregation, fits, plots. Wall time,
+CPU time, peak RSS and row counts per stage are appended as one JSON line per size to
+.bench/results.jsonl together with the git commit, so results can be tracked across commits.
+
+Usage (from the 'Py Scripts' folder):
+    python -m czechfoi.bench                               # 100k rows, AG70 cohort, all analyses
+    python -m czechfoi.bench --rows 100k 1M 10M --analyses FS FW ZI
+    python -m czechfoi.bench --all-ages                    # population pyramid instead of AG70
+    python -m czechfoi.bench --compare                     # latest results vs the previous commit
+
+FG is not benchmarked: its constrained dose assignment is quadratic in the cohort size. FJ is
+timed on the synthetic cohort used as both the real and the simulated data.
+FZ and FP are skipped for a size when the person-day table would exceed --max-person-days rows.
+"""
+
+BENCH_DIR = os.path.join(pipeline.ROOT_DIR, ".bench")
+RESULTS_FILE = os.path.join(BENCH_DIR, "results.jsonl")
+
+BENCH_ANALYSES = ['CA', 'FS', 'FW', 'FX', 'FY', 'FZ', 'FP', 'ZI', 'FJ']
+PERSON_DAY_ANALYSES = ('FZ', 'FP')
+DEFAULT_ROWS = ['100k']
+BENCH_AGE = 70                       # Age of the synthetic cohort, like the AG70 export
+MAX_PERSON_DAYS = 20_000_000         # Larger person-day tables are not built (memory)
+FJ_REPLICATES = 20                   # Bias baseline replicates timed in FJ (the script uses 200)
+
+def git_commit():
+    """Short commit hash and whether tracked files are modified; (None, None) outside git."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=pipeline.ROOT_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=pipeline.ROOT_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status)
+
+def cohort_dir(n_rows, age, seed):
+    label = f"{n_rows}-{'all' if age is None else f'age{age}'}-seed{seed}"
+    return os.path.join(BENCH_DIR, "data", label)
+
+def ensure_cohort(n_rows, age, seed):
+    """Data folder holding the synthetic cohort under the real-data file name"""
+    data_dir = cohort_dir(n_rows, age, seed)
+    csv = os.path.join(data_dir, pipeline.REAL_CSV)
+    if not os.path.exists(csv):
+        print(f"Generating {n_rows:,} synthetic rows -> {csv}")
+        synth.write_synthetic_csv(csv + ".tmp", n_rows, seed=seed, age=age)
+        os.replace(csv + ".tmp", csv)
+    return data_dir
+
+def bench_fj(record, derived, out_dir, n_replicates):
+    """Time the FJ stages with the synthetic cohort as both the simulated and the real data"""
+    fj = pipeline.load_script('FJ')
+
+    def timed(name, func, *args, **kwargs):
+        with record.stage(name) as timer:
+            result = func(*args, **kwargs)
+            if hasattr(result, 'shape'):
+                timer.rows = result.shape[0]
+        return result
+
+    prep = timed('FJ:real:prep', fj.preprocess_data, derived)
+    record.stages[-1].rows = len(prep[1])
+    km = timed('FJ:real:km', fj.km_death_rate_diff, prep)
+    doses = timed('FJ:real:doses', fj.daily_dose_counts, prep)
+    replicates = timed('FJ:real:replicates', fj.baseline_replicates, prep, n_replicates=n_replicates)
+    timed('FJ:plot', fj.plot_results, km, km, replicates, doses,
+          output_html=os.path.join(out_dir, "FJ.html"), output_surv_html=os.path.join(out_dir, "FJ_surv.html"))
+
+def bench_size(n_rows, analyses, age=BENCH_AGE, seed=synth.SYNTH_SEED, max_person_days=MAX_PERSON_DAYS,
+               fj_replicates=FJ_REPLICATES):
+    """Run and time all stages of the analyses on one synthetic cohort; returns the RunRecord."""
+    data_dir = ensure_cohort(n_rows, age, seed)
+    n_days = (synth.END_DATE - data.START_DATE).days + 1
+    skipped = []
+    if n_rows * n_days > max_person_days:
+        skipped = [code for code in analyses if code in PERSON_DAY_ANALYSES]
+    selected = [code for code in analyses if code not in skipped and code != 'FJ']
+
+    commit, dirty = git_commit()
+    record = RunRecord(commit=commit, dirty=dirty, rows=n_rows, age=age, seed=seed, analyses=analyses,
+                       skipped=skipped, python=platform.python_version(), numpy=np.__version__,
+                       pandas=pd.__version__, machine=platform.machine(), system=platform.system(),
+                       cpus=os.cpu_count())
+
+    with tempfile.TemporaryDirectory(prefix="czechfoi-bench-") as tmp:
+        stages = pipeline.build_stages(datasets=('real',), analyses=selected, data_dir=data_dir,
+                                       results_dir=os.path.join(tmp, "results"))
+        runner = pipeline.Pipeline(stages, cache_dir=os.path.join(tmp, "cache"), force=True)
+        runner.record = record
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            runner.run()
+            if 'FJ' in analyses:
+                bench_fj(record, runner.value('derive:real'), tmp, fj_replicates)
+    record.meta['status'] = 'completed'
+    return record
+
+def append_result(record, path=RESULTS_FILE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record.as_dict()) + "\n")
+
+def load_results(path=RESULTS_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compare(path=RESULTS_FILE):
+    """Wall time per stage of the latest result per cohort vs the latest one from another commit"""
+    results = load_results(path)
+    if not results:
+        print(f"No benchmark results in {path}")
+        return
+    cohorts = {}
+    for result in results:
+        cohorts.setdefault((result['rows'], result['age'], result['seed']), []).append(result)
+
+    for (rows, age, seed), runs in cohorts.items():
+        latest = runs[-1]
+        previous = next((r for r in reversed(runs[:-1]) if r['commit'] != latest['commit']), None)
+        cohort = f"{rows:,} rows, {'all ages' if age is None else f'age {age}'}"
+        if previous is None:
+            print(f"\n{cohort}: only commit {latest['commit']} measured")
+            continue
+        print(f"\n{cohort}: {previous['commit']} -> {latest['commit']}{' (dirty)' if latest['dirty'] else ''}")
+        before = {s['stage']: s['wall_s'] for s in previous['stages']}
+        print(f"{'stage':28} {'before s':>10} {'after s':>10} {'ratio':>7}")
+        for stage in latest['stages']:
+            old = before.get(stage['stage'])
+            ratio = f"{stage['wall_s'] / old:7.2f}" if old else f"{'-':>7}"
+            old_text = f"{old:10.2f}" if old is not None else f"{'-':>10}"
+            print(f"{stage['stage']:28} {old_text} {stage['wall_s']:10.2f} {ratio}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the analysis stages on synthetic cohorts.")
+    parser.add_argument('--rows', nargs='+', default=DEFAULT_ROWS, help="cohort sizes, e.g. 100k 1M 10M")
+    parser.add_argument('--analyses', nargs='+', default=BENCH_ANALYSES, choices=BENCH_ANALYSES)
+    parser.add_argument('--all-ages', action='store_true', help="population pyramid instead of a single age")
+    parser.add_argument('--seed', type=int, default=synth.SYNTH_SEED)
+    parser.add_argument('--max-person-days', type=int, default=MAX_PERSON_DAYS)
+    parser.add_argument('--fj-replicates', type=int, default=FJ_REPLICATES)
+    parser.add_argument('--results', default=RESULTS_FILE, help="JSON lines file the results are appended to")
+    parser.add_argument('--compare', action='store_true', help="only compare the stored results")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(args.results)
+        return
+
+    for rows in args.rows:
+        n_rows = synth.parse_rows(rows)
+        print(f"\n=== {n_rows:,} rows ({datetime.datetime.now():%H:%M:%S}) ===", file=sys.stderr)
+        record = bench_size(n_rows, args.analyses, age=None if args.all_ages else BENCH_AGE, seed=args.seed,
+                            max_person_days=args.max_person_days, fj_replicates=args.fj_replicates)
+        if record.meta['skipped']:
+            print(f"Skipped (person-day table too large): {', '.join(record.meta['skipped'])}")
+        print(record.summary())
+        append_result(record, args.results)
+    print(f"\nResults appended to {args.results}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import numpy as np
+import pandas as pd
+
+from czechfoi.data import MAX_AGE, DOSE_DAY_COLS, WEIGHT_COL, load_csv, derive_days
+
+"""
+Out-of-core mode: stream the input in chunks and reduce every chunk into small accumulators.
+
+The national file does not fit into memory as a DataFrame with all derived columns. Here the
+loader reads chunks whose size follows a memory budget, derives the day numbers per chunk
+(day conversion and first dose are row-wise) and adds the chunk to accumulators whose size only
+depends on ages x days, not on the number of people:
+
+- AgeDayCounts: population, deaths and doses per age and day for vaccinated/unvaccinated,
+  giving the ZI daily counts and the FZ/FP Poisson table without a person-day table
+- VaccinationKM: event/censoring histograms for the FZ/FP Kaplan-Meier curves
+
+END_MEASURE (the last death day) is only known after the last chunk. People still alive are
+therefore stored as open-ended intervals and closed at END_MEASURE when the results are read.
+
+Usage:
+    counts, km = AgeDayCounts(), VaccinationKM()
+    end = reduce_csv(INPUT_CSV, [counts, km], memory_budget_mb=2000)
+    agg = counts.poisson_table(end)
+"""
+
+MEMORY_BUDGET_MB = 2000     # Default memory for one chunk in flight
+ROW_BYTES = 700             # Approximate memory per row of a loaded and derived chunk
+MIN_CHUNK_ROWS = 10_000
+
+def chunk_rows(memory_budget_mb=MEMORY_BUDGET_MB):
+    """Rows per chunk so that a loaded and derived chunk stays within the budget"""
+    return max(MIN_CHUNK_ROWS, int(memory_budget_mb * (1 << 20) / ROW_BYTES))
+
+def iter_derived_chunks(path, memory_budget_mb=MEMORY_BUDGET_MB, **derive_kwargs):
+    """Derived chunks (see czechfoi.data.derive_days) of the input file"""
+    for chunk in load_csv(path, chunksize=chunk_rows(memory_budget_mb)):
+        yield derive_days(chunk, **derive_kwargs)
+
+def reduce_csv(path, accumulators, memory_budget_mb=MEMORY_BUDGET_MB, **derive_kwargs):
+    """
+    Add every chunk of the input to each accumulator; returns END_MEASURE (maximum death day).
+    """
+    end_measure = None
+    for chunk in iter_derived_chunks(path, memory_budget_mb, **derive_kwargs):
+        for accumulator in accumulators:
+            accumulator.add(chunk)
+        chunk_end = chunk['death_day'].max()
+        if pd.notna(chunk_end):
+            end_measure = int(chunk_end) if end_measure is None else max(end_measure, int(chunk_end))
+    if end_measure is None:
+        raise ValueError(f"No deaths in {path}: END_MEASURE is undefined")
+    return end_measure
+
+def poisson_inputs(path, memory_budget_mb=MEMORY_BUDGET_MB):
+    """END_MEASURE, the FZ/FP Poisson table and Kaplan-Meier curves of an input in one streamed pass"""
+    counts, km = AgeDayCounts(), VaccinationKM()
+    end_measure = reduce_csv(path, [counts, km], memory_budget_mb)
+    return end_measure, counts.poisson_table(end_measure), km.curves(end_measure)
+
+class DayGrid:
+    """
+    Named age x day count arrays that grow along the day axis as later days show up.
+
+    Interval counts are kept as difference arrays (+1 at the start day, -1 at the stop day),
+    so open-ended intervals are simply never closed and cumsum() gives the counts per day.
+    With dtype=float the arrays hold sums of fractional weights (preview samples) instead of counts.
+    """
+    def __init__(self, names, n_ages=MAX_AGE + 1, dtype=np.int64):
+        self.n_ages = n_ages
+        self.n_days = 0
+        self.arrays = {name: np.zeros((n_ages, 0), dtype=dtype) for name in names}
+
+    def ensure(self, n_days):
+        if n_days > self.n_days:
+            grow = max(n_days, 2 * self.n_days) - self.n_days
+            for name, array in self.arrays.items():
+                self.arrays[name] = np.pad(array, ((0, 0), (0, grow)))
+            self.n_days += grow
+
+    def _add(self, name, ages, days, sign, weights=None):
+        if len(days) == 0:
+            return
+        self.ensure(int(days.max()) + 1)
+        flat = ages * self.n_days + days
+        counts = np.bincount(flat, weights=weights, minlength=self.n_ages * self.n_days)
+        array_type = self.arrays[name].dtype
+        if weights is not None and np.issubdtype(array_type, np.integer):
+            counts = np.rint(counts).astype(array_type)
+        self.arrays[name] += counts.reshape(self.n_ages, -1) * sign
+
+    def add_points(self, name, ages, days, weights=None):
+        """+1 (or +weight) at (age, day) for each finite day >= 0"""
+        keep = np.isfinite(days) & (days >= 0)
+        self._add(name, ages[keep], days[keep].astype(np.int64), 1, None if weights is None else weights[keep])
+
+    def add_ranges(self, name, ages, start, stop, weights=None):
+        """
+        +1 (or +weight) on the days [start, stop) per row; stop = inf leaves the interval open.
+        Integer weights count a row several times, negative weights remove rows (see czechfoi.incremental).
+        """
+        start = np.maximum(start, 0)
+        keep = stop > start
+        ages, start, stop = ages[keep], start[keep], stop[keep]
+        weights = None if weights is None else weights[keep]
+        self._add(name, ages, start.astype(np.int64), 1, weights)
+        closed = np.isfinite(stop)
+        self._add(name, ages[closed], stop[closed].astype(np.int64), -1, None if weights is None else weights[closed])
+
+    def counts(self, name, end_measure, cumulative=False):
+        """(n_ages, end_measure + 1) array of the days 0..end_measure"""
+        self.ensure(end_measure + 1)
+        array = self.arrays[name]
+        if cumulative:
+            array = array.cumsum(axis=1)
+        return array[:, :end_measure + 1]
+
+class AgeDayCounts:
+    """
+    Population, deaths and doses per age and day, split by vaccination state on that day.
+
+    A person counts as vaccinated from the first dose day on; as alive on the days before the
+    death day (as in ZI) and as under observation up to and including the death day (as in the
+    FZ/FP person-day table).
+
+    weighted=True sums the 'weight' column of the chunks (a preview sample, see
+    czechfoi.data.preview_sample) into float arrays instead of counting persons.
+    """
+    def __init__(self, weighted=False):
+        dtype = float if weighted else np.int64
+        self.weighted = weighted
+        self.grid = DayGrid(['alive_vx', 'alive_uvx', 'death_vx', 'death_uvx', 'first_doses', 'all_doses'], dtype=dtype)
+        self.persons = np.zeros(MAX_AGE + 1, dtype=dtype)
+
+    def add(self, chunk):
+        ages = chunk['age'].to_numpy(dtype=np.int64)
+        death = chunk['death_day'].to_numpy(dtype=float)
+        first = chunk['first_dose_day'].to_numpy(dtype=float)
+        death_open = np.where(np.isnan(death), np.inf, death)
+        first_open = np.where(np.isnan(first), np.inf, first)
+        w = chunk[WEIGHT_COL].to_numpy(dtype=float) if self.weighted else None
+
+        self.persons += np.bincount(ages, weights=w, minlength=MAX_AGE + 1).astype(self.persons.dtype)
+        self.grid.add_ranges('alive_uvx', ages, np.zeros(len(ages)), np.minimum(first_open, death_open), w)
+        self.grid.add_ranges('alive_vx', ages, first_open, death_open, w)
+
+        vaccinated_at_death = death >= first
+        for name, rows in (('death_vx', vaccinated_at_death), ('death_uvx', ~vaccinated_at_death)):
+            self.grid.add_points(name, ages[rows], death[rows], None if w is None else w[rows])
+
+        self.grid.add_points('first_doses', ages, first, w)
+        for col in DOSE_DAY_COLS:
+            self.grid.add_points('all_doses', ages, chunk[col].to_numpy(dtype=float), w)
+
+    def _counts(self, end_measure):
+        return {name: self.grid.counts(name, end_measure, cumulative=name.startswith('alive'))
+                for name in self.grid.arrays}
+
+    def daily_counts(self, end_measure):
+        """Per age and day: pop_vx, pop_uvx, death_vx, ... as counted by ZI compute_daily_counts"""
+        c = self._counts(end_measure)
+        ages = np.flatnonzero(self.persons)
+        n_days = end_measure + 1
+        result = pd.DataFrame({
+            'day': np.tile(np.arange(n_days), len(ages)),
+            'age': np.repeat(ages, n_days),
+            'pop_vx': c['alive_vx'][ages].ravel(),
+            'pop_uvx': c['alive_uvx'][ages].ravel(),
+            'death_vx': c['death_vx'][ages].ravel(),
+            'death_uvx': c['death_uvx'][ages].ravel(),
+        })
+        result['death_total'] = result['death_vx'] + result['death_uvx']
+        result['pop_total'] = result['pop_vx'] + result['pop_uvx']
+        return result[['day', 'age', 'pop_vx', 'pop_uvx', 'death_vx', 'death_uvx', 'death_total', 'pop_total']]
+
+    def dose_counts(self, end_measure):
+        """Daily first and all dose counts, DataFrames with days as index and ages as columns"""
+        days = np.arange(end_measure + 1)
+        first = pd.DataFrame(self.grid.counts('first_doses', end_measure).T.astype(float), index=days)
+        all_doses = pd.DataFrame(self.grid.counts('all_doses', end_measure).T.astype(float), index=days)
+        return first, all_doses
+
+    def poisson_table(self, end_measure):
+        """
+        Deaths and person-days per age, day and vaccination state, the same table as aggregate()
+        in FZ/FP builds from the person-day rows (including how deaths are marked there: every
+        person-day of an age on a day with a death of that age counts as a death).
+        """
+        c = self._counts(end_measure)
+        any_death = (c['death_vx'] + c['death_uvx']) > 0
+        frames = []
+        for vaccinated, suffix in ((0, 'uvx'), (1, 'vx')):
+            person_days = c[f'alive_{suffix}'] + c[f'death_{suffix}']
+            age, day = np.nonzero(person_days)
+            frames.append(pd.DataFrame({
+                'age': age,
+                'day': day,
+                'vaccinated': vaccinated,
+                'deaths': np.where(any_death[age, day], person_days[age, day], 0),
+                'person_days': person_days[age, day],
+            }))
+        agg = pd.concat(frames, ignore_index=True).sort_values(['age', 'day', 'vaccinated'], ignore_index=True)
+        agg['offset'] = np.log(agg['person_days'])
+        agg['age_c'] = agg['age'] - agg['age'].mean()
+        return agg
+
+class SurvivalHistogram:
+    """Event and censoring counts per duration; durations ending at END_MEASURE are kept by start day"""
+    def __init__(self):
+        self.grid = DayGrid(['events', 'censored', 'open'], n_ages=1)
+
+    def add(self, start, stop, event):
+        """Intervals [start, stop]; stop = inf means censored at END_MEASURE"""
+        zeros = np.zeros(len(start), dtype=np.int64)
+        open_ended = np.isinf(stop)
+        duration = stop - start
+        self.grid.add_points('events', zeros[event], duration[event])
+        self.grid.add_points('censored', zeros[~event & ~open_ended], duration[~event & ~open_ended])
+        self.grid.add_points('open', zeros[open_ended], start[open_ended])
+
+    def survival(self, end_measure, label):
+        """Kaplan-Meier survival function like lifelines' survival_function_ (index 'timeline')"""
+        events = self.grid.counts('events', end_measure)[0]
+        censored = self.grid.counts('censored', end_measure)[0].copy()
+        # Open intervals from start day s end at END_MEASURE: duration end_measure - s
+        open_by_start = self.grid.counts('open', end_measure)[0]
+        censored[end_measure - np.arange(end_measure + 1)] += open_by_start
+        # Durations of 0 are excluded when the intervals are built (stop > start)
+        censored[0] = events[0] = 0
+
+        observed = events + censored
+        at_risk = observed.sum() - np.concatenate([[0], np.cumsum(observed)[:-1]])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = np.where(at_risk > 0, 1 - events / at_risk, 1.0)
+        survival = np.cumprod(factor)
+        timeline = np.flatnonzero(observed)
+        timeline = np.concatenate([[0], timeline[timeline > 0]])
+        return pd.DataFrame({label: survival[timeline]}, index=pd.Index(timeline.astype(float), name='timeline'))
+
+class VaccinationKM:
+    """
+    Kaplan-Meier curves of the unvaccinated period (day 0 to first dose or end of follow-up) and
+    the vaccinated period (first dose to end of follow-up), as fit_km() in FZ/FP.
+    """
+    GROUPS = [('Unvaccinated', 'blue'), ('Vaccinated', 'red')]
+
+    def __init__(self):
+        self.unvaccinated = SurvivalHistogram()
+        self.vaccinated = SurvivalHistogram()
+
+    def add(self, chunk):
+        death = chunk['death_day'].to_numpy(dtype=float)
+        first = chunk['first_dose_day'].to_numpy(dtype=float)
+        end = np.where(np.isnan(death), np.inf, death)
+        dead = ~np.isnan(death)
+
+        stop = np.where(np.isnan(first), end, first)
+        keep = stop > 0
+        self.unvaccinated.add(np.zeros(keep.sum()), stop[keep], (dead & (death <= stop))[keep])
+
+        keep = ~np.isnan(first) & (end > first)
+        self.vaccinated.add(first[keep], end[keep], (dead & (death >= first))[keep])
+
+    def curves(self, end_measure):
+        """[(label, color, survival DataFrame)] as returned by fit_km() in FZ/FP"""
+        return [(label, color, histogram.survival(end_measure, label))
+                for (label, color), histogram in zip(self.GROUPS, (self.unvaccinated, self.vaccinated))]
@@ -0,0 +1,343 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from czechfoi import data
+from czechfoi.collapse import WEIGHT_COL
+from czechfoi.cube import HASH_MEMO, file_hash
+
+"""
+Lazy cohort: the derived columns of one input, computed on first access and shared by all analyses.
+
+Every script used to run derive_days() on its own copy of the data and then add the same columns
+again (end_day, event, END_MEASURE, age subsets). A Cohort holds the loaded frame once and derives
+each column when it is first read:
+
+- birth_year, age, death_day, datum_1_day .. datum_7_day, first_dose_day, has_any_dose (as derive_days)
+- event          1 for a death, else 0
+- end_day        death day, or END_MEASURE for survivors (end_day(end_measure) for another end)
+- exposure_day   first dose day + lag_days of the cohort (exposure_day(lag_days) for another lag)
+
+Columns are kept per cohort, so no column is computed twice in one process. view(ages=70) and
+view(lag_days=14) return filtered views (the same object on every call): a view stores the rows it
+selects (a slice when they are contiguous, e.g. an age block of a sorted file or all rows of the
+AG70 file, so its columns are NumPy views of the cohort's arrays) and takes its columns from the
+cohort it was made from. assign() replaces or adds columns in a view, as DataFrame.assign does.
+
+Reading works like a DataFrame: cohort['death_day'] is a Series, cohort[['age', 'death_day']] a
+DataFrame, 'weight' in cohort, len(cohort) and cohort.index as usual, so the table builders
+(carry_weights, ScheduleTable.from_cohort, AgeDayCounts.add, ...) take cohorts unchanged.
+
+With a cache folder (Cohort.from_csv(path, cache_dir=...) or CACHE_DIR), the derived columns are
+also saved as .npy files in a folder named after the input's content hash (as the count cube) and
+opened memory-mapped on the next run: a script whose columns are all cached does not parse the CSV.
+The content hash is remembered with the file's size and modification time, so the file is not read
+either while it is unchanged.
+
+Usage (from the 'Py Scripts' folder):
+    cohort = Cohort.from_csv(INPUT_CSV)                 # or derive(load_csv(INPUT_CSV)) in the pipeline
+    end = cohort.end_measure
+    ag70 = cohort.view(ages=70)                         # also ages=[65, 70] or ages=range(60, 80)
+    lagged = ag70.view(lag_days=14)
+    tv = lag_episodes(ag70['death_day'], ag70['first_dose_day'], ag70['end_day'], 14)
+    lagged['exposure_day'], ag70.end_day(end)
+"""
+
+CACHE_DIR = None             # Folder for derived columns on disk (None = memory only), e.g. COHORT_ROOT
+COHORT_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), ".cohort")
+COHORT_VERSION = 1
+DERIVED_COLS = ['birth_year', 'age', 'death_day'] + data.DOSE_DAY_COLS + ['first_dose_day', 'has_any_dose']
+LAZY_COLS = ['event', 'end_day', 'exposure_day']
+BASE_COLS = [col.lower() for col in data.NEEDED_COLS]
+
+def _day_number(source):
+    def derive_column(cohort):
+        return data.to_day_number(cohort[source], cohort.start_date).to_numpy()
+    return derive_column
+
+# Columns of a cohort derived from other columns (birth_year and age come with the valid rows)
+DERIVATIONS = {
+    'death_day': _day_number('datumumrti'),
+    **{col + '_day': _day_number(col) for col in data.DOSE_COLS_LOWER},
+    'first_dose_day': lambda cohort: cohort[data.DOSE_DAY_COLS].min(axis=1, skipna=True).to_numpy(),
+    'has_any_dose': lambda cohort: cohort[data.DOSE_DAY_COLS].notna().any(axis=1).to_numpy(),
+    'event': lambda cohort: cohort['death_day'].notna().astype(int).to_numpy(),
+}
+
+def _key_name(key):
+    return key if isinstance(key, str) else f"{key[0]}-{key[1]:g}"
+
+class Cohort:
+    """
+    Lazily derived columns of one loaded input (see the module description). Create cohorts with
+    Cohort(frame) for a frame from data.load_csv, Cohort.from_csv(path) or Cohort.from_derived(df).
+    """
+    def __init__(self, frame=None, max_age=data.MAX_AGE, reference_year=data.REFERENCE_YEAR,
+                 start_date=data.START_DATE, derived=False, source=None, cache_dir=None):
+        self.max_age = max_age
+        self.reference_year = reference_year
+        self.start_date = start_date
+        self.lag_days = 0
+        self._frame = frame
+        self._derived_frame = derived      # frame already holds the derived columns of valid rows only
+        self._source = source              # input file, loaded on first need if frame is None
+        self._disk = None
+        self._parent = None
+        self._rows = None                  # root: rows of the frame with a valid age; view: rows of the parent
+        self._index = None
+        self._end_measure = None
+        self._columns = {}
+        self._views = {}
+        if cache_dir and source:
+            self._disk = self._open_disk(cache_dir)
+
+    @classmethod
+    def from_csv(cls, path, cache_dir=None, **derive_kwargs):
+        """Cohort of an input file, loaded on first access; with cache_dir (default CACHE_DIR) columns persist on disk"""
+        return cls(source=data.resolve_input(path), cache_dir=cache_dir or CACHE_DIR, **derive_kwargs)
+
+    @classmethod
+    def from_derived(cls, df, **derive_kwargs):
+        """Cohort of a derived frame (data.derive_days, a preview sample); its columns are used as they are"""
+        return cls(df, derived=True, **derive_kwargs)
+
+    def _view(self, rows=None, lag_days=None, columns=None):
+        view = object.__new__(Cohort)
+        view.__dict__.update(max_age=self.max_age, reference_year=self.reference_year, start_date=self.start_date,
+                             lag_days=self.lag_days if lag_days is None else lag_days,
+                             _frame=None, _derived_frame=False, _source=None, _disk=None, _parent=self, _rows=rows,
+                             _index=None, _end_measure=None, _columns=dict(columns or {}), _views={})
+        if rows is None and self._end_measure is not None and 'death_day' not in view._columns:
+            view._end_measure = self._end_measure
+        return view
+
+    def __getstate__(self):
+        # Views are rebuilt on demand; memory-mapped columns are pickled as plain arrays
+        state = dict(self.__dict__, _views={}, _disk=None)
+        state['_columns'] = {key: np.asarray(values) for key, values in self._columns.items()}
+        return state
+
+    # --- rows ---
+
+    def _load(self):
+        if self._frame is None:
+            self._frame = data.load_csv(self._source)
+        return self._frame
+
+    def _root_rows(self):
+        """Rows of the frame with an age in 0..max_age; keeps birth_year and age as derive_days does"""
+        if self._rows is None and not self._derived_frame:
+            frame = self._load()
+            birth_year = pd.to_numeric(frame['rok_narozeni'], errors='coerce')
+            age = self.reference_year - birth_year
+            valid = age.between(0, self.max_age).to_numpy()
+            self._rows = slice(None) if valid.all() else np.flatnonzero(valid)
+            for key, values in (('birth_year', birth_year), ('age', age)):
+                if key not in self._columns:
+                    self._columns[key] = values.to_numpy()[self._rows]
+                    self._save(key, self._columns[key])
+        return slice(None) if self._rows is None else self._rows
+
+    @property
+    def index(self):
+        if self._index is None:
+            if self._parent is not None:
+                self._index = self._parent.index if self._rows is None else self._parent.index[self._rows]
+            elif self._disk and os.path.exists(self._disk_path('index')):
+                self._index = pd.Index(np.load(self._disk_path('index')))
+            else:
+                self._index = self._load().index[self._root_rows()]
+                self._save('index', self._index.to_numpy())
+        return self._index
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+    @property
+    def columns(self):
+        base = list(self._frame.columns) if self._frame is not None and self._parent is None else BASE_COLS
+        if self._parent is not None:
+            base = self._parent.columns
+        names = base + [name for name in DERIVED_COLS + LAZY_COLS if name not in base]
+        return names + [name for name in self._columns if isinstance(name, str) and name not in names]
+
+    @property
+    def shape(self):
+        return len(self), len(self.columns)
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    # --- columns ---
+
+    def _column(self, key, derive=None):
+        """Array of a column (or a (name, parameter) key), from the memo, the parent, the disk or derive(root)"""
+        if key in self._columns:
+            return self._columns[key]
+        if self._parent is None:
+            if self._is_loaded(key):
+                return self._frame[key].to_numpy()[self._root_rows()]    # loaded columns are not copied
+            values = self._root_column(key, derive)
+        else:
+            values = self._parent._column(key, derive)
+            values = values if self._rows is None else values[self._rows]
+        self._columns[key] = values
+        return values
+
+    def _is_loaded(self, key):
+        if not isinstance(key, str):
+            return False
+        if self._frame is None and self._source is not None and key in BASE_COLS:
+            self._load()
+        return self._frame is not None and key in self._frame.columns
+
+    def _root_column(self, key, derive):
+        if self._disk and os.path.exists(self._disk_path(key)):
+            return np.load(self._disk_path(key), mmap_mode='r')
+        if key in ('birth_year', 'age') and not self._derived_frame:
+            self._root_rows()
+            return self._columns[key]
+        if derive is None and key not in DERIVATIONS:
+            raise KeyError(key)
+        values = (derive or DERIVATIONS[key])(self)
+        self._save(key, values)
+        return values
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key == 'end_day':
+                return self.end_day()
+            if key == 'exposure_day':
+                return self.exposure_day()
+            return pd.Series(self._column(key), index=self.index, name=key)
+        if isinstance(key, list):
+            return pd.DataFrame({name: self[name].to_numpy() for name in key}, index=self.index)
+        return self.select(key)
+
+    def end_day(self, end_measure=None):
+        """Series of the death day, or end_measure (default END_MEASURE of the cohort) for survivors"""
+        end = self.end_measure if end_measure is None else end_measure
+        values = self._column(('end_day', end), lambda root: root['death_day'].fillna(end).to_numpy())
+        return pd.Series(values, index=self.index, name='end_day')
+
+    def exposure_day(self, lag_days=None):
+        """Series of the first dose day + lag_days (default the lag of the view); NaN without a dose"""
+        lag = self.lag_days if lag_days is None else lag_days
+        values = self._column(('exposure_day', lag), lambda root: (root['first_dose_day'] + lag).to_numpy())
+        return pd.Series(values, index=self.index, name='exposure_day')
+
+    @property
+    def end_measure(self):
+        """Last day of the measurement window: the maximum observed death day of the cohort's rows"""
+        if self._end_measure is None:
+            self._end_measure = int(np.nanmax(self._column('death_day')))
+        return self._end_measure
+
+    def compute(self, names=DERIVED_COLS):
+        """Derive the named columns now (e.g. before forking workers that share them); returns self"""
+        for name in names:
+            self._column(name)
+        return self
+
+    def to_frame(self, columns=None):
+        """DataFrame of the columns (default: the loaded ones, the derive_days ones and assigned ones)"""
+        if columns is None:
+            columns = [name for name in self.columns if name not in LAZY_COLS]
+        return self[list(columns)]
+
+    # --- views ---
+
+    def view(self, ages=None, lag_days=None):
+        """
+        Rows with an age in ages (one age, a list or a range) and/or exposure lag_days; the same view
+        object is returned for the same arguments, and it takes its columns from this cohort.
+        """
+        key = (None if ages is None else tuple(int(age) for age in np.atleast_1d(np.asarray(ages))), lag_days)
+        if key not in self._views:
+            rows = None if ages is None else self._rows_where(np.isin(self._column('age'), key[0]))
+            self._views[key] = self._view(rows, lag_days)
+        return self._views[key]
+
+    def select(self, mask):
+        """View of the rows where mask (a boolean array or Series of this cohort) is true"""
+        return self._view(self._rows_where(np.asarray(mask, dtype=bool)))
+
+    def assign(self, **columns):
+        """View with the given columns added or replaced (scalars are broadcast); other columns are shared"""
+        n = len(self)
+        values = {name: (np.full(n, value) if np.isscalar(value) else np.asarray(value)) for name, value in columns.items()}
+        return self._view(columns=values)
+
+    @staticmethod
+    def _rows_where(mask):
+        rows = np.flatnonzero(mask)
+        if len(rows) == len(mask):
+            return None
+        if len(rows) == 0 or rows[-1] - rows[0] + 1 == len(rows):
+            return slice(int(rows[0]), int(rows[-1]) + 1) if len(rows) else slice(0, 0)
+        return rows
+
+    def take(self, rows, **columns):
+        """New cohort of the rows (positions or a boolean mask) with its columns copied, plus extra columns"""
+        rows = np.flatnonzero(rows) if np.asarray(rows).dtype == bool else np.asarray(rows)
+        frame = pd.DataFrame({name: self[name].to_numpy()[rows] for name in self.to_frame().columns},
+                             index=self.index[rows])
+        for name, values in columns.items():
+            frame[name] = values
+        return Cohort.from_derived(frame, max_age=self.max_age, reference_year=self.reference_year,
+                                   start_date=self.start_date)
+
+    # --- disk cache ---
+
+    def _open_disk(self, cache_dir):
+        sha = file_hash(self._source, os.path.join(cache_dir, HASH_MEMO))
+        folder = os.path.join(cache_dir, f"{os.path.basename(self._source)}-{sha[:16]}")
+        meta = dict(version=COHORT_VERSION, max_age=self.max_age, reference_year=self.reference_year,
+                    start_date=str(self.start_date))
+        meta_path = os.path.join(folder, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                if json.load(f) == meta:
+                    return folder
+            shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder, exist_ok=True)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=1)
+        return folder
+
+    def _disk_path(self, key):
+        return os.path.join(self._disk, f"{_key_name(key)}.npy")
+
+    def _save(self, key, values):
+        if not self._disk or np.asarray(values).dtype == object:
+            return
+        path = self._disk_path(key)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, values)
+        os.replace(path + ".tmp", path)
+
+def derive(frame, max_age=data.MAX_AGE, reference_year=data.REFERENCE_YEAR, start_date=data.START_DATE):
+    """Cohort of a loaded frame with the derive_days columns computed (the pipeline caches it as one stage)"""
+    return Cohort(frame, max_age=max_age, reference_year=reference_year, start_date=start_date).compute()
+
+def end_measure(cohort):
+    """END_MEASURE of a cohort (computed once), or of a derived frame"""
+    if isinstance(cohort, Cohort):
+        return cohort.end_measure
+    return data.end_measure(cohort)
+
+def preview_sample(cohort, fraction, seed=data.PREVIEW_SEED, min_per_stratum=data.PREVIEW_MIN_PER_STRATUM):
+    """Weighted stratified sample of a cohort as a new cohort (see czechfoi.data.preview_sample)"""
+    if not fraction or fraction >= 1:
+        return cohort
+    keep, weight = data.preview_rows(cohort, fraction, seed, min_per_stratum)
+    if WEIGHT_COL in cohort:
+        weight = weight * cohort[WEIGHT_COL].to_numpy()[keep]
+    return cohort.take(keep, **{WEIGHT_COL: weight})
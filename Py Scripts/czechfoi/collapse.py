@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+"""
+Frequency-weighted collapsing of the interval tables built by FS, FW, FX and FY.
+
+In a single-age cohort most people share their intervals exactly: everyone unvaccinated and
+alive until END_MEASURE has the row (0, END_MEASURE, event 0, vaccinated 0), everyone dosed on
+the same day and still alive has the same vaccinated row. collapse_intervals() merges identical
+rows into one row with a 'weight' column (the number of people), and the Cox and Kaplan-Meier
+fits pass that column to lifelines.
+
+Only censored rows are merged. lifelines handles tied deaths (Efron) by counting rows, not
+weights, so rows with an event stay one row per person; the estimates are then the same as on
+the full table. The L2 penalty lifelines adds depends on the number of rows and on the covariate
+spread per row; scaled_penalizer() corrects both.
+
+Usage:
+    tv_df = collapse_intervals(build_intervals(df, end))
+    ctv = CoxTimeVaryingFitter(penalizer=scaled_penalizer(tv_df, 0.1))
+    ctv.fit(tv_df, ..., weights_col=weight_col(tv_df))
+"""
+
+WEIGHT_COL = 'weight'
+
+def collapse_intervals(tv_df, id_col='id', event_col='event'):
+    """
+    Merge identical censored rows (all columns except the id) into one row per distinct interval.
+    Returns the rows with events followed by the merged rows, with new ids and a 'weight' column.
+    """
+    tv_df = tv_df.drop(columns=id_col)
+    if WEIGHT_COL not in tv_df:
+        tv_df[WEIGHT_COL] = 1
+    keys = [col for col in tv_df.columns if col != WEIGHT_COL]
+
+    events = tv_df[tv_df[event_col] != 0]
+    censored = (tv_df[tv_df[event_col] == 0]
+                .groupby(keys, sort=True, dropna=False, as_index=False)[WEIGHT_COL].sum())
+    collapsed = pd.concat([events, censored], ignore_index=True)
+    collapsed.insert(0, id_col, np.arange(len(collapsed)))
+    print(f"Collapsed {len(tv_df):,} intervals into {len(collapsed):,} weighted rows")
+    return collapsed
+
+def weight_col(tv_df):
+    """Name of the weight column, None for an uncollapsed table"""
+    return WEIGHT_COL if WEIGHT_COL in tv_df else None
+
+def weights(tv_df):
+    """Row weights for KaplanMeierFitter.fit(weights=...), None for an uncollapsed table"""
+    return tv_df[WEIGHT_COL] if WEIGHT_COL in tv_df else None
+
+def scaled_penalizer(tv_df, penalizer, id_col='id', start_col='start', stop_col='stop', event_col='event'):
+    """
+    Penalizer that gives a collapsed table the same L2 penalty as the table of one row per interval.
+
+    lifelines multiplies the penalty by the number of rows and applies it to the coefficients of the
+    covariates scaled by their (unweighted) standard deviation, so it is rescaled per covariate by
+    weight sum / rows and by the ratio of the weighted to the unweighted variance.
+    """
+    if WEIGHT_COL not in tv_df or len(tv_df) < 2:
+        return penalizer
+    w = tv_df[WEIGHT_COL].to_numpy(dtype=float)
+    X = tv_df.drop(columns=[id_col, start_col, stop_col, event_col, WEIGHT_COL]).to_numpy(dtype=float)
+    total = w.sum()
+    mean = (w[:, None] * X).sum(axis=0) / total
+    weighted_var = (w[:, None] * (X - mean) ** 2).sum(axis=0) / (total - 1)
+    row_var = X.var(axis=0, ddof=1)
+    return penalizer * total / len(tv_df) * weighted_var / row_var
@@ -0,0 +1,385 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from czechfoi.data import MAX_AGE, START_DATE, DOSE_DAY_COLS, resolve_input
+from czechfoi.chunked import DayGrid, MEMORY_BUDGET_MB, iter_derived_chunks
+
+"""
+Persistent count cube: persons at risk, deaths and doses by age x day x dose number x time since dose.
+
+ZI, the FZ/FP Poisson table and tied-time hazard estimates only need counts per age, calendar day
+and exposure state, not the individual rows. The cube holds these counts for one input file:
+
+- at_risk[age, day, dose, band]   persons under observation on the day (up to and including the
+                                  death day, as the FZ/FP person-day table counts them)
+- deaths[age, day, dose, band]    deaths on the day, in the state the person was in on that day
+- doses[age, day, dose, 0]        dose number 'dose' given on the day (by dose order, not column)
+
+dose is the number of doses received up to and including the day (0 = unvaccinated, doses in
+date order), band the time since the last dose binned by TIME_SINCE_DOSE_BANDS (always 0 for
+dose 0). The days run from START_DATE (day 0) to END_MEASURE, the last death day.
+
+The cube is built once per input (streamed in chunks, see czechfoi.chunked) and saved as .npy
+arrays plus meta.json in a folder named after the input's content hash; the arrays are opened
+memory-mapped, so a query only reads the slices it touches. meta.json records CUBE_VERSION and
+the bands: a cube written by another version or with other bands is rebuilt.
+
+Usage:
+    cube = CountCube.for_input(INPUT_CSV)                    # open, or build on first use
+    cube.table(by=['day', 'vaccinated'], age=(65, 75), day=('2021-01-01', '2021-12-31'))
+    at_risk, deaths = cube.counts(age=70, dose=(1, 7))       # arrays (age, day, dose, band)
+
+    python -m czechfoi.cube build INPUT_CSV                  # from the 'Py Scripts' folder
+    python -m czechfoi.cube query INPUT_CSV --by day vaccinated --age 70
+"""
+
+CUBE_VERSION = 1
+CUBE_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), ".cube")
+
+N_DOSES = len(DOSE_DAY_COLS)
+TIME_SINCE_DOSE_BANDS = [0, 14, 28, 91, 182]     # Band starts in days since the last dose; the last is open
+MEASURES = ('at_risk', 'deaths', 'doses')
+HASH_MEMO = "file-hashes.json"                  # Input hashes by size and mtime, in the cube root
+DIMS = ('age', 'day', 'dose', 'band')
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+_hash_memos = {}
+
+def file_hash(path, memo_path):
+    """
+    file_sha256 of path, remembered in the JSON file memo_path with the file's size and modification
+    time: the (multi-GB) input is only read again when one of them changes. None if path is missing.
+    """
+    path = os.path.abspath(path)
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime_ns]
+    if memo_path not in _hash_memos:
+        _hash_memos[memo_path] = {}
+        if os.path.exists(memo_path):
+            with open(memo_path, encoding="utf-8") as f:
+                _hash_memos[memo_path] = json.load(f)
+    memo = _hash_memos[memo_path]
+    known = memo.get(path)
+    if known and known['stamp'] == stamp:
+        return known['sha256']
+    memo[path] = {'stamp': stamp, 'sha256': file_sha256(path)}
+    os.makedirs(os.path.dirname(memo_path) or ".", exist_ok=True)
+    tmp = f"{memo_path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(memo, f, indent=1)
+    os.replace(tmp, memo_path)
+    return memo[path]['sha256']
+
+def meta_matches(cube_dir, bands=TIME_SINCE_DOSE_BANDS):
+    """Whether a saved cube was written by this CUBE_VERSION with these bands"""
+    with open(os.path.join(cube_dir, "meta.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    return meta.get('version') == CUBE_VERSION and meta.get('bands') == list(bands)
+
+class CubeCounts:
+    """
+    Accumulator for czechfoi.chunked.reduce_csv(): adds derived chunks to difference arrays
+    with one row per (age, dose, band) state, so chunks can arrive before END_MEASURE is known.
+    """
+    def __init__(self, bands=TIME_SINCE_DOSE_BANDS):
+        self.bands = list(bands)
+        self.shape = (MAX_AGE + 1, N_DOSES + 1, len(self.bands))
+        self.grid = DayGrid(MEASURES, n_ages=int(np.prod(self.shape)))
+        self.persons = np.zeros(MAX_AGE + 1, dtype=np.int64)
+
+    def state_row(self, ages, dose, band):
+        return (ages * (N_DOSES + 1) + dose) * len(self.bands) + band
+
+    def add(self, chunk, weights=None):
+        """Count the rows of a derived chunk; integer weights count a row several times (or remove it if < 0)"""
+        ages = chunk['age'].to_numpy(dtype=np.int64)
+        death = chunk['death_day'].to_numpy(dtype=float)
+        # Doses in date order; NaN (not given) sort last
+        dose_days = np.sort(chunk[DOSE_DAY_COLS].to_numpy(dtype=float), axis=1)
+        w = np.ones(len(ages), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+        self.persons += np.bincount(ages, weights=w, minlength=MAX_AGE + 1).astype(np.int64)
+
+        # Observed up to and including the death day; people alive stay open until END_MEASURE
+        obs_stop = np.where(np.isnan(death), np.inf, death + 1)
+        next_dose = np.where(np.isnan(dose_days), np.inf, dose_days)
+
+        # Unvaccinated until the first dose, then one range per dose and time-since-dose band
+        rows = [self.state_row(ages, 0, 0)]
+        starts = [np.zeros(len(ages))]
+        stops = [np.minimum(next_dose[:, 0], obs_stop)]
+        row_weights = [w]
+        band_starts = self.bands
+        band_stops = self.bands[1:] + [np.inf]
+        for dose in range(1, N_DOSES + 1):
+            given = ~np.isnan(dose_days[:, dose - 1])
+            dose_day = dose_days[given, dose - 1]
+            segment_stop = np.minimum(next_dose[given, dose] if dose < N_DOSES else np.inf, obs_stop[given])
+            for band, (lo, hi) in enumerate(zip(band_starts, band_stops)):
+                rows.append(self.state_row(ages[given], dose, band))
+                starts.append(dose_day + lo)
+                stops.append(np.minimum(dose_day + hi, segment_stop))
+                row_weights.append(w[given])
+            self.grid.add_points('doses', self.state_row(ages[given], dose, 0), dose_day, w[given])
+        self.grid.add_ranges('at_risk', np.concatenate(rows), np.concatenate(starts), np.concatenate(stops),
+                             np.concatenate(row_weights))
+
+        # State on the death day: doses up to that day and the time since the last of them
+        dead = ~np.isnan(death)
+        dose_at_death = (dose_days[dead] <= death[dead, None]).sum(axis=1)
+        last_dose = np.where(dose_at_death > 0,
+                             dose_days[dead][np.arange(dead.sum()), np.maximum(dose_at_death - 1, 0)], np.nan)
+        band_at_death = np.where(dose_at_death > 0,
+                                 np.searchsorted(self.bands, death[dead] - np.nan_to_num(last_dose), side='right') - 1, 0)
+        self.grid.add_points('deaths', self.state_row(ages[dead], dose_at_death, band_at_death), death[dead], w[dead])
+
+    def to_cube(self, end_measure):
+        """Close the open intervals at END_MEASURE and return the (age, day, dose, band) arrays"""
+        arrays = {}
+        for name in MEASURES:
+            counts = self.grid.counts(name, end_measure, cumulative=(name == 'at_risk'))
+            arrays[name] = np.ascontiguousarray(
+                counts.reshape(*self.shape, end_measure + 1).transpose(0, 3, 1, 2).astype(np.int32))
+        return arrays
+
+class CountCube:
+    """The counts of one input, in memory (after build) or memory-mapped from a cube folder"""
+    def __init__(self, arrays, persons, meta):
+        self.at_risk = arrays['at_risk']
+        self.deaths = arrays['deaths']
+        self.doses = arrays['doses']
+        self.persons = persons
+        self.meta = meta
+        self.bands = meta['bands']
+        self.end_measure = meta['end_measure']
+        self.start_date = pd.Timestamp(meta['start_date'])
+
+    # --- building and storage ---
+
+    @classmethod
+    def build(cls, chunks, bands=TIME_SINCE_DOSE_BANDS, **meta):
+        """Cube from derived chunks (see czechfoi.data.derive_days), e.g. [derived_df]"""
+        counts = CubeCounts(bands)
+        end_measure = None
+        for chunk in chunks:
+            counts.add(chunk)
+            chunk_end = chunk['death_day'].max()
+            if pd.notna(chunk_end):
+                end_measure = int(chunk_end) if end_measure is None else max(end_measure, int(chunk_end))
+        if end_measure is None:
+            raise ValueError("No deaths in the input: END_MEASURE is undefined")
+        return cls.build_from_counts(counts, end_measure, **meta)
+
+    @classmethod
+    def build_from_counts(cls, counts, end_measure, **meta):
+        """Cube of a filled CubeCounts accumulator, closed at end_measure"""
+        meta = dict(meta, version=CUBE_VERSION, bands=list(counts.bands), end_measure=end_measure,
+                    start_date=str(START_DATE.date()), created=datetime.datetime.now().isoformat(timespec='seconds'))
+        return cls(counts.to_cube(end_measure), counts.persons, meta)
+
+    @classmethod
+    def build_csv(cls, path, bands=TIME_SINCE_DOSE_BANDS, memory_budget_mb=MEMORY_BUDGET_MB, cube_root=CUBE_ROOT):
+        path = resolve_input(path)
+        print(f"Building count cube of {os.path.basename(path)}...")
+        # Through the cube root's hash memo: for_input has just hashed the same file
+        sha = file_hash(path, os.path.join(cube_root, HASH_MEMO))
+        return cls.build(iter_derived_chunks(path, memory_budget_mb), bands=bands,
+                         input=os.path.abspath(path), input_sha256=sha)
+
+    def save(self, cube_dir):
+        """Write the arrays and meta.json; the folder is replaced as a whole"""
+        tmp_dir = cube_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in MEASURES:
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), getattr(self, name))
+        np.save(os.path.join(tmp_dir, "persons.npy"), self.persons)
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(dict(self.meta, shape=list(self.at_risk.shape), dims=list(DIMS)), f, indent=1)
+        shutil.rmtree(cube_dir, ignore_errors=True)
+        os.replace(tmp_dir, cube_dir)
+        return cube_dir
+
+    @classmethod
+    def open(cls, cube_dir, mmap_mode='r'):
+        with open(os.path.join(cube_dir, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get('version') != CUBE_VERSION:
+            raise ValueError(f"Count cube {cube_dir} has version {meta.get('version')}, expected {CUBE_VERSION}")
+        arrays = {name: np.load(os.path.join(cube_dir, f"{name}.npy"), mmap_mode=mmap_mode) for name in MEASURES}
+        return cls(arrays, np.load(os.path.join(cube_dir, "persons.npy")), meta)
+
+    @classmethod
+    def for_input(cls, path, cube_root=CUBE_ROOT, bands=TIME_SINCE_DOSE_BANDS, memory_budget_mb=MEMORY_BUDGET_MB):
+        """Open the cube of an input file, building it first if there is none for its current content"""
+        path = resolve_input(path)
+        sha = file_hash(path, os.path.join(cube_root, HASH_MEMO))
+        cube_dir = os.path.join(cube_root, f"{os.path.basename(path)}-{sha[:16]}")
+        if os.path.exists(os.path.join(cube_dir, "meta.json")) and meta_matches(cube_dir, bands):
+            return cls.open(cube_dir)
+        cube = cls.build_csv(path, bands=bands, memory_budget_mb=memory_budget_mb, cube_root=cube_root)
+        cube.save(cube_dir)
+        print(f"Count cube saved to {cube_dir}")
+        return cls.open(cube_dir)
+
+    # --- queries ---
+
+    def day_number(self, value):
+        """Day number of an int day or a date ('2021-03-01', Timestamp)"""
+        if isinstance(value, (int, np.integer)):
+            return int(value)
+        return (pd.Timestamp(value) - self.start_date).days
+
+    def _index(self, dim, value):
+        """slice along one axis for None (all), a single value or an inclusive (first, last) range"""
+        size = self.at_risk.shape[DIMS.index(dim)]
+        if value is None:
+            return slice(0, size)
+        convert = self.day_number if dim == 'day' else int
+        first, last = value if isinstance(value, (tuple, list)) else (value, value)
+        first, last = convert(first), convert(last)
+        return slice(max(first, 0), min(last, size - 1) + 1)
+
+    def _filters(self, age, day, dose, band, vaccinated):
+        if vaccinated is not None:
+            dose = (1, N_DOSES) if vaccinated else 0
+        return tuple(self._index(dim, value) for dim, value in zip(DIMS, (age, day, dose, band)))
+
+    def counts(self, age=None, day=None, dose=None, band=None, vaccinated=None):
+        """
+        at_risk and deaths arrays (age, day, dose, band) of the selection. Every filter is a value
+        or an inclusive (first, last) range; days may be given as dates.
+        """
+        index = self._filters(age, day, dose, band, vaccinated)
+        return np.asarray(self.at_risk[index]), np.asarray(self.deaths[index])
+
+    def table(self, by=('day',), age=None, day=None, dose=None, band=None, vaccinated=None, drop_empty=True):
+        """
+        Long DataFrame of at_risk and deaths summed over all dimensions not in 'by'
+        ('age', 'day', 'dose', 'band' or 'vaccinated'), with the same filters as counts().
+        """
+        by = list(by)
+        index = self._filters(age, day, dose, band, vaccinated)
+        origins = {dim: index[i].start for i, dim in enumerate(DIMS)}
+        values = {}
+        for name in ('at_risk', 'deaths'):
+            array = np.asarray(getattr(self, name)[index], dtype=np.int64)
+            if 'vaccinated' in by:
+                # Dose axis -> (unvaccinated, vaccinated)
+                start = origins['dose']
+                array = np.stack([array[:, :, :max(1 - start, 0)].sum(axis=2),
+                                  array[:, :, max(1 - start, 0):].sum(axis=2)], axis=2)
+            keep = [DIMS.index(dim) for dim in by if dim != 'vaccinated']
+            if 'vaccinated' in by:
+                keep.append(DIMS.index('dose'))
+            values[name] = array.sum(axis=tuple(i for i in range(4) if i not in keep))
+
+        # Remaining axes are in DIMS order; name them and add the origin of each slice
+        names = [dim for dim in DIMS if dim in by or (dim == 'dose' and 'vaccinated' in by)]
+        names = ['vaccinated' if dim == 'dose' and 'vaccinated' in by else dim for dim in names]
+        grid = np.indices(values['at_risk'].shape).reshape(len(names), -1)
+        result = pd.DataFrame({dim: grid[i] + (0 if dim == 'vaccinated' else origins[dim])
+                               for i, dim in enumerate(names)})
+        for name, array in values.items():
+            result[name] = array.ravel()
+        if 'day' in result:
+            result.insert(result.columns.get_loc('day') + 1, 'date', self.start_date + pd.to_timedelta(result['day'], unit='D'))
+        if drop_empty:
+            result = result[(result['at_risk'] > 0) | (result['deaths'] > 0)].reset_index(drop=True)
+        return result[[dim for dim in by if dim in result] + [c for c in result if c not in by]]
+
+    # --- tables of the analysis scripts ---
+
+    def _by_vaccination(self, name):
+        """(ages, days) arrays of the unvaccinated and the vaccinated state"""
+        array = getattr(self, name)
+        return np.asarray(array[:, :, 0, :].sum(axis=2)), np.asarray(array[:, :, 1:, :].sum(axis=(2, 3)))
+
+    def daily_counts(self):
+        """Per age and day as ZI compute_daily_counts (see czechfoi.chunked.AgeDayCounts.daily_counts)"""
+        at_risk_uvx, at_risk_vx = self._by_vaccination('at_risk')
+        death_uvx, death_vx = self._by_vaccination('deaths')
+        ages = np.flatnonzero(self.persons)
+        n_days = self.end_measure + 1
+        result = pd.DataFrame({
+            'day': np.tile(np.arange(n_days), len(ages)),
+            'age': np.repeat(ages, n_days),
+            # Alive counts exclude the death day, at-risk counts include it
+            'pop_vx': (at_risk_vx - death_vx)[ages].ravel(),
+            'pop_uvx': (at_risk_uvx - death_uvx)[ages].ravel(),
+            'death_vx': death_vx[ages].ravel(),
+            'death_uvx': death_uvx[ages].ravel(),
+        })
+        result['death_total'] = result['death_vx'] + result['death_uvx']
+        result['pop_total'] = result['pop_vx'] + result['pop_uvx']
+        return result
+
+    def dose_counts(self):
+        """Daily first and all dose counts, DataFrames with days as index and ages as columns (as ZI)"""
+        days = np.arange(self.end_measure + 1)
+        doses = np.asarray(self.doses[:, :, :, 0], dtype=float)
+        first = pd.DataFrame(doses[:, :, 1].T, index=days)
+        all_doses = pd.DataFrame(doses[:, :, 1:].sum(axis=2).T, index=days)
+        return first, all_doses
+
+    def poisson_table(self):
+        """The aggregate() table of FZ/FP (see czechfoi.chunked.AgeDayCounts.poisson_table)"""
+        at_risk = self._by_vaccination('at_risk')
+        death_uvx, death_vx = self._by_vaccination('deaths')
+        any_death = (death_uvx + death_vx) > 0
+        frames = []
+        for vaccinated in (0, 1):
+            person_days = at_risk[vaccinated]
+            age, day = np.nonzero(person_days)
+            frames.append(pd.DataFrame({
+                'age': age,
+                'day': day,
+                'vaccinated': vaccinated,
+                'deaths': np.where(any_death[age, day], person_days[age, day], 0),
+                'person_days': person_days[age, day],
+            }))
+        agg = pd.concat(frames, ignore_index=True).sort_values(['age', 'day', 'vaccinated'], ignore_index=True)
+        agg['offset'] = np.log(agg['person_days'])
+        agg['age_c'] = agg['age'] - agg['age'].mean()
+        return agg
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the persistent age x day x dose count cube.")
+    parser.add_argument('command', choices=['build', 'query'])
+    parser.add_argument('input_csv')
+    parser.add_argument('--cube-root', default=CUBE_ROOT)
+    parser.add_argument('--memory-budget-mb', type=int, default=MEMORY_BUDGET_MB)
+    parser.add_argument('--by', nargs='+', default=['day'], choices=list(DIMS) + ['vaccinated'])
+    parser.add_argument('--age', nargs='+', type=int, help="age or first and last age")
+    parser.add_argument('--days', nargs='+', help="day number/date or first and last day")
+    parser.add_argument('--output', help="CSV file for the query result (default: print)")
+    args = parser.parse_args(argv)
+
+    cube = CountCube.for_input(args.input_csv, cube_root=args.cube_root, memory_budget_mb=args.memory_budget_mb)
+    if args.command == 'build':
+        print(f"END_MEASURE {cube.end_measure}, shape {cube.at_risk.shape} {DIMS}")
+        return
+    days = args.days and [int(d) if d.lstrip('-').isdigit() else d for d in args.days]
+    result = cube.table(by=args.by, age=args.age and tuple(args.age), day=days and tuple(days))
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print(f"Saved {len(result):,} rows to {args.output}")
+    else:
+        print(result.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
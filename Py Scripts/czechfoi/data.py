@@ -0,0 +1,215 @@
+import csv
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from czechfoi import scheduler
+from czechfoi.collapse import WEIGHT_COL
+
+"""
+Loading and preprocessing shared by the analysis scripts.
+
+All scripts read the same columns of the Czech FOI export (or the FG simulated file)
+and derive the same day numbers relative to START_DATE:
+
+- birth_year, age             (age = REFERENCE_YEAR - birth year, filtered to 0..MAX_AGE)
+- death_day, datum_i_day      (days since START_DATE, NaN if missing)
+- first_dose_day, has_any_dose
+
+Inputs may be compressed (.gz, .zst, .xz); they are decompressed while parsing, never to disk.
+If the plain CSV is missing, a compressed copy next to it (e.g. 'file.csv.gz') is used.
+
+Large uncompressed files can be read in parallel (load_csv(..., workers=N) or LOAD_WORKERS): the file is split
+into byte ranges at line boundaries and each range is parsed in a worker process. The number of
+workers is capped at the CPU budget of czechfoi.scheduler (0 = the whole budget).
+
+Preview mode (preview_sample(df, fraction), the pipeline's --preview) keeps a
+deterministic stratified subsample of the derived rows with a 'weight' column, see preview_sample.
+
+The analyses read these columns through czechfoi.cohort.Cohort, which derives each of them once
+per process; derive_days remains for callers that want a plain DataFrame.
+"""
+
+START_DATE = pd.Timestamp('2020-01-01')  # Reference day zero
+REFERENCE_YEAR = 2023                    # Used to calculate age from birth year
+MAX_AGE = 113                            # Maximum allowed age
+DOSE_COLS = [f'Datum_{i}' for i in range(1, 8)]
+NEEDED_COLS = ['Rok_narozeni', 'DatumUmrti'] + DOSE_COLS
+
+# Lower-case column names after loading
+DOSE_COLS_LOWER = [col.lower() for col in DOSE_COLS]
+DOSE_DAY_COLS = [col + '_day' for col in DOSE_COLS_LOWER]
+DATE_COLS_LOWER = ['datumumrti'] + DOSE_COLS_LOWER
+
+COMPRESSED_SUFFIXES = ('.gz', '.zst', '.xz')   # zstd needs the 'zstandard' package
+LOAD_WORKERS = 1                         # Processes for parsing the CSV (0 = the whole CPU budget, for the national file)
+MIN_RANGE_BYTES = 16 << 20               # Smaller files / ranges are not worth a process
+
+PREVIEW_SEED = 2020                      # Same seed and input -> same preview rows
+PREVIEW_MIN_PER_STRATUM = 20             # Small strata (e.g. deaths of one age) keep at least this many rows
+PREVIEW_STRATA = ['age', 'has_any_dose', 'dead']
+
+
+def is_compressed(path):
+    return path.lower().endswith(COMPRESSED_SUFFIXES)
+
+def resolve_input(path):
+    """path, or its compressed copy (path + .gz/.zst/.xz) if only that exists."""
+    if os.path.exists(path) or is_compressed(path):
+        return path
+    for suffix in COMPRESSED_SUFFIXES:
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return path
+
+def load_csv(path, chunksize=None, workers=None):
+    """
+    Load birth year, death date and dose dates, parse the dates and normalize column names.
+    With chunksize, returns an iterator over DataFrames of at most chunksize rows (see czechfoi.chunked).
+    With workers > 1 (default LOAD_WORKERS), byte ranges of the file are parsed in parallel;
+    compressed files are always streamed through one decompressor.
+    """
+    path = resolve_input(path)
+    workers = scheduler.worker_count(LOAD_WORKERS if workers is None else workers)
+    if chunksize is None and workers > 1 and not is_compressed(path):
+        return _load_parallel(path, workers)
+    reader = pd.read_csv(
+        path,
+        usecols=NEEDED_COLS,
+        parse_dates=['DatumUmrti'] + DOSE_COLS,
+        dayfirst=False,
+        low_memory=False,
+        chunksize=chunksize
+    )
+    if chunksize is not None:
+        return (_normalize_columns(chunk) for chunk in reader)
+    return _normalize_columns(reader)
+
+def line_ranges(path, parts):
+    """Split the data lines of a CSV file into up to 'parts' byte ranges [start, stop) at line starts."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header_end = len(f.readline())
+        bounds = [header_end]
+        for i in range(1, parts):
+            f.seek(header_end + (size - header_end) * i // parts)
+            f.readline()  # skip to the start of the next line
+            bounds.append(max(f.tell(), bounds[-1]))
+    bounds.append(size)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+def _read_range(path, start, stop, names):
+    """Parse the lines in [start, stop) of the file (no quoted line breaks in the FOI export)."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(stop - start)
+    df = pd.read_csv(
+        io.BytesIO(data),
+        header=None,
+        names=names,
+        usecols=NEEDED_COLS,
+        parse_dates=['DatumUmrti'] + DOSE_COLS,
+        dayfirst=False,
+        low_memory=False
+    )
+    # A range where a date column is empty is parsed as float: make it datetime like the full file
+    for col in ['DatumUmrti'] + DOSE_COLS:
+        df[col] = pd.to_datetime(df[col])
+    return _normalize_columns(df[NEEDED_COLS])
+
+def _load_parallel(path, workers):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        names = next(csv.reader(f))
+    parts = max(1, min(workers * 4, os.path.getsize(path) // MIN_RANGE_BYTES))
+    ranges = line_ranges(path, parts)
+    with scheduler.process_pool(workers) as pool:
+        futures = [pool.submit(_read_range, path, start, stop, names) for start, stop in ranges]
+        frames = [future.result() for future in futures]
+    # Row labels as if the whole file had been read at once
+    return pd.concat(frames, ignore_index=True)
+
+def _normalize_columns(df):
+    df.columns = [col.strip().lower() for col in df.columns]
+    return df
+
+def to_day_number(date_series, start_date=START_DATE):
+    return (date_series - start_date).dt.days
+
+def derive_days(df, max_age=MAX_AGE, reference_year=REFERENCE_YEAR, start_date=START_DATE):
+    """
+    Compute age, filter to valid ages and convert death and dose dates to day numbers.
+    Returns a new DataFrame; the loaded frame is not modified.
+    """
+    birth_year = pd.to_numeric(df['rok_narozeni'], errors='coerce')
+    age = reference_year - birth_year
+    valid = age.between(0, max_age)
+
+    df = df[valid].copy()
+    df['birth_year'] = birth_year[valid]
+    df['age'] = age[valid]
+
+    df['death_day'] = to_day_number(df['datumumrti'], start_date)
+    for col in DOSE_COLS_LOWER:
+        df[col + '_day'] = to_day_number(df[col], start_date)
+
+    df['first_dose_day'] = df[DOSE_DAY_COLS].min(axis=1, skipna=True)
+    df['has_any_dose'] = df[DOSE_DAY_COLS].notna().any(axis=1)
+    return df
+
+def end_measure(df):
+    """
+    Last day of the measurement window: the maximum observed death day.
+    """
+    return int(df['death_day'].dropna().max())
+
+def preview_sample(df, fraction, seed=PREVIEW_SEED, min_per_stratum=PREVIEW_MIN_PER_STRATUM):
+    """
+    Deterministic stratified subsample of a derived frame for quick preview runs.
+
+    Rows are stratified by age, vaccination status (has_any_dose) and death status. Every row
+    draws a uniform key from a generator seeded with 'seed'; each stratum keeps its rows with the
+    smallest keys, ceil(fraction * stratum size) of them but at least min_per_stratum (or the whole
+    stratum). The kept rows get a 'weight' column = stratum size / kept rows, so weighted counts,
+    Kaplan-Meier curves and Cox fits estimate the full-data ones. An existing weight is multiplied.
+    The same input, fraction and seed always give the same rows (in their original order).
+    """
+    if not fraction or fraction >= 1:
+        return df
+    keep, weight = preview_rows(df, fraction, seed, min_per_stratum)
+    sample = df[keep].copy()
+    sample[WEIGHT_COL] = weight * sample[WEIGHT_COL].to_numpy() if WEIGHT_COL in sample else weight
+    return sample
+
+def preview_rows(df, fraction, seed=PREVIEW_SEED, min_per_stratum=PREVIEW_MIN_PER_STRATUM):
+    """Boolean mask of the preview rows of a derived frame or cohort and their stratum weights (see preview_sample)"""
+    keys = df.assign(dead=df['death_day'].notna())[PREVIEW_STRATA]
+    stratum = keys.groupby(PREVIEW_STRATA, sort=True, dropna=False).ngroup().to_numpy()
+    sizes = np.bincount(stratum)
+    n_keep = np.minimum(sizes, np.maximum(np.ceil(fraction * sizes).astype(np.int64), min_per_stratum))
+
+    # Rank of every row's key within its stratum
+    order = np.lexsort((np.random.default_rng(seed).random(len(df)), stratum))
+    first_row = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    rank = np.empty(len(df), dtype=np.int64)
+    rank[order] = np.arange(len(df)) - first_row[stratum[order]]
+    keep = rank < n_keep[stratum]
+    print(f"Preview: {int(keep.sum()):,} of {len(df):,} rows ({fraction:.1%} per stratum, "
+          f"at least {min_per_stratum}, {len(sizes):,} strata)")
+    return keep, (sizes / n_keep)[stratum[keep]]
+
+def carry_weights(table, df, person):
+    """
+    Copy the row weights of a (preview) cohort to a table built from it, where person holds the
+    cohort row position of every table row. Tables of unweighted cohorts are returned unchanged.
+    """
+    if WEIGHT_COL in df:
+        table[WEIGHT_COL] = df[WEIGHT_COL].to_numpy()[person]
+    return table
+
+def weight_array(df):
+    """Row weights of a cohort: the preview weights, or integer ones (plain counts) without a weight column"""
+    if WEIGHT_COL in df:
+        return df[WEIGHT_COL].to_numpy(dtype=float)
+    return np.ones(len(df), dtype=np.int64)
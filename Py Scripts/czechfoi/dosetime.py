@@ -0,0 +1,207 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from czechfoi.chunked import AgeDayCounts, MEMORY_BUDGET_MB, reduce_csv
+from czechfoi import figures
+
+"""
+Hazard ratio (vaccinated vs unvaccinated) as a function of time since the first dose.
+
+FW's Kaplan-Meier curves run on the time spent in a state and FS's on calendar time; neither
+shows how the ratio changes after vaccination. Here the vaccinated deaths are put on the time
+since first dose axis s and compared with the unvaccinated hazard of the same age on the same
+calendar day:
+
+- O(s) = deaths of vaccinated persons s days after their first dose (Nelson-Aalen increments
+  of the vaccinated group on the s axis, times its number at risk),
+- E(s) = sum over the vaccinated persons at risk s days after their first dose of the
+  unvaccinated Nelson-Aalen increment dA0(age, day) = D0 / T0 on their calendar day.
+
+The ratio of the kernel-smoothed O and E (Epanechnikov kernel, Ramlau-Hansen smoothing) is the
+hazard ratio at s, adjusted for age and calendar time. Pointwise 95% CIs use the Poisson variance
+of the smoothed O; dA0 is taken as known, so the CIs are too narrow where few unvaccinated remain.
+Days without unvaccinated persons at risk in an age are left out of both O and E.
+
+Everything runs on count arrays: per age, persons with the same first dose day form a cohort
+whose number at risk over s is a reverse cumulative sum of its exits, and E(s) is that
+(first dose days x s) array weighted by dA0 on the matching calendar days. All ages are
+smoothed in one batch. Inputs are streamed in chunks (see czechfoi.chunked).
+
+Usage (from the 'Py Scripts' folder):
+    counts = DoseTimeCounts(lag_days=0)
+    end = reduce_csv(INPUT_CSV, [counts])
+    curves = counts.hazard_ratio(end, bandwidth=14)   # one row per age and day since first dose
+
+    python -m czechfoi.dosetime REAL_CSV --sim SIM_CSV --age 70 --output-html hr_by_time_since_dose.html
+"""
+
+BANDWIDTH_DAYS = 14         # Half-width of the Epanechnikov kernel
+Z_95 = 1.959964
+
+def epanechnikov(bandwidth):
+    """Kernel weights on the days -bandwidth..bandwidth"""
+    u = np.arange(-bandwidth, bandwidth + 1) / (bandwidth + 1)
+    return 0.75 * (1 - u ** 2)
+
+def smooth(array, kernel):
+    """Convolve every row with the (symmetric) kernel; zero outside the observed days"""
+    from scipy.ndimage import convolve1d
+    return convolve1d(array, kernel, axis=-1, mode='constant')
+
+class DoseTimeCounts:
+    """
+    Per-age/day counts for the unvaccinated hazard plus the vaccinated persons grouped by
+    (age, first dose day, death day). A person counts as vaccinated from first dose day + lag_days on.
+    """
+    def __init__(self, lag_days=0):
+        self.lag_days = lag_days
+        self.day_counts = AgeDayCounts()
+        self.parts = []
+
+    def add(self, chunk):
+        first = chunk['first_dose_day'] + self.lag_days
+        self.day_counts.add(chunk.assign(first_dose_day=first))
+        vaccinated = first.notna()
+        records = pd.DataFrame({'age': chunk.loc[vaccinated, 'age'].astype(np.int64),
+                                'first': first[vaccinated].astype(np.int64),
+                                'death': chunk.loc[vaccinated, 'death_day']})
+        self.parts.append(records.groupby(['age', 'first', 'death'], dropna=False).size().rename('n').reset_index())
+
+    def _cohorts(self, end_measure):
+        """Vaccinated cohorts: age, first dose day, last day at risk (stop), died, n"""
+        records = (pd.concat(self.parts, ignore_index=True)
+                   .groupby(['age', 'first', 'death'], dropna=False)['n'].sum().reset_index())
+        death = records['death'].to_numpy(dtype=float)
+        records['stop'] = np.where(np.isnan(death), end_measure, death).astype(np.int64)
+        records['died'] = ~np.isnan(death)
+        # Persons who die before their (lagged) first dose stay unvaccinated
+        return records[(records['first'] <= records['stop']) & (records['first'] <= end_measure)]
+
+    def observed_expected(self, end_measure, ages=None):
+        """
+        (ages, observed, expected, person_days): arrays (n_ages, n_s) over the days since first
+        dose s = 0..n_s-1, for the ages with vaccinated persons (ages: inclusive (first, last) range).
+        """
+        counts = self.day_counts.daily_counts(end_measure)
+        n_days = end_measure + 1
+        # Unvaccinated Nelson-Aalen increments per age and day, NaN where nobody unvaccinated is at risk
+        deaths_uvx = counts['death_uvx'].to_numpy(dtype=float).reshape(-1, n_days)
+        at_risk_uvx = counts['pop_uvx'].to_numpy(dtype=float).reshape(-1, n_days) + deaths_uvx
+        with np.errstate(divide='ignore', invalid='ignore'):
+            increments = np.where(at_risk_uvx > 0, deaths_uvx / at_risk_uvx, np.nan)
+        row_of_age = pd.Series(np.arange(len(increments)), index=counts['age'].unique())
+
+        cohorts = self._cohorts(end_measure)
+        if ages is not None:
+            cohorts = cohorts[cohorts['age'].between(*ages)]
+        age_list = np.sort(cohorts['age'].unique())
+        n_s = n_days - int(cohorts['first'].min()) if len(cohorts) else 1
+        observed, expected, person_days = (np.zeros((len(age_list), n_s)) for _ in range(3))
+
+        for i, (age, group) in enumerate(cohorts.groupby('age', sort=True)):
+            dA0 = increments[row_of_age[age]]
+            valid = ~np.isnan(dA0)
+            first_days, cohort = np.unique(group['first'].to_numpy(), return_inverse=True)
+            exit_s = (group['stop'] - group['first']).to_numpy()
+            n = group['n'].to_numpy(dtype=float)
+
+            # At risk per (first dose day, s): persons whose last day at risk is s or later
+            exits = np.bincount(cohort * n_s + exit_s, weights=n, minlength=len(first_days) * n_s)
+            at_risk = exits.reshape(len(first_days), n_s)[:, ::-1].cumsum(axis=1)[:, ::-1]
+
+            # Calendar day of every (cohort, s) cell and its unvaccinated increment
+            calendar_day = np.minimum(first_days[:, None] + np.arange(n_s), end_measure)
+            in_window = first_days[:, None] + np.arange(n_s) <= end_measure
+            reference = np.where(in_window & valid[calendar_day], np.nan_to_num(dA0)[calendar_day], 0.0)
+            usable = in_window & valid[calendar_day]
+
+            expected[i] = (at_risk * reference).sum(axis=0)
+            person_days[i] = (at_risk * usable).sum(axis=0)
+            died = group['died'].to_numpy() & valid[group['stop'].to_numpy()]
+            observed[i] = np.bincount(exit_s[died], weights=n[died], minlength=n_s)
+        return age_list, observed, expected, person_days
+
+    def hazard_ratio(self, end_measure, bandwidth=BANDWIDTH_DAYS, ages=None):
+        """
+        Smoothed HR by days since first dose: one row per age and s with the raw observed and
+        expected deaths, the vaccinated person-days, the HR and its 95% CI (NaN where E is 0).
+        """
+        age_list, observed, expected, person_days = self.observed_expected(end_measure, ages)
+        kernel = epanechnikov(bandwidth)
+        o, e = smooth(observed, kernel), smooth(expected, kernel)
+        o_var = smooth(observed, kernel ** 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hr = np.where(e > 0, o / e, np.nan)
+            se = np.where(o > 0, np.sqrt(o_var) / o, np.nan)
+        n_s = observed.shape[1]
+        return pd.DataFrame({
+            'age': np.repeat(age_list, n_s),
+            'days_since_dose': np.tile(np.arange(n_s), len(age_list)),
+            'person_days': person_days.ravel(),
+            'observed': observed.ravel(),
+            'expected': expected.ravel(),
+            'hr': hr.ravel(),
+            'hr_lower': (hr * np.exp(-Z_95 * se)).ravel(),
+            'hr_upper': (hr * np.exp(Z_95 * se)).ravel(),
+        })
+
+def hazard_ratio_csv(path, lag_days=0, bandwidth=BANDWIDTH_DAYS, ages=None, memory_budget_mb=MEMORY_BUDGET_MB):
+    """Streamed DoseTimeCounts of an input file and its smoothed HR curves"""
+    counts = DoseTimeCounts(lag_days)
+    end_measure = reduce_csv(path, [counts], memory_budget_mb)
+    return counts.hazard_ratio(end_measure, bandwidth, ages)
+
+def plot(curves, output_html, title="Hazard Ratio (Vaccinated / Unvaccinated) by Days since First Dose"):
+    """Curves per dataset and age ({label: hazard_ratio() frame}) with 95% CI bands"""
+    import plotly.graph_objects as go
+    colors = {'real': ('blue', 'rgba(0,0,255,0.15)'), 'sim': ('gray', 'rgba(128,128,128,0.2)')}
+    fig = go.Figure()
+    for label, frame in curves.items():
+        line_color, fill = colors.get(label, ('black', 'rgba(0,0,0,0.1)'))
+        for age, curve in frame.dropna(subset=['hr']).groupby('age'):
+            name = f"{label} AG{age}"
+            fig.add_trace(go.Scatter(x=curve['days_since_dose'], y=curve['hr_upper'], mode='lines',
+                                     line=dict(width=0), showlegend=False, legendgroup=name, hoverinfo='skip'))
+            fig.add_trace(go.Scatter(x=curve['days_since_dose'], y=curve['hr_lower'], mode='lines',
+                                     line=dict(width=0), fill='tonexty', fillcolor=fill, showlegend=False,
+                                     legendgroup=name, hoverinfo='skip'))
+            fig.add_trace(go.Scatter(x=curve['days_since_dose'], y=curve['hr'], mode='lines', name=name,
+                                     legendgroup=name, line=dict(width=1.2, color=line_color)))
+    fig.add_hline(y=1, line=dict(color='black', width=1, dash='dash'))
+    fig.update_layout(title=title, xaxis_title="Days since first dose", yaxis=dict(title="Hazard Ratio", type='log'),
+                      template='plotly_white', hovermode='x unified')
+    figures.write_html(fig, output_html)
+    print(f"Plot saved to {output_html}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Smoothed HR vaccinated vs unvaccinated by days since first dose.")
+    parser.add_argument('input_csv', help="real data")
+    parser.add_argument('--sim', help="simulated data (FG) to plot next to the real data")
+    parser.add_argument('--age', nargs='+', type=int, help="age or first and last age (default: all)")
+    parser.add_argument('--lag-days', type=int, default=0)
+    parser.add_argument('--bandwidth', type=int, default=BANDWIDTH_DAYS, help="kernel half-width in days")
+    parser.add_argument('--memory-budget-mb', type=int, default=MEMORY_BUDGET_MB)
+    parser.add_argument('--output-csv', help="CSV file for the curves of all datasets and ages")
+    parser.add_argument('--output-html', help="Plotly HTML file of the curves")
+    args = parser.parse_args(argv)
+
+    ages = (args.age[0], args.age[-1]) if args.age else None
+    inputs = {'real': args.input_csv}
+    if args.sim:
+        inputs['sim'] = args.sim
+    curves = {label: hazard_ratio_csv(path, args.lag_days, args.bandwidth, ages, args.memory_budget_mb)
+              for label, path in inputs.items()}
+    if args.output_csv:
+        pd.concat([frame.assign(dataset=label) for label, frame in curves.items()]).to_csv(args.output_csv, index=False)
+        print(f"Curves saved to {args.output_csv}")
+    if args.output_html:
+        plot(curves, args.output_html)
+    if not args.output_csv and not args.output_html:
+        for label, frame in curves.items():
+            print(label)
+            print(frame.dropna(subset=['hr']).groupby('age')['hr'].describe().to_string())
+
+if __name__ == "__main__":
+    main()
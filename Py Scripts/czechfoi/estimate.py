@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from czechfoi.data import MAX_AGE, DOSE_DAY_COLS
+from czechfoi.chunked import MEMORY_BUDGET_MB, ROW_BYTES, reduce_csv
+from czechfoi.cube import HASH_MEMO, file_hash
+
+"""
+Dry-run estimates of rows and peak memory per analysis stage, from a cheap cohort summary.
+
+The expensive stages grow with different quantities, all of which follow from a few counts per age:
+
+- interval tables (FS, FW, FJ):  one row per person, one more per vaccinated person
+- dose interval tables (FX, FY): one row per person, one more per dose
+- person-day table (FZ, FP):     sum over persons of (death day or END_MEASURE) + 1
+- ZI daily counts:               ages x (END_MEASURE + 1) rows of Python lists
+
+CohortSummary holds these counts (persons, deaths, vaccinated persons, doses, death days + 1 per
+age and END_MEASURE). It is streamed in chunks like the out-of-core mode, so the summary of the
+national file needs a few MB. Rows times the measured peak bytes per row of the stage (BYTES_PER_ROW,
+including pandas temporaries) plus the derived cohort held in memory give the predicted peak.
+The interval counts are upper bounds: doses after death or after END_MEASURE - lag still count.
+
+Usage (from the 'Py Scripts' folder):
+    summary = summarize_csv(INPUT_CSV)                  # summarize_csv(INPUT_CSV, cache_dir=...) keeps it
+    table = estimate(summary, ['FW', 'FZ'], ages={'FW': 70})   # one row per stage: rows, peak_mb
+
+    python -m czechfoi.estimate INPUT_CSV --analyses FZ FP ZI --memory-limit-mb 4000
+    python -m czechfoi.pipeline --dry-run                       # estimates for every pipeline stage
+"""
+
+# Peak bytes per row while a stage runs (measured with tracemalloc on AG70 and all-age cohorts)
+BYTES_PER_ROW = {
+    'intervals': 250,       # kernel arrays + DataFrame + the zero-length fix
+    'collapse': 230,        # interval table held + groupby temporaries, per interval row
+    'person_days': 150,     # per-person frames + concat (FP; FZ needs ~90)
+    'aggregate': 170,       # person-day table held + groupby, per person-day row
+    'daily_counts': 400,    # ZI result lists of NumPy scalars + DataFrame + rolling means
+}
+SUMMARY_VERSION = 1         # Stored summaries of another version are recomputed
+COHORT_BYTES = 300          # Derived cohort per person, held while the analyses run
+CHUNKABLE = ('FZ', 'FP', 'ZI')  # Analyses with an out-of-core strategy (see czechfoi.chunked)
+COUNT_FIELDS = ('persons', 'deaths', 'vaccinated', 'doses', 'death_days')  # Per-age arrays of a stored CohortSummary
+
+class CohortSummary:
+    """Per-age counts of an input that determine the table sizes of the analyses"""
+    def __init__(self):
+        self.persons = np.zeros(MAX_AGE + 1, dtype=np.int64)
+        self.deaths = np.zeros(MAX_AGE + 1, dtype=np.int64)
+        self.vaccinated = np.zeros(MAX_AGE + 1, dtype=np.int64)
+        self.doses = np.zeros(MAX_AGE + 1, dtype=np.int64)
+        self.death_days = np.zeros(MAX_AGE + 1, dtype=np.int64)   # sum of death day + 1 of the dead
+        self.end_measure = None
+
+    def add(self, chunk):
+        ages = chunk['age'].to_numpy(dtype=np.int64)
+        death = chunk['death_day'].to_numpy(dtype=float)
+        dead = ~np.isnan(death)
+        self.persons += np.bincount(ages, minlength=MAX_AGE + 1)
+        self.deaths += np.bincount(ages[dead], minlength=MAX_AGE + 1)
+        self.vaccinated += np.bincount(ages[chunk['first_dose_day'].notna().to_numpy()], minlength=MAX_AGE + 1)
+        self.doses += np.bincount(ages, weights=chunk[DOSE_DAY_COLS].notna().sum(axis=1).to_numpy(),
+                                  minlength=MAX_AGE + 1).astype(np.int64)
+        self.death_days += np.bincount(ages[dead], weights=death[dead] + 1, minlength=MAX_AGE + 1).astype(np.int64)
+        if dead.any():
+            chunk_end = int(death[dead].max())
+            self.end_measure = chunk_end if self.end_measure is None else max(self.end_measure, chunk_end)
+
+    def as_dict(self):
+        return dict({name: getattr(self, name).tolist() for name in COUNT_FIELDS}, end_measure=self.end_measure)
+
+    @classmethod
+    def from_dict(cls, fields):
+        summary = cls()
+        for name in COUNT_FIELDS:
+            setattr(summary, name, np.asarray(fields[name], dtype=np.int64))
+        summary.end_measure = fields['end_measure']
+        return summary
+
+    def select(self, ages=None):
+        """Age mask: all ages, one age or an inclusive (first, last) range"""
+        mask = self.persons > 0
+        if ages is None:
+            return mask
+        first, last = (ages, ages) if np.isscalar(ages) else (ages[0], ages[-1])
+        mask[:first] = False
+        mask[last + 1:] = False
+        return mask
+
+    def person_days(self, ages=None):
+        """Rows of the FZ/FP person-day table: dead persons up to their death day, the others to END_MEASURE"""
+        mask = self.select(ages)
+        alive = self.persons[mask] - self.deaths[mask]
+        return int(self.death_days[mask].sum() + alive.sum() * (self.end_measure + 1))
+
+def summarize(df):
+    """CohortSummary of a derived frame in memory"""
+    summary = CohortSummary()
+    summary.add(df)
+    return summary
+
+def summarize_csv(path, memory_budget_mb=MEMORY_BUDGET_MB, cache_dir=None):
+    """
+    CohortSummary of an input file, streamed in chunks. With cache_dir, the summary is saved there
+    under the input's content hash (see czechfoi.cube.file_hash) and read back while the file is
+    unchanged, so repeated plans of a large input do not parse it again.
+    """
+    if cache_dir:
+        sha = file_hash(path, os.path.join(cache_dir, HASH_MEMO))
+        if sha is None:
+            raise FileNotFoundError(f"No input file {path}")
+        stored = os.path.join(cache_dir, f"summary-{os.path.basename(path)}-{sha[:16]}.json")
+        if os.path.exists(stored):
+            with open(stored, encoding="utf-8") as f:
+                fields = json.load(f)
+            if fields.pop('version', None) == SUMMARY_VERSION:
+                return CohortSummary.from_dict(fields)
+    summary = CohortSummary()
+    reduce_csv(path, [summary], memory_budget_mb)
+    if cache_dir:
+        with open(stored + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(dict(summary.as_dict(), version=SUMMARY_VERSION), f)
+        os.replace(stored + ".tmp", stored)
+    return summary
+
+def _mb(n_bytes):
+    return n_bytes / (1 << 20)
+
+def stage_rows(summary, code, ages=None, scale=1.0):
+    """
+    [(stage, rows, bytes per row)] of the large tables one analysis builds on a cohort; rows that
+    grow with the number of persons are multiplied by scale.
+    """
+    mask = summary.select(ages)
+    persons = int(summary.persons[mask].sum())
+    if code == 'FJ':
+        rows = int((persons + summary.vaccinated[mask].sum()) * scale)
+        return [('prep', rows, BYTES_PER_ROW['intervals'])]
+    if code in ('FS', 'FW'):
+        rows = int((persons + summary.vaccinated[mask].sum()) * scale)
+        return [('intervals', rows, BYTES_PER_ROW['intervals']), ('collapse', rows, BYTES_PER_ROW['collapse'])]
+    if code in ('FX', 'FY'):
+        rows = int((persons + summary.doses[mask].sum()) * scale)
+        return [('intervals', rows, BYTES_PER_ROW['intervals']), ('collapse', rows, BYTES_PER_ROW['collapse'])]
+    if code in ('FZ', 'FP'):
+        rows = int(summary.person_days(ages) * scale)
+        return [('person_days', rows, BYTES_PER_ROW['person_days']), ('aggregate', rows, BYTES_PER_ROW['aggregate'])]
+    if code == 'ZI':
+        rows = int(mask.sum()) * (summary.end_measure + 1)
+        return [('counts', rows, BYTES_PER_ROW['daily_counts'])]
+    return []
+
+def estimate(summary, analyses, ages=None, scale=1.0, memory_limit_mb=None, chunkable=CHUNKABLE):
+    """
+    Predicted rows and memory (MB) per stage of the analyses on one cohort: stage_mb for the
+    tables the stage builds, peak_mb with the derived cohort held next to them.
+
+    ages maps analysis codes to the age (or range) they select, scale multiplies the rows (e.g. a
+    preview fraction). With memory_limit_mb, 'strategy' says how an analysis with a stage over the
+    limit runs: 'chunked' if it has an out-of-core mode (chunkable), else 'over budget'. If the
+    cohort itself does not fit, every analysis that needs it in memory is over budget.
+    """
+    ages = ages or {}
+    persons = int(summary.persons.sum() * scale)
+    cohort_mb = _mb(persons * COHORT_BYTES)
+    load_mb = _mb(persons * ROW_BYTES)
+    records = [dict(analysis='load', stage='cohort', rows=persons, stage_mb=load_mb, peak_mb=load_mb)]
+    for code in analyses:
+        for stage, rows, row_bytes in stage_rows(summary, code, ages.get(code), scale):
+            stage_mb = _mb(rows * row_bytes)
+            records.append(dict(analysis=code, stage=stage, rows=rows, stage_mb=stage_mb, peak_mb=cohort_mb + stage_mb))
+    table = pd.DataFrame(records, columns=['analysis', 'stage', 'rows', 'stage_mb', 'peak_mb'])
+    table['strategy'] = 'in memory'
+    if memory_limit_mb is None:
+        return table
+
+    over = table['peak_mb'] > memory_limit_mb
+    cohort_over = bool(over.iloc[0])
+    for code in analyses:
+        rows = table['analysis'] == code
+        if cohort_over or over[rows].any():
+            table.loc[rows, 'strategy'] = 'chunked' if code in chunkable else 'over budget'
+    if cohort_over:
+        in_memory = [code for code in analyses if code not in chunkable]
+        table.loc[0, 'strategy'] = 'over budget' if in_memory else 'chunked'
+    return table
+
+def format_table(table):
+    return table.to_string(index=False, formatters={'rows': '{:,}'.format, 'stage_mb': '{:,.0f}'.format, 'peak_mb': '{:,.0f}'.format})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Predict rows and peak memory of the analysis stages for an input file.")
+    parser.add_argument('input_csv')
+    parser.add_argument('--analyses', nargs='+', default=['FS', 'FW', 'FX', 'FY', 'FZ', 'FP', 'ZI', 'FJ'])
+    parser.add_argument('--age', nargs='+', type=int, help="age or first and last age the analyses select (default: all)")
+    parser.add_argument('--memory-limit-mb', type=float, help="mark stages above this peak as chunked / over budget")
+    parser.add_argument('--memory-budget-mb', type=int, default=MEMORY_BUDGET_MB, help="chunk memory of the summary pass")
+    args = parser.parse_args(argv)
+
+    summary = summarize_csv(args.input_csv, args.memory_budget_mb)
+    ages = {code: (args.age[0], args.age[-1]) for code in args.analyses} if args.age else None
+    print(f"{int(summary.persons.sum()):,} persons, {int(summary.deaths.sum()):,} deaths, "
+          f"{int(summary.doses.sum()):,} doses, END_MEASURE {summary.end_measure}")
+    table = estimate(summary, args.analyses, ages, memory_limit_mb=args.memory_limit_mb)
+    print(format_table(table))
+    if (table['strategy'] == 'over budget').any():
+        raise SystemExit("Some stages exceed the memory limit and have no out-of-core strategy")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import html
+import os
+import re
+
+import numpy as np
+
+"""
+HTML output of the Plotly figures: standalone (default) or slim, and a multi-figure report.
+
+fig.write_html inlines the whole plotly.js bundle (~4.6 MB) into every file, and traces built from
+lists are written as JSON text. With SLIM_HTML every script writes its figure through write_html()
+here instead:
+- the page loads one shared plotly-<version>.min.js (written once into PLOTLYJS_DIR, by default
+  the folder of the HTML; the pipeline uses the Plot Results root) through a relative <script src>,
+  so the result folders can be moved together,
+- x/y trace data are stored as compact typed arrays: whole numbers (days, counts) as int16/int32,
+  other values as float32, which Plotly encodes as base64 'bdata' instead of decimal text,
+- the figure JSON sits in a <script type="application/json"> block, from which write_report()
+  collects several figures into one page.
+
+Without SLIM_HTML, write_html() is fig.write_html(path): the files open anywhere without the
+shared script.
+
+Before writing, the scripts thin their line traces with compress_traces() (COMPRESS_CURVES):
+- step functions (Kaplan-Meier curves, steps=True) keep only the first and last point of every run
+  of equal values; the plotted line is exactly the same,
+- daily series (ZI, FJ) additionally go through largest-triangle-three-buckets (LTTB) decimation
+  with the fewest points (MIN_POINTS, doubled as needed) whose linear interpolation stays within
+  DECIMATE_TOLERANCE of the trace's value range at every original point. NaN gaps are kept.
+
+Usage (from the 'Py Scripts' folder):
+    figures.SLIM_HTML = True                            # or configure(slim=True, plotlyjs_dir=...)
+    figures.compress_traces(fig, steps=True)            # KM curves: change points only
+    figures.write_html(fig, OUTPUT_HTML)
+    figures.write_report([html_1, html_2], "report.html", title="CzechFOI analyses")
+
+    python -m czechfoi.pipeline --slim-html --report    # slim files and Plot Results/CzechFOI report.html
+    python -m czechfoi.pipeline --full-curves           # every point of every curve
+"""
+
+SLIM_HTML = False            # Shared plotly.js and typed-array trace data instead of standalone files
+PLOTLYJS_DIR = None          # Folder of the shared plotly.js (None = next to each HTML file)
+COMPACT_ATTRS = ('x', 'y')   # Trace arrays stored as int16/int32/float32 in slim mode
+FIGURE_DATA_ID = "figure-data"
+
+COMPRESS_CURVES = True       # Thin line traces before writing (see compress_traces)
+DECIMATE_TOLERANCE = 0.005   # Largest deviation of a decimated series, as a share of its value range (~2 px)
+MIN_POINTS = 128             # Shorter segments are not decimated; the first LTTB attempt keeps this many
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script src="{plotlyjs}"></script>
+<style>body {{ margin: 0; font-family: sans-serif; }} h2 {{ margin: 16px; }} .figure {{ width: 100%; height: {height}; }}</style>
+</head>
+<body>
+{body}
+<script>
+for (const block of document.querySelectorAll('script[type="application/json"]')) {{
+    const figure = JSON.parse(block.textContent);
+    Plotly.newPlot(block.dataset.target, figure.data, figure.layout, {{responsive: true}});
+}}
+</script>
+</body>
+</html>
+"""
+FIGURE = """{heading}<div id="{div_id}" class="figure"></div>
+<script type="application/json" id="{data_id}" data-target="{div_id}">{data}</script>
+"""
+_FIGURE_DATA = re.compile(r'<script type="application/json" id="' + FIGURE_DATA_ID + r'"[^>]*>(.*?)</script>', re.S)
+
+def configure(slim=None, plotlyjs_dir=None, compress=None, tolerance=None):
+    """Set SLIM_HTML / PLOTLYJS_DIR / COMPRESS_CURVES / DECIMATE_TOLERANCE (None keeps the current value)"""
+    global SLIM_HTML, PLOTLYJS_DIR, COMPRESS_CURVES, DECIMATE_TOLERANCE
+    if slim is not None:
+        SLIM_HTML = slim
+    if plotlyjs_dir is not None:
+        PLOTLYJS_DIR = plotlyjs_dir
+    if compress is not None:
+        COMPRESS_CURVES = compress
+    if tolerance is not None:
+        DECIMATE_TOLERANCE = tolerance
+
+def settings():
+    """Current output mode, part of the pipeline key of every stage that writes HTML"""
+    return {'slim': SLIM_HTML, 'plotlyjs_dir': PLOTLYJS_DIR if SLIM_HTML else None,
+            'compress': COMPRESS_CURVES, 'tolerance': DECIMATE_TOLERANCE if COMPRESS_CURVES else None}
+
+def compact_array(values):
+    """Numeric array in the smallest exact integer type, else float32; other values unchanged"""
+    try:
+        array = np.asarray(values)
+    except (TypeError, ValueError):
+        return values
+    if array.dtype.kind not in 'biuf' or array.size == 0:
+        return values
+    if array.dtype.kind == 'f':
+        finite = np.isfinite(array)
+        if not finite.all() or not np.array_equal(array, np.round(array)):
+            return array.astype(np.float32)
+    for dtype in (np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if array.min() >= info.min and array.max() <= info.max:
+            return array.astype(dtype)
+    return array.astype(np.float64)
+
+def compact_traces(fig):
+    """Store the x/y arrays of all traces in compact types (in place); returns fig"""
+    for trace in fig.data:
+        for attr in COMPACT_ATTRS:
+            values = getattr(trace, attr, None)
+            if values is not None and not isinstance(values, str):
+                trace[attr] = compact_array(values)
+    return fig
+
+def change_points(y):
+    """Mask of the first and last point of every run of equal values (NaN points are kept)"""
+    y = np.asarray(y)
+    keep = np.ones(len(y), dtype=bool)
+    if len(y) > 2:
+        same = y[1:] == y[:-1]
+        keep[1:-1] = ~(same[:-1] & same[1:])
+    return keep
+
+def lttb(x, y, n_out):
+    """
+    Indices of n_out points chosen by largest-triangle-three-buckets (first and last point kept);
+    the triangle's left vertex is the previous bucket's mean, so all buckets are scored at once
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    starts, sizes = edges[:-1], np.diff(edges)
+    inner = slice(1, n - 1)
+    mean_x = np.add.reduceat(x[inner], starts - 1) / sizes
+    mean_y = np.add.reduceat(y[inner], starts - 1) / sizes
+    ax, ay = np.repeat(np.append(x[0], mean_x[:-1]), sizes), np.repeat(np.append(y[0], mean_y[:-1]), sizes)
+    cx, cy = np.repeat(np.append(mean_x[1:], x[-1]), sizes), np.repeat(np.append(mean_y[1:], y[-1]), sizes)
+    area = np.abs((ax - cx) * (y[inner] - ay) - (ax - x[inner]) * (cy - ay))
+    # First index reaching its bucket's maximum area
+    top = area == np.repeat(np.maximum.reduceat(area, starts - 1), sizes)
+    best = np.minimum.reduceat(np.where(top, np.arange(1, n - 1), n), starts - 1)
+    return np.concatenate(([0], best, [n - 1]))
+
+def decimate(x, y, tolerance=None, min_points=MIN_POINTS):
+    """
+    Indices of an LTTB subset of a finite series whose linear interpolation deviates at most
+    tolerance x (max - min) from every point; the subset grows from min_points until it does, or
+    all points are kept when it would need more than half of them.
+    """
+    n = len(y)
+    tolerance = DECIMATE_TOLERANCE if tolerance is None else tolerance
+    limit = tolerance * (y.max() - y.min()) if n else 0
+    n_out = min_points
+    while n_out <= n // 2:
+        chosen = lttb(x, y, n_out)
+        if np.max(np.abs(np.interp(x, x[chosen], y[chosen]) - y)) <= limit:
+            return chosen
+        n_out *= 2
+    return np.arange(n)
+
+def _numeric_x(x):
+    x = np.asarray(x)
+    if x.dtype.kind in 'biuf':
+        return x.astype(float)
+    if x.dtype.kind == 'M':
+        return x.astype('datetime64[ns]').astype(np.int64).astype(float)
+    return np.arange(len(x), dtype=float)                        # labels: equally spaced
+
+def compress_curve(x, y, steps=False, tolerance=None):
+    """Mask of the points to keep: change points, and for steps=False an error-bounded LTTB subset of each finite segment"""
+    y = np.asarray(y, dtype=float)
+    keep = change_points(y)
+    if steps or len(y) <= MIN_POINTS:
+        return keep
+    x_num = _numeric_x(x)
+    finite = np.isfinite(y) & np.isfinite(x_num)
+    keep = ~finite
+    bounds = np.flatnonzero(np.diff(np.concatenate([[0], finite.astype(np.int8), [0]])))
+    for start, stop in zip(bounds[::2], bounds[1::2]):
+        segment = slice(start, stop)
+        if stop - start <= MIN_POINTS:
+            keep[segment] = True
+            continue
+        index = np.flatnonzero(change_points(y[segment]))      # decimate the change points only
+        chosen = decimate(x_num[segment][index], y[segment][index], tolerance)
+        keep[start + index[chosen]] = True
+    return keep
+
+def compress_traces(fig, steps=False, tolerance=None):
+    """
+    Thin the line traces of fig in place (see compress_curve); traces with markers, other trace types
+    and figures with COMPRESS_CURVES off are left alone. Returns fig.
+    """
+    if not COMPRESS_CURVES:
+        return fig
+    for trace in fig.data:
+        if trace.type != 'scatter' or (trace.mode is not None and 'markers' in trace.mode):
+            continue
+        if trace.x is None or trace.y is None or len(trace.x) != len(trace.y) or len(trace.y) < 3:
+            continue
+        try:
+            keep = compress_curve(trace.x, trace.y, steps, tolerance)
+        except (TypeError, ValueError):                          # non-numeric y
+            continue
+        if not keep.all():
+            trace.x, trace.y = np.asarray(trace.x)[keep], np.asarray(trace.y)[keep]
+    return fig
+
+def shared_plotlyjs(folder):
+    """Path of the shared plotly.js in folder, written if it is not there yet"""
+    from plotly.offline import get_plotlyjs, get_plotlyjs_version
+    path = os.path.join(folder, f"plotly-{get_plotlyjs_version()}.min.js")
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+        os.replace(path + ".tmp", path)
+    return path
+
+def _figure_json(fig):
+    # '</' cannot end the <script> block inside a JSON string
+    return fig.to_json().replace("</", "<\\/")
+
+def _page(output_html, title, body, height):
+    folder = os.path.dirname(os.path.abspath(output_html))
+    plotlyjs = shared_plotlyjs(PLOTLYJS_DIR or folder)
+    src = os.path.relpath(plotlyjs, folder).replace(os.sep, "/")
+    with open(output_html, "w", encoding="utf-8") as f:
+        f.write(PAGE.format(title=html.escape(title), plotlyjs=html.escape(src), body=body, height=height))
+
+def write_html(fig, output_html, slim=None):
+    """fig.write_html(output_html), or a slim page (see the module description) with SLIM_HTML / slim=True"""
+    if not (SLIM_HTML if slim is None else slim):
+        fig.write_html(output_html)
+        return
+    compact_traces(fig)
+    title = fig.layout.title.text or os.path.splitext(os.path.basename(output_html))[0]
+    body = FIGURE.format(heading="", div_id="figure", data_id=FIGURE_DATA_ID, data=_figure_json(fig))
+    _page(output_html, title, body, height="100vh")
+
+def read_figure(path):
+    """Figure JSON text of a slim HTML file, None for standalone files"""
+    with open(path, encoding="utf-8") as f:
+        match = _FIGURE_DATA.search(f.read())
+    return match.group(1) if match else None
+
+def write_report(html_files, output_html, title="CzechFOI analyses"):
+    """
+    One page with the figures of several slim HTML files (in the given order), each under its file
+    name; standalone files are linked instead. Returns the number of figures included.
+    """
+    report_dir = os.path.dirname(os.path.abspath(output_html))
+    parts, n_figures = [], 0
+    for n, path in enumerate(html_files):
+        name = os.path.splitext(os.path.basename(path))[0]
+        data = read_figure(path) if os.path.exists(path) else None
+        if data is None:
+            link = html.escape(os.path.relpath(path, report_dir).replace(os.sep, "/"))
+            parts.append(f'<h2><a href="{link}">{html.escape(name)}</a></h2>\n')
+            continue
+        parts.append(FIGURE.format(heading=f"<h2>{html.escape(name)}</h2>\n", div_id=f"figure-{n}",
+                                   data_id=f"report-data-{n}", data=data))
+        n_figures += 1
+    _page(output_html, title, "".join(parts), height="80vh")
+    print(f"Report with {n_figures} figures saved to {output_html}")
+    return n_figures
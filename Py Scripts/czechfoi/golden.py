@@ -0,0 +1,328 @@
+import argparse
+import contextlib
+import importlib
+import json
+import math
+import os
+import platform
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from czechfoi import dosetime, incremental, multistate, pipeline, stratified, synth
+from czechfoi.chunked import reduce_csv
+from czechfoi.cohort import Cohort
+from czechfoi.cube import CountCube
+from czechfoi.bench import git_commit
+from czechfoi.instrument import RunRecord
+
+"""
+Golden-output regression harness: all analyses on a fixed synthetic cohort, compared with stored results.
+
+The Plot Results TXT logs are the only record of the expected HRs, IRRs and counts on the real data.
+This harness gives every change (vectorized builders, collapsed tables, chunked counts, ...) a check
+that runs offline in about a minute:
+
+1. A synthetic AG70 cohort of GOLDEN_ROWS rows (czechfoi.synth, GOLDEN_SEED) is written to a
+   temporary folder as the real-data file; FG simulates the 'sim' dataset from it as usual.
+2. The pipeline runs every stage of the selected analyses without its cache. The other code paths
+   (MODES) run after it, with their stage names prefixed by the mode: 'chunked/' runs FZ, FP and
+   ZI from streamed counts, 'preview/' all analyses on a GOLDEN_PREVIEW weighted sample; 'cube',
+   'incremental' (a release without the last rows, updated to the full file), 'stratified',
+   'dosetime' and 'multistate' stream the real-data file.
+3. Each stage value is reduced to its numbers (fingerprint): END_MEASURE, the coefficients,
+   standard errors and log-likelihood of the Cox and Poisson fits, the row count and column sums
+   of every table (e.g. the doses FG assigned per dose column), Kaplan-Meier curves, daily counts.
+4. These are compared with GOLDEN_FILE within a relative tolerance (FIT_RTOL for model fits,
+   RTOL otherwise), and the wall time and traced peak memory of each stage with their recorded
+   budget (recorded value x TIME_FACTOR / MEMORY_FACTOR plus a small slack for tiny stages).
+
+Memory is the tracemalloc peak within the stage above the memory traced when it starts (NumPy and
+pandas allocations included), so it is independent of what earlier stages left in the process.
+Timings are measured with tracing on and depend on the machine: record the budgets once per machine
+with --update-budgets.
+
+Usage (from the 'Py Scripts' folder):
+    python -m czechfoi.golden                       # check values and budgets, exit code 1 on failure
+    python -m czechfoi.golden --analyses FW FZ      # only these analyses (and the stages they need)
+    python -m czechfoi.golden --modes chunked cube  # only these of the other code paths (--modes alone: none)
+    python -m czechfoi.golden --no-budgets          # values only
+    python -m czechfoi.golden --update              # record new golden values and budgets
+    python -m czechfoi.golden --update-budgets      # keep the values, re-record time and memory
+"""
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden.json")
+GOLDEN_ROWS = 2_000          # Synthetic AG70 rows (FZ builds rows x days person-day rows)
+GOLDEN_SEED = 7
+GOLDEN_AGE = 70
+GOLDEN_PREVIEW = 0.2         # Fraction of the 'preview' mode
+INCREMENTAL_BASE = 0.9       # Share of the rows in the earlier release of the 'incremental' mode
+MODES = ('chunked', 'preview', 'cube', 'incremental', 'stratified', 'dosetime', 'multistate')
+CHUNKABLE = ('FZ', 'FP', 'ZI')
+
+RTOL = 1e-6                  # Relative tolerance of counts, sums and curves
+ATOL = 1e-9
+FIT_RTOL = 1e-4              # Relative tolerance of fitted coefficients (optimizer convergence)
+FIT_STAGES = ('cox', 'poisson')
+TIME_FACTOR = 2.0            # A stage fails if it takes longer than recorded x TIME_FACTOR + TIME_SLACK_S
+TIME_SLACK_S = 0.5
+MEMORY_FACTOR = 1.25         # ... or traces more than recorded x MEMORY_FACTOR + MEMORY_SLACK_MB
+MEMORY_SLACK_MB = 16
+# Imported before the run, so no stage pays for a first import (the scripts import them lazily)
+WARM_IMPORTS = ('lifelines', 'statsmodels.api', 'plotly.graph_objects', 'scipy.ndimage', 'scipy.integrate')
+
+class TracedRecord(RunRecord):
+    """
+    RunRecord that also keeps the tracemalloc peak (MB) of every stage above its start in traced_mb;
+    stage names get the current prefix (the mode of run_golden)
+    """
+    def __init__(self, **meta):
+        super().__init__(**meta)
+        self.traced_mb = {}
+        self.prefix = ""
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        name = self.prefix + name
+        # reset_peak() sets the peak to the memory traced now, not to zero: subtract that baseline
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        with super().stage(name) as timer:
+            try:
+                yield timer
+            finally:
+                peak = tracemalloc.get_traced_memory()[1]
+                self.traced_mb[name] = round((peak - start) / (1 << 20), 2)
+
+def fingerprint(value, key):
+    """Flat {key: number} of the numeric results in a stage value (tables, fits, curves, counts)"""
+    if value is None or isinstance(value, str):
+        return {}
+    if isinstance(value, (bool, int, float, np.number)):
+        return {key: float(value)}
+    if hasattr(value, 'survival_function_'):                     # lifelines KaplanMeierFitter
+        return fingerprint(value.survival_function_, f"{key}.survival")
+    if hasattr(value, 'log_likelihood_') and hasattr(value, 'summary'):   # lifelines Cox fit
+        values = {f"{key}.loglik": float(value.log_likelihood_)}
+        for covariate, row in value.summary.iterrows():
+            values[f"{key}.coef.{covariate}"] = float(row['coef'])
+            values[f"{key}.se.{covariate}"] = float(row['se(coef)'])
+        return values
+    if hasattr(value, 'per_age') and hasattr(value, 'beta'):     # czechfoi.stratified fit
+        values = {f"{key}.loglik": float(value.loglik), f"{key}.coef": float(value.beta), f"{key}.se": float(value.se)}
+        values.update(fingerprint(value.per_age, f"{key}.per_age"))
+        return values
+    if hasattr(value, 'params') and hasattr(value, 'bse'):       # statsmodels results
+        values = {f"{key}.loglik": float(value.llf)}
+        for name in value.params.index:
+            values[f"{key}.coef.{name}"] = float(value.params[name])
+            values[f"{key}.se.{name}"] = float(value.bse[name])
+        return values
+    if isinstance(value, (pd.Series, Cohort)):
+        return fingerprint(value.to_frame(), key)
+    if isinstance(value, pd.DataFrame):
+        values = {f"{key}.rows": float(len(value))}
+        for column in value.columns:
+            series = value[column]
+            if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+                values[f"{key}.sum.{column}"] = float(series.sum())
+            else:                                                    # dates, labels: non-missing values
+                values[f"{key}.count.{column}"] = float(series.notna().sum())
+        return values
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind not in 'biuf':
+            return {f"{key}.size": float(value.size)}
+        return {f"{key}.size": float(value.size), f"{key}.sum": float(np.nansum(value))}
+    if isinstance(value, (tuple, list)):
+        values = {}
+        for i, item in enumerate(value):
+            values.update(fingerprint(item, f"{key}.{i}"))
+        return values
+    if isinstance(value, dict):
+        values = {}
+        for name, item in value.items():
+            values.update(fingerprint(item, f"{key}.{name}"))
+        return values
+    return {}
+
+def warm_up():
+    """Import the model and plot libraries and render one figure, so the budgets do not depend on stage order"""
+    for module in WARM_IMPORTS:
+        importlib.import_module(module)
+    go = importlib.import_module('plotly.graph_objects')
+    go.Figure(go.Scatter(x=[0], y=[0])).to_html()
+
+def run_pipeline(record, stages, cache_dir, force=True, prefix=""):
+    """Run the stages with their timings in record; returns {prefixed stage name: fingerprint}"""
+    runner = pipeline.Pipeline(stages, cache_dir=cache_dir, force=force)
+    runner.record = record
+    record.prefix = prefix
+    try:
+        runner.run()
+    finally:
+        record.prefix = ""
+    return {prefix + name: fingerprint(value, prefix + name) for name, value in runner.values.items()}
+
+def run_counts(record, mode, csv, tmp):
+    """Stages of the streamed modes on one input file; returns {stage name: fingerprint}"""
+    results = {}
+
+    def stage(name, func, *args, **kwargs):
+        with record.stage(name):
+            results[name] = func(*args, **kwargs)
+        return results[name]
+
+    if mode == 'cube':
+        cube = stage('cube:real:build', CountCube.build_csv, csv, cube_root=os.path.join(tmp, "cube"))
+        stage('cube:real:poisson_table', cube.poisson_table)
+        stage('cube:real:daily_counts', cube.daily_counts)
+    elif mode == 'incremental':
+        base = os.path.join(tmp, "base", os.path.basename(csv))
+        os.makedirs(os.path.dirname(base))
+        rows = pd.read_csv(csv, dtype=str)
+        rows.iloc[:int(len(rows) * INCREMENTAL_BASE)].to_csv(base, index=False)
+        cube_root = os.path.join(tmp, "incremental")
+        stage('incremental:real:init', incremental.init, base, cube_root)
+        cube_dir = stage('incremental:real:update', incremental.update, csv, base, cube_root)
+        stage('incremental:real:poisson_table', lambda: CountCube.open(cube_dir).poisson_table())
+    elif mode == 'stratified':
+        counts = stratified.RiskSetCounts()
+        end = stage('stratified:real:counts', reduce_csv, csv, [counts])
+        stage('stratified:real:cox', stratified.fit_stratified, counts.risk_sets(end))
+    elif mode == 'dosetime':
+        stage('dosetime:real:hr', dosetime.hazard_ratio_csv, csv)
+    elif mode == 'multistate':
+        stage('multistate:real:occupancy', multistate.aalen_johansen_csv, csv)
+    return {name: fingerprint(value, name) for name, value in results.items()}
+
+def run_golden(analyses=pipeline.ANALYSES, modes=MODES, n_rows=GOLDEN_ROWS, seed=GOLDEN_SEED, age=GOLDEN_AGE):
+    """Run the analyses and modes on the synthetic cohort; returns ({stage: fingerprint}, TracedRecord)"""
+    warm_up()
+    record = TracedRecord(rows=n_rows, seed=seed, age=age, analyses=list(analyses), modes=list(modes))
+    values = {}
+    with tempfile.TemporaryDirectory(prefix="czechfoi-golden-") as tmp:
+        csv = os.path.join(tmp, pipeline.REAL_CSV)
+        synth.write_synthetic_csv(csv, n_rows, seed=seed, age=age)
+        cache_dir = os.path.join(tmp, "cache")
+        tracemalloc.start()
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                stages = pipeline.build_stages(analyses=analyses, data_dir=tmp, results_dir=os.path.join(tmp, "results"))
+                values.update(run_pipeline(record, stages, cache_dir))
+                for mode in modes:
+                    if mode in ('chunked', 'preview'):
+                        if mode == 'chunked':
+                            codes = [code for code in analyses if code in CHUNKABLE]
+                            build = dict(chunked_runs=[f'{code}:{ds}' for code in codes for ds in ('real', 'sim')])
+                        else:
+                            codes, build = analyses, dict(preview=GOLDEN_PREVIEW)
+                        if not codes:
+                            continue
+                        stages = pipeline.build_stages(analyses=codes, data_dir=tmp,
+                                                       results_dir=os.path.join(tmp, mode), **build)
+                        # The 'sim' file of the first run is reused: FG's stage comes from the cache
+                        force = {stage.name for stage in stages if stage.group != 'FG'}
+                        values.update(run_pipeline(record, stages, cache_dir, force, prefix=f"{mode}/"))
+                    else:
+                        values.update(run_counts(record, mode, csv, tmp))
+        finally:
+            tracemalloc.stop()
+    return {name: found for name, found in values.items() if found}, record
+
+def budgets(record):
+    return {timer.name: {'wall_s': timer.wall_s, 'traced_mb': record.traced_mb[timer.name]} for timer in record.stages}
+
+def _close(found, expected, rtol):
+    if math.isnan(expected):
+        return math.isnan(found)
+    return math.isclose(found, expected, rel_tol=rtol, abs_tol=ATOL)
+
+def compare_values(values, golden):
+    """Failure messages for missing, extra or changed numbers"""
+    failures = []
+    for stage, expected in golden.items():
+        if stage not in values:
+            continue                                              # analysis not selected
+        found = values[stage]
+        rtol = FIT_RTOL if stage.rsplit(':', 1)[-1] in FIT_STAGES else RTOL
+        for key in sorted(set(expected) | set(found)):
+            if key not in found:
+                failures.append(f"{key}: missing (golden {expected[key]:.10g})")
+            elif key not in expected:
+                failures.append(f"{key}: {found[key]:.10g} not in the golden file")
+            elif not _close(found[key], expected[key], rtol):
+                failures.append(f"{key}: {found[key]:.10g} != golden {expected[key]:.10g}")
+    failures += [f"{stage}: stage not in the golden file" for stage in values if stage not in golden]
+    return failures
+
+def compare_budgets(record, recorded):
+    """Failure messages for stages over their time or memory budget"""
+    failures = []
+    for stage, measured in budgets(record).items():
+        if stage not in recorded:
+            continue
+        time_budget = recorded[stage]['wall_s'] * TIME_FACTOR + TIME_SLACK_S
+        memory_budget = recorded[stage]['traced_mb'] * MEMORY_FACTOR + MEMORY_SLACK_MB
+        if measured['wall_s'] > time_budget:
+            failures.append(f"{stage}: {measured['wall_s']:.2f} s > budget {time_budget:.2f} s")
+        if measured['traced_mb'] > memory_budget:
+            failures.append(f"{stage}: {measured['traced_mb']:.1f} MB > budget {memory_budget:.1f} MB")
+    return failures
+
+def load_golden(path=GOLDEN_FILE):
+    if not os.path.exists(path):
+        raise SystemExit(f"No golden file {path}; record one with --update")
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def write_golden(path, values, record, golden=None):
+    """Write new values (or keep those of golden) and the budgets measured in record"""
+    commit, dirty = git_commit()
+    result = {
+        'meta': {**record.meta, 'commit': commit, 'dirty': dirty, 'python': platform.python_version(),
+                 'numpy': np.__version__, 'pandas': pd.__version__, 'machine': platform.machine(),
+                 'system': platform.system()},
+        'values': golden['values'] if golden else values,
+        'budgets': budgets(record),
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=1, sort_keys=True)
+        f.write("\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check all analyses on a fixed synthetic cohort against golden results.")
+    parser.add_argument('--analyses', nargs='+', default=pipeline.ANALYSES, choices=pipeline.ANALYSES)
+    parser.add_argument('--modes', nargs='*', default=list(MODES), choices=MODES,
+                        help="other code paths to check after the default run")
+    parser.add_argument('--golden', default=GOLDEN_FILE, help="JSON file with the golden values and budgets")
+    parser.add_argument('--no-budgets', action='store_true', help="do not check time and memory")
+    parser.add_argument('--update', action='store_true', help="record the values and budgets of this run")
+    parser.add_argument('--update-budgets', action='store_true', help="record only the time and memory budgets")
+    args = parser.parse_args(argv)
+
+    values, record = run_golden(args.analyses, args.modes)
+    print(record.summary())
+    if args.update:
+        write_golden(args.golden, values, record)
+        print(f"Golden values and budgets of {len(values)} stages written to {args.golden}")
+        return
+    golden = load_golden(args.golden)
+    if args.update_budgets:
+        write_golden(args.golden, values, record, golden)
+        print(f"Budgets written to {args.golden}")
+        return
+
+    failures = compare_values(values, golden['values'])
+    if not args.no_budgets:
+        failures += compare_budgets(record, golden['budgets'])
+    n_values = sum(len(found) for found in values.values())
+    if failures:
+        print("\n".join(failures))
+        raise SystemExit(f"{len(failures)} golden check(s) failed")
+    print(f"All {n_values} values of {len(values)} stages match the golden file"
+          + ("" if args.no_budgets else ", all stages within their time and memory budgets"))
+
+if __name__ == "__main__":
+    main()
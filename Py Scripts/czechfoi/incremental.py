@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from czechfoi.data import DOSE_DAY_COLS, resolve_input
+from czechfoi.chunked import MEMORY_BUDGET_MB, iter_derived_chunks
+from czechfoi.cube import CUBE_ROOT, HASH_MEMO, TIME_SINCE_DOSE_BANDS, CountCube, CubeCounts, file_hash
+
+"""
+Incremental update of the count cube (czechfoi.cube) when a new FOI release arrives.
+
+A new Vesely export mostly differs from the previous one by added deaths and doses. The export
+has no person ID, so a record is a whole row: age, death day and the seven dose days. A release
+is kept as its distinct records with the number of rows of each (the cached cohort), together with
+the difference arrays the cube is computed from. For a new release:
+
+1. its records are counted (one streaming pass to parse the file, no interval building),
+2. the record counts are diffed against the cached ones: a person who died or got a dose since
+   the last release shows up as -1 for the old row and +1 for the new one,
+3. only the changed records are counted into the difference arrays, with weights -n / +n,
+4. the cube is closed at the new END_MEASURE (intervals of people still alive are open-ended,
+   so a later END_MEASURE only extends them) and saved for the new file.
+
+So the counting work grows with the size of the change, not with the size of the country. The
+Poisson model is refitted from the updated cube (the table of deaths and person-days is its
+sufficient statistic). The Cox intervals are not updated this way: every censored interval ends
+at END_MEASURE, so a new release moves all of them.
+
+Usage (from the 'Py Scripts' folder):
+    python -m czechfoi.incremental init Vesely_106_202403141131.csv
+    python -m czechfoi.incremental update Vesely_106_202409301200.csv --base Vesely_106_202403141131.csv --refit
+
+Afterwards CountCube.for_input() on the new file (e.g. ZI with COUNT_CUBE = True) opens the updated cube.
+"""
+
+RECORD_COLS = ['age', 'death_day'] + DOSE_DAY_COLS
+STATE_DIR = "state"         # Subfolder of a cube folder with the cached records and difference arrays
+
+def count_records(df, weight=None):
+    """Distinct records (RECORD_COLS) with the number of rows n (or the sum of the 'weight' column)"""
+    grouped = df.groupby(RECORD_COLS, dropna=False, sort=False)
+    n = grouped[weight].sum() if weight else grouped.size()
+    return n.rename('n').reset_index()
+
+def encode_records(path, memory_budget_mb=MEMORY_BUDGET_MB):
+    """Distinct records of an input file, counted chunk by chunk"""
+    parts = [count_records(chunk[RECORD_COLS]) for chunk in iter_derived_chunks(path, memory_budget_mb)]
+    return count_records(pd.concat(parts, ignore_index=True), 'n')
+
+def diff_records(old, new):
+    """Records whose number of rows changed between two releases, n = new count - old count"""
+    both = pd.concat([old.assign(n=-old['n']), new], ignore_index=True)
+    delta = count_records(both, 'n')
+    return delta[delta['n'] != 0].reset_index(drop=True)
+
+def input_hash(path, cube_root=CUBE_ROOT):
+    """sha256 of an input file through the cube root's size+mtime memo (see czechfoi.cube.file_hash)"""
+    return file_hash(path, os.path.join(cube_root, HASH_MEMO))
+
+def cube_dir_for(path, cube_root=CUBE_ROOT):
+    """Cube folder of an input file, as used by CountCube.for_input()"""
+    return os.path.join(cube_root, f"{os.path.basename(path)}-{input_hash(path, cube_root)[:16]}")
+
+class ReleaseState:
+    """Cached cohort of one release: its record counts and the cube's difference arrays"""
+    def __init__(self, records, counts, meta):
+        self.records = records
+        self.counts = counts
+        self.meta = meta
+
+    @classmethod
+    def build(cls, path, bands=TIME_SINCE_DOSE_BANDS, memory_budget_mb=MEMORY_BUDGET_MB, cube_root=CUBE_ROOT):
+        path = resolve_input(path)
+        print(f"Counting the records of {os.path.basename(path)}...")
+        records = encode_records(path, memory_budget_mb)
+        counts = CubeCounts(bands)
+        # One row per distinct record, weighted by how many people have it
+        counts.add(records, weights=records['n'].to_numpy())
+        return cls(records, counts, dict(input=os.path.abspath(path), input_sha256=input_hash(path, cube_root)))
+
+    def end_measure(self):
+        return int(self.records['death_day'].max())
+
+    def update(self, path, memory_budget_mb=MEMORY_BUDGET_MB, cube_root=CUBE_ROOT):
+        """Move the state to a new release; returns the changed records (n = change in rows)"""
+        path = resolve_input(path)
+        print(f"Counting the records of {os.path.basename(path)}...")
+        new_records = encode_records(path, memory_budget_mb)
+        delta = diff_records(self.records, new_records)
+        print(f"{len(delta):,} of {len(new_records):,} distinct records changed "
+              f"(+{delta.loc[delta['n'] > 0, 'n'].sum():,} / -{-delta.loc[delta['n'] < 0, 'n'].sum():,} rows)")
+        self.counts.add(delta, weights=delta['n'].to_numpy())
+        self.records = new_records
+        self.meta = dict(input=os.path.abspath(path), input_sha256=input_hash(path, cube_root),
+                         updated_from=self.meta['input_sha256'])
+        return delta
+
+    def cube(self):
+        """CountCube of the current release, closed at its END_MEASURE"""
+        end_measure = self.end_measure()
+        return CountCube.build_from_counts(self.counts, end_measure, **self.meta)
+
+    # --- storage next to the cube ---
+
+    def save(self, cube_dir):
+        state_dir = os.path.join(cube_dir, STATE_DIR)
+        shutil.rmtree(state_dir, ignore_errors=True)
+        os.makedirs(state_dir)
+        np.save(os.path.join(state_dir, "records.npy"), self.records[RECORD_COLS].to_numpy(dtype=float))
+        np.save(os.path.join(state_dir, "record_counts.npy"), self.records['n'].to_numpy(dtype=np.int64))
+        for name, array in self.counts.grid.arrays.items():
+            np.save(os.path.join(state_dir, f"grid_{name}.npy"), array)
+        np.save(os.path.join(state_dir, "persons.npy"), self.counts.persons)
+        with open(os.path.join(state_dir, "state.json"), "w", encoding="utf-8") as f:
+            json.dump(dict(self.meta, bands=self.counts.bands), f, indent=1)
+
+    @classmethod
+    def load(cls, cube_dir):
+        state_dir = os.path.join(cube_dir, STATE_DIR)
+        if not os.path.exists(os.path.join(state_dir, "state.json")):
+            raise FileNotFoundError(f"No incremental state in {cube_dir}: run 'init' on that release first")
+        with open(os.path.join(state_dir, "state.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        counts = CubeCounts(meta.pop('bands'))
+        for name in counts.grid.arrays:
+            counts.grid.arrays[name] = np.load(os.path.join(state_dir, f"grid_{name}.npy"))
+        counts.grid.n_days = counts.grid.arrays['at_risk'].shape[1]
+        counts.persons = np.load(os.path.join(state_dir, "persons.npy"))
+        records = pd.DataFrame(np.load(os.path.join(state_dir, "records.npy")), columns=RECORD_COLS)
+        records['n'] = np.load(os.path.join(state_dir, "record_counts.npy"))
+        return cls(records, counts, meta)
+
+def init(path, cube_root=CUBE_ROOT, bands=TIME_SINCE_DOSE_BANDS, memory_budget_mb=MEMORY_BUDGET_MB):
+    """Build the cube and the incremental state of a release from scratch"""
+    path = resolve_input(path)
+    state = ReleaseState.build(path, bands, memory_budget_mb, cube_root)
+    cube_dir = cube_dir_for(path, cube_root)
+    state.cube().save(cube_dir)
+    state.save(cube_dir)
+    print(f"Count cube and incremental state saved to {cube_dir}")
+    return cube_dir
+
+def update(path, base, cube_root=CUBE_ROOT, memory_budget_mb=MEMORY_BUDGET_MB):
+    """
+    Cube of a new release from the state of an earlier one. base is the earlier release's CSV
+    or its cube folder. Returns the new cube folder.
+    """
+    path = resolve_input(path)
+    base_dir = base if os.path.isdir(base) else cube_dir_for(resolve_input(base), cube_root)
+    state = ReleaseState.load(base_dir)
+    state.update(path, memory_budget_mb, cube_root)
+    cube_dir = cube_dir_for(path, cube_root)
+    state.cube().save(cube_dir)
+    state.save(cube_dir)
+    print(f"Updated count cube saved to {cube_dir}")
+    return cube_dir
+
+def refit_poisson(cube):
+    """Refit the FZ Poisson model (deaths ~ vaccinated + age) from the cube's person-day table"""
+    from czechfoi.pipeline import load_script
+    fz = load_script('FZ')
+    result = fz.fit_poisson(cube.poisson_table())
+    conf = np.exp(result.conf_int())
+    irr = np.exp(result.params)
+    print(f"END_MEASURE {cube.end_measure}: IRR vaccinated vs unvaccinated {irr['vaccinated']:.3f} "
+          f"(95% CI: {conf.loc['vaccinated', 0]:.3f} - {conf.loc['vaccinated', 1]:.3f})")
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incrementally update the count cube for a new FOI release.")
+    parser.add_argument('command', choices=['init', 'update'])
+    parser.add_argument('input_csv', help="release to build ('init') or the new release ('update')")
+    parser.add_argument('--base', help="earlier release (CSV or cube folder) to update from")
+    parser.add_argument('--cube-root', default=CUBE_ROOT)
+    parser.add_argument('--memory-budget-mb', type=int, default=MEMORY_BUDGET_MB)
+    parser.add_argument('--refit', action='store_true', help="refit the Poisson model from the cube")
+    args = parser.parse_args(argv)
+
+    if args.command == 'init':
+        cube_dir = init(args.input_csv, args.cube_root, memory_budget_mb=args.memory_budget_mb)
+    else:
+        if not args.base:
+            parser.error("update needs --base")
+        cube_dir = update(args.input_csv, args.base, args.cube_root, args.memory_budget_mb)
+    if args.refit:
+        refit_poisson(CountCube.open(cube_dir))
+
+if __name__ == "__main__":
+    main()
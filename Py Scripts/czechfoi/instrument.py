@@ -0,0 +1,177 @@
+import contextlib
+import datetime
+import json
+import os
+import sys
+import time
+
+"""
+Per-stage timing and memory instrumentation for the analysis scripts and the pipeline runner.
+
+A RunRecord measures named stages (load, intervals, cox, ...) and stores for each one
+- wall time and CPU time in seconds,
+- peak RSS of the process after the stage and how much the stage raised it (MB),
+- the number of rows it produced (interval rows, person-day rows, ...), if set.
+
+run_log() replaces the per-script Tee logger: console output is duplicated into the TXT log
+through a buffered file, a stage summary is appended to the log and the record is saved as
+JSON next to it ('<log>.run.json'), so runs on AG70 and on all ages can be compared.
+
+Usage:
+    with run_log(OUTPUT_TXT, script="FW", input_csv=INPUT_CSV) as run:
+        with run.stage("intervals") as st:
+            tv_df = st.count(build_intervals(df, end))
+"""
+
+LOG_BUFFER_SIZE = 1 << 16   # Bytes buffered before the TXT log is written to disk
+
+try:
+    import resource
+except ImportError:         # Windows
+    resource = None
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, None if it cannot be determined."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KB, macOS bytes
+        return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss) / (1 << 20)
+
+def record_path(log_path):
+    """Path of the JSON run record that belongs to a TXT log."""
+    return os.path.splitext(log_path)[0] + ".run.json"
+
+class Tee:
+    """Duplicate writes to several streams; the streams flush on their own buffering."""
+    def __init__(self, *files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+@contextlib.contextmanager
+def tee_output(path, stderr=True):
+    """Duplicate stdout (and stderr) into a buffered log file for the duration of the block."""
+    if path is None:
+        yield
+        return
+    with open(path, "w", encoding="utf-8", buffering=LOG_BUFFER_SIZE) as log_file:
+        tee = Tee(sys.stdout, log_file)
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(contextlib.redirect_stdout(tee))
+            if stderr:
+                stack.enter_context(contextlib.redirect_stderr(tee))
+            yield
+
+class StageTimer:
+    """Measurements of one stage; set rows directly or through count()."""
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.wall_s = None
+        self.cpu_s = None
+        self.peak_rss_mb = None
+        self.rss_increase_mb = None
+
+    def count(self, result):
+        """Record len(result) as the row count and return result unchanged."""
+        self.rows = len(result)
+        return result
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'wall_s': self.wall_s,
+            'cpu_s': self.cpu_s,
+            'peak_rss_mb': self.peak_rss_mb,
+            'rss_increase_mb': self.rss_increase_mb,
+            'rows': self.rows,
+        }
+
+class RunRecord:
+    """Collects stage measurements of one run"""
+    def __init__(self, **meta):
+        self.meta = dict(meta)
+        self.meta.setdefault('started', datetime.datetime.now().isoformat(timespec='seconds'))
+        self.stages = []
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        timer = StageTimer(name)
+        rss_before = peak_rss_mb()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield timer
+        finally:
+            timer.wall_s = round(time.perf_counter() - wall_start, 3)
+            timer.cpu_s = round(time.process_time() - cpu_start, 3)
+            timer.peak_rss_mb = peak_rss_mb()
+            if timer.peak_rss_mb is not None:
+                timer.rss_increase_mb = round(timer.peak_rss_mb - rss_before, 1)
+                timer.peak_rss_mb = round(timer.peak_rss_mb, 1)
+            self.stages.append(timer)
+
+    def add(self, records):
+        """Append stage dicts measured elsewhere (e.g. in a worker process)."""
+        for record in records:
+            timer = StageTimer(record['stage'])
+            for key, value in record.items():
+                if key != 'stage':
+                    setattr(timer, key, value)
+            self.stages.append(timer)
+
+    def as_dict(self):
+        return {
+            **self.meta,
+            'total_wall_s': round(time.perf_counter() - self._wall_start, 3),
+            'total_cpu_s': round(time.process_time() - self._cpu_start, 3),
+            'peak_rss_mb': None if peak_rss_mb() is None else round(peak_rss_mb(), 1),
+            'stages': [timer.as_dict() for timer in self.stages],
+        }
+
+    def summary(self):
+        """Plain-text table of the stage measurements."""
+        def fmt(value, width, spec):
+            return f"{'-':>{width}}" if value is None else f"{value:>{width}{spec}}"
+
+        lines = [f"{'stage':28} {'wall s':>9} {'cpu s':>9} {'peak MB':>9} {'+MB':>8} {'rows':>12}"]
+        for t in self.stages:
+            lines.append(f"{t.name:28} {fmt(t.wall_s, 9, '.2f')} {fmt(t.cpu_s, 9, '.2f')} "
+                         f"{fmt(t.peak_rss_mb, 9, '.1f')} {fmt(t.rss_increase_mb, 8, '.1f')} {fmt(t.rows, 12, ',d')}")
+        return "\n".join(lines)
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.as_dict(), f, indent=1)
+
+@contextlib.contextmanager
+def run_log(log_path, stderr=True, **meta):
+    """
+    Tee the console into log_path and yield a RunRecord; on exit the stage summary is appended
+    to the log and the record is written to record_path(log_path), also when a stage fails.
+    """
+    run = RunRecord(**meta)
+    with tee_output(log_path, stderr=stderr):
+        try:
+            yield run
+            run.meta['status'] = 'completed'
+        except BaseException as exc:
+            run.meta['status'] = f'failed: {exc!r}'
+            raise
+        finally:
+            print("\n=== Run record ===")
+            print(run.summary())
+            run.write(record_path(log_path))
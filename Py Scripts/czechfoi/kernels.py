@@ -0,0 +1,228 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:          # optional: the NumPy versions are used instead
+    numba = None
+
+"""
+Per-person kernels of the interval builders and of FG's dose assignment, with an optional JIT backend.
+
+Each kernel exists twice with identical results:
+- a loop over persons (one pass to count the rows, one to fill them), compiled with numba when
+  it is installed; it needs no temporaries beyond the output arrays,
+- a NumPy version on (persons x doses) arrays, used without numba (and as the reference).
+
+USE_JIT selects the backend (default: numba if importable). The kernels return plain arrays;
+the scripts build their DataFrames from them:
+
+- lag_episodes:          unvaccinated / vaccinated interval per person, vaccinated from first dose + lag (FW, FS, FJ)
+- dose_episodes:         one interval per dose state, dose number of the latest dose column (FX)
+- dose_count_intervals:  one interval per dose in date order, numbered by doses received (FY)
+- first_eligible:        first candidate that dies after the last dose day (FG's constraint check)
+
+Dose days are passed per schedule (see czechfoi.schedules.ScheduleTable), sorted in date order
+with NaN last, together with the schedule ID of every person.
+
+Usage:
+    person, start, stop, event, vaccinated = kernels.lag_episodes(death_day, first_dose_day, end_day, lag_days)
+"""
+
+USE_JIT = numba is not None
+
+def _jit(func):
+    return numba.njit(cache=True)(func) if numba is not None else func
+
+def sort_schedules(days):
+    """Dose days of each schedule in date order (NaN last) and the dose numbers (column + 1) in that order"""
+    order = np.argsort(days, axis=1, kind='stable')
+    return np.take_along_axis(days, order, axis=1), order + 1
+
+# === Unvaccinated / vaccinated episodes with lag (FW, FS, FJ) ===
+
+@_jit
+def _lag_episodes_loop(death, first, end, lag, person, start, stop, event, state):
+    row = 0
+    for i in range(len(end)):
+        has_dose = not np.isnan(first[i])
+        vax_start = first[i] + lag
+        unvax_stop = min(end[i], vax_start) if has_dose else end[i]
+        person[row], start[row], stop[row] = i, 0.0, unvax_stop
+        event[row], state[row] = int(death[i] == unvax_stop), 0
+        row += 1
+        if has_dose and vax_start < end[i]:
+            person[row], start[row], stop[row] = i, vax_start, end[i]
+            event[row], state[row] = int(death[i] == end[i]), 1
+            row += 1
+
+def lag_episodes(death, first, end, lag):
+    """
+    Per person an unvaccinated interval [0, min(end, first + lag)] and, if the lagged first dose
+    comes before the end, a vaccinated interval [first + lag, end]. Returns (person index, start,
+    stop, event, vaccinated); event is a death at the interval's stop. death and first are NaN if missing.
+    """
+    death, first, end = (np.asarray(a, dtype=float) for a in (death, first, end))
+    vaccinated = ~np.isnan(first) & (first + lag < end)
+    rows = len(end) + int(vaccinated.sum())
+    if USE_JIT:
+        person, start, stop = np.empty(rows, np.int64), np.empty(rows), np.empty(rows)
+        event, state = np.empty(rows, np.int64), np.empty(rows, np.int64)
+        _lag_episodes_loop(death, first, end, float(lag), person, start, stop, event, state)
+        return person, start, stop, event, state
+
+    # Row of the unvaccinated interval of every person; its vaccinated interval follows it
+    first_row = np.arange(len(end)) + np.concatenate([[0], np.cumsum(vaccinated)[:-1]])
+    vax_start = first + lag
+    unvax_stop = np.where(np.isnan(first), end, np.fmin(end, vax_start))
+    person, start, stop = np.empty(rows, np.int64), np.zeros(rows), np.empty(rows)
+    event, state = np.empty(rows, np.int64), np.zeros(rows, np.int64)
+    person[first_row], stop[first_row], event[first_row] = np.arange(len(end)), unvax_stop, death == unvax_stop
+    vax_row = first_row[vaccinated] + 1
+    person[vax_row], start[vax_row], stop[vax_row] = np.flatnonzero(vaccinated), vax_start[vaccinated], end[vaccinated]
+    event[vax_row], state[vax_row] = death[vaccinated] == end[vaccinated], 1
+    return person, start, stop, event, state
+
+# === Episodes per dose state, numbered by dose column (FX) ===
+
+@_jit
+def _dose_episodes_loop(sorted_days, numbers, ids, death, end, lag, fill, person, start, stop, event, state):
+    row = 0
+    for i in range(len(ids)):
+        days, nums = sorted_days[ids[i]], numbers[ids[i]]
+        current_day, current_dose = 0.0, 0
+        for k in range(days.shape[0]):
+            if np.isnan(days[k]) or days[k] + lag >= end[i]:
+                break
+            day = days[k] + lag
+            if day > current_day:
+                if fill:
+                    person[row], start[row], stop[row] = i, current_day, day
+                    event[row], state[row] = int(death[i] == day), current_dose
+                row += 1
+            current_day, current_dose = day, nums[k]
+            if death[i] <= current_day:
+                break
+        if current_day < end[i]:
+            if fill:
+                person[row], start[row], stop[row] = i, current_day, end[i]
+                event[row], state[row] = int(death[i] == end[i]), current_dose
+            row += 1
+    return row
+
+def dose_episodes(sorted_days, numbers, ids, death, end, lag):
+    """
+    Consecutive intervals per person between the lagged dose days (before end): 0 -> first dose ->
+    next dose ... -> end, each with the dose number (column) of the latest dose, skipping empty
+    intervals. sorted_days/numbers per schedule as from sort_schedules(). death is inf if alive.
+    Returns (person index, start, stop, event, dose number).
+    """
+    death, end = np.asarray(death, dtype=float), np.asarray(end, dtype=float)
+    if USE_JIT:
+        empty_f, empty_i = np.empty(0), np.empty(0, np.int64)
+        rows = _dose_episodes_loop(sorted_days, numbers, ids, death, end, float(lag), False,
+                                   empty_i, empty_f, empty_f, empty_i, empty_i)
+        person, start, stop = np.empty(rows, np.int64), np.empty(rows), np.empty(rows)
+        event, state = np.empty(rows, np.int64), np.empty(rows, np.int64)
+        _dose_episodes_loop(sorted_days, numbers, ids, death, end, float(lag), True, person, start, stop, event, state)
+        return person, start, stop, event, state
+
+    days = sorted_days[ids] + lag
+    nums = numbers[ids]
+    n, n_doses = days.shape
+    with np.errstate(invalid='ignore'):
+        # A dose counts until the first dose at or after the end, or after the dose on/after death
+        valid = np.logical_and.accumulate(~np.isnan(days) & (days < end[:, None]), axis=1)
+        alive = np.logical_and.accumulate(death[:, None] > days, axis=1)
+    valid[:, 1:] &= alive[:, :-1]
+    n_valid = valid.sum(axis=1)
+
+    # Candidate k < n_doses ends at dose k; candidate n_doses ends at the end of follow-up
+    previous_day = np.hstack([np.zeros((n, 1)), days])
+    previous_num = np.hstack([np.zeros((n, 1), np.int64), nums])
+    starts, states = previous_day.copy(), previous_num.copy()
+    starts[:, n_doses] = previous_day[np.arange(n), n_valid]
+    states[:, n_doses] = previous_num[np.arange(n), n_valid]
+    stops = np.hstack([days, end[:, None]])
+    with np.errstate(invalid='ignore'):
+        emit = np.hstack([valid, np.ones((n, 1), bool)]) & (stops > starts)
+    person = np.broadcast_to(np.arange(n)[:, None], emit.shape)[emit]
+    return person, starts[emit], stops[emit], (death[:, None] == stops)[emit].astype(np.int64), states[emit]
+
+# === Intervals per dose in date order (FY) ===
+
+@_jit
+def _dose_count_intervals_loop(sorted_days, n_doses, ids, death, end, lag, fill, person, start, stop, event, state):
+    row = 0
+    for i in range(len(ids)):
+        days = sorted_days[ids[i]]
+        last_start = 0.0
+        for k in range(n_doses[ids[i]]):
+            day = days[k] + lag
+            if day > end[i]:
+                break
+            if fill:
+                person[row], start[row], stop[row] = i, last_start, day
+                event[row], state[row] = int(death[i] == day), k
+            row += 1
+            last_start = day
+        if last_start < end[i]:
+            if fill:
+                person[row], start[row], stop[row] = i, last_start, end[i]
+                event[row], state[row] = int(death[i] == end[i]), n_doses[ids[i]]
+            row += 1
+    return row
+
+def dose_count_intervals(sorted_days, n_doses, ids, death, end, lag):
+    """
+    One interval per lagged dose day up to the end (empty ones kept), numbered by the doses received
+    before it, and a last interval to the end numbered by the person's total number of doses.
+    Returns (person index, start, stop, event, dose count).
+    """
+    death, end = np.asarray(death, dtype=float), np.asarray(end, dtype=float)
+    if USE_JIT:
+        empty_f, empty_i = np.empty(0), np.empty(0, np.int64)
+        rows = _dose_count_intervals_loop(sorted_days, n_doses, ids, death, end, float(lag), False,
+                                          empty_i, empty_f, empty_f, empty_i, empty_i)
+        person, start, stop = np.empty(rows, np.int64), np.empty(rows), np.empty(rows)
+        event, state = np.empty(rows, np.int64), np.empty(rows, np.int64)
+        _dose_count_intervals_loop(sorted_days, n_doses, ids, death, end, float(lag), True,
+                                   person, start, stop, event, state)
+        return person, start, stop, event, state
+
+    days = sorted_days[ids] + lag
+    n, width = days.shape
+    with np.errstate(invalid='ignore'):
+        valid = np.logical_and.accumulate(~np.isnan(days) & (days <= end[:, None]), axis=1)
+    n_valid = valid.sum(axis=1)
+    starts = np.hstack([np.zeros((n, 1)), days])
+    last_start = starts[np.arange(n), n_valid]
+    starts[:, width] = last_start
+    stops = np.hstack([days, end[:, None]])
+    states = np.broadcast_to(np.arange(width + 1), (n, width + 1)).copy()
+    states[:, width] = n_doses[ids]
+    emit = np.hstack([valid, (last_start < end)[:, None]])
+    person = np.broadcast_to(np.arange(n)[:, None], emit.shape)[emit]
+    return person, starts[emit], stops[emit], (death[:, None] == stops)[emit].astype(np.int64), states[emit]
+
+# === FG constraint check ===
+
+@_jit
+def _first_eligible_loop(candidates, death_day, last_dose_day):
+    for position in candidates:
+        if np.isnan(death_day[position]) or death_day[position] > last_dose_day:
+            return position
+    return -1
+
+FIRST_BLOCK = 16            # Candidates checked before the rest of the pool (usually the first one fits)
+
+def first_eligible(candidates, death_day, last_dose_day):
+    """First candidate position whose death day is after last_dose_day (or who does not die), -1 if none"""
+    if USE_JIT:
+        return int(_first_eligible_loop(candidates, death_day, last_dose_day))
+    for block in (candidates[:FIRST_BLOCK], candidates[FIRST_BLOCK:]):
+        deaths = death_day[block]
+        with np.errstate(invalid='ignore'):
+            ok = np.isnan(deaths) | (deaths > last_dose_day)
+        if ok.any():
+            return int(block[np.argmax(ok)])
+    return -1
@@ -0,0 +1,188 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from czechfoi.data import MAX_AGE, DOSE_DAY_COLS
+from czechfoi.chunked import DayGrid, MEMORY_BUDGET_MB, reduce_csv
+from czechfoi import figures
+
+"""
+Multi-state dose-transition model: Aalen-Johansen state occupancy over calendar time.
+
+FX and FY use the dose number as a covariate; here it is the state. Every person starts
+unvaccinated on day 0 and moves to 'dose k' with the k-th dose (in date order) and to 'dead' on
+the death day:
+
+    unvaccinated -> dose 1 -> dose 2 -> ... -> dose 7
+         \\             \\         \\              \\
+          +------------> dead <----+-------------+
+
+Several doses on the same day are one jump (e.g. unvaccinated -> dose 2). Within a day the dose
+transitions come first and deaths second, as in the count cube (a death counts in the state of
+that day). Doses after the death day are ignored.
+
+TransitionCounts adds each chunk into per-age/day counts of every transition (j -> k). The
+Aalen-Johansen estimator is the product over days of (I + dA(day)), with dA_jk = N_jk / Y_j
+(transitions over persons in state j at the start of the step). It is evaluated for all ages at
+once, one dose step and one death step per day. Everyone is followed until END_MEASURE, so the
+estimate equals the share of the age group in each state; the product form also holds for
+left-truncated or censored subsets.
+
+Usage (from the 'Py Scripts' folder):
+    counts = TransitionCounts()
+    end = reduce_csv(INPUT_CSV, [counts])
+    occupancy = counts.aalen_johansen(end)              # one row per age and day, one column per state
+
+    python -m czechfoi.multistate REAL_CSV --sim SIM_CSV --age 70 --output-html dose_states.html
+"""
+
+N_DOSES = len(DOSE_DAY_COLS)
+STATES = ['unvaccinated'] + [f'dose_{k}' for k in range(1, N_DOSES + 1)] + ['dead']
+DEAD = len(STATES) - 1
+DOSE_TRANSITIONS = [(j, k) for j in range(N_DOSES) for k in range(j + 1, N_DOSES + 1)]
+DEATH_TRANSITIONS = [(j, DEAD) for j in range(N_DOSES + 1)]
+
+class TransitionCounts:
+    """Per-age/day counts of every dose transition (j -> k) and death (j -> dead)"""
+    def __init__(self):
+        self.grid = DayGrid(DOSE_TRANSITIONS + DEATH_TRANSITIONS)
+        self.persons = np.zeros(MAX_AGE + 1, dtype=np.int64)
+
+    def add(self, chunk):
+        ages = chunk['age'].to_numpy(dtype=np.int64)
+        death = chunk['death_day'].to_numpy(dtype=float)
+        stop = np.where(np.isnan(death), np.inf, death)
+        # Doses in date order (NaN last); doses before day 0 count as given on day 0
+        doses = np.sort(np.maximum(chunk[DOSE_DAY_COLS].to_numpy(dtype=float), 0), axis=1)
+        doses[doses > stop[:, None]] = np.nan
+        self.persons += np.bincount(ages, minlength=MAX_AGE + 1)
+
+        # The last dose of every dose day is the jump from the doses before that day
+        n_before = np.zeros(len(ages), dtype=np.int64)
+        for k in range(N_DOSES):
+            day = doses[:, k]
+            next_day = doses[:, k + 1] if k + 1 < N_DOSES else np.full(len(ages), np.nan)
+            jump = ~np.isnan(day) & (next_day != day)
+            for j in np.unique(n_before[jump]):
+                rows = jump & (n_before == j)
+                self.grid.add_points((j, k + 1), ages[rows], day[rows])
+            n_before[jump] = k + 1
+
+        # Deaths from the state after the doses of the day
+        dead = ~np.isnan(death)
+        for j in np.unique(n_before[dead]):
+            rows = dead & (n_before == j)
+            self.grid.add_points((j, DEAD), ages[rows], death[rows])
+
+    def transitions(self, end_measure, ages=None):
+        """(ages, flows): flows[step][transition] is an (n_ages, n_days) array of transition counts"""
+        age_list = np.flatnonzero(self.persons)
+        if ages is not None:
+            age_list = age_list[(age_list >= ages[0]) & (age_list <= ages[1])]
+        flows = [np.stack([self.grid.counts(pair, end_measure)[age_list] for pair in pairs]).astype(float)
+                 for pairs in (DOSE_TRANSITIONS, DEATH_TRANSITIONS)]
+        return age_list, flows
+
+    def aalen_johansen(self, end_measure, ages=None, pooled=False):
+        """
+        State occupancy probabilities per age (or of the pooled ages) and day: a DataFrame with
+        'age' ('pooled'), 'day', one column per state and the persons at risk per state ('n_<state>').
+        """
+        age_list, flows = self.transitions(end_measure, ages)
+        persons = self.persons[age_list].astype(float)
+        if pooled:
+            flows = [flow.sum(axis=1, keepdims=True) for flow in flows]
+            persons = persons.sum(keepdims=True)
+        n_groups, n_days = len(persons), end_measure + 1
+
+        # Row p of 'moves' takes one unit out of the from-state and into the to-state of transition p
+        moves = []
+        for pairs in (DOSE_TRANSITIONS, DEATH_TRANSITIONS):
+            move = np.zeros((len(pairs), len(STATES)))
+            move[np.arange(len(pairs)), [j for j, _ in pairs]] = -1
+            move[np.arange(len(pairs)), [k for _, k in pairs]] = 1
+            moves.append(move)
+        sources = [np.array([j for j, _ in pairs]) for pairs in (DOSE_TRANSITIONS, DEATH_TRANSITIONS)]
+
+        probability = np.zeros((n_groups, len(STATES)))
+        probability[:, 0] = 1.0
+        at_risk = np.zeros((n_groups, len(STATES)))
+        at_risk[:, 0] = persons
+        occupancy = np.empty((n_groups, n_days, len(STATES)))
+        at_risk_by_day = np.empty((n_groups, n_days, len(STATES)))
+        for day in range(n_days):
+            for flow, move, source in zip(flows, moves, sources):
+                counts = flow[:, :, day].T                                   # (groups, transitions)
+                y = at_risk[:, source]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    hazard = np.where(y > 0, counts / y, 0.0)               # dA_jk
+                probability = probability + (probability[:, source] * hazard) @ move
+                at_risk = at_risk + counts @ move
+            occupancy[:, day] = probability
+            at_risk_by_day[:, day] = at_risk
+
+        result = pd.DataFrame({
+            'age': np.repeat(['pooled'] if pooled else age_list, n_days),
+            'day': np.tile(np.arange(n_days), n_groups),
+        })
+        for s, state in enumerate(STATES):
+            result[state] = occupancy[:, :, s].ravel()
+        for s, state in enumerate(STATES):
+            result[f'n_{state}'] = at_risk_by_day[:, :, s].ravel().astype(np.int64)
+        return result
+
+def aalen_johansen_csv(path, ages=None, pooled=False, memory_budget_mb=MEMORY_BUDGET_MB):
+    """Streamed TransitionCounts of an input file and its state occupancy"""
+    counts = TransitionCounts()
+    end_measure = reduce_csv(path, [counts], memory_budget_mb)
+    return counts.aalen_johansen(end_measure, ages, pooled)
+
+def plot(curves, output_html, title="Aalen-Johansen State Occupancy (Dose States and Death)"):
+    """One line per state, solid for the first dataset and dashed for the others ({label: occupancy frame})"""
+    import plotly.graph_objects as go
+    import plotly.colors
+    palette = plotly.colors.qualitative.Plotly
+    fig = go.Figure()
+    for n, (label, frame) in enumerate(curves.items()):
+        for age, curve in frame.groupby('age', sort=False):
+            for s, state in enumerate(STATES):
+                fig.add_trace(go.Scatter(x=curve['day'], y=curve[state], mode='lines',
+                                         name=f"{label} AG{age} {state}", legendgroup=state,
+                                         line=dict(width=1.2, color=palette[s % len(palette)],
+                                                   dash='solid' if n == 0 else 'dash')))
+    fig.update_layout(title=title, xaxis_title="Days since Jan 1, 2020",
+                      yaxis=dict(title="Probability of being in state", range=[0, 1]),
+                      template='plotly_white', hovermode='x unified')
+    figures.write_html(fig, output_html)
+    print(f"Plot saved to {output_html}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Aalen-Johansen occupancy of the dose states and death.")
+    parser.add_argument('input_csv', help="real data")
+    parser.add_argument('--sim', help="simulated data (FG) to plot next to the real data")
+    parser.add_argument('--age', nargs='+', type=int, help="age or first and last age (default: all)")
+    parser.add_argument('--pooled', action='store_true', help="one estimate for all selected ages together")
+    parser.add_argument('--memory-budget-mb', type=int, default=MEMORY_BUDGET_MB)
+    parser.add_argument('--output-csv', help="CSV file for the occupancy of all datasets and ages")
+    parser.add_argument('--output-html', help="Plotly HTML file of the occupancy curves")
+    args = parser.parse_args(argv)
+
+    ages = (args.age[0], args.age[-1]) if args.age else None
+    inputs = {'real': args.input_csv}
+    if args.sim:
+        inputs['sim'] = args.sim
+    curves = {label: aalen_johansen_csv(path, ages, args.pooled, args.memory_budget_mb)
+              for label, path in inputs.items()}
+    if args.output_csv:
+        pd.concat([frame.assign(dataset=label) for label, frame in curves.items()]).to_csv(args.output_csv, index=False)
+        print(f"Occupancy saved to {args.output_csv}")
+    if args.output_html:
+        plot(curves, args.output_html)
+    if not args.output_csv and not args.output_html:
+        for label, frame in curves.items():
+            print(label)
+            print(frame.groupby('age').tail(1)[['age', 'day'] + STATES].to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,672 @@
+import argparse
+import ast
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import pickle
+
+import pandas as pd
+
+from czechfoi import chunked, cohort, collapse, data, estimate, figures, scheduler
+from czechfoi.cube import HASH_MEMO, file_hash
+from czechfoi.instrument import RunRecord, tee_output
+
+"""
+Declarative pipeline runner with content-hashed stage caching.
+
+The analysis scripts (FG, CA, FS, FW, FX, FY, FZ, FP, ZI, FJ) are described as a DAG of stages
+(load -> derive -> intervals -> collapse -> fit -> report/plot) for the real Czech FOI data and the
+FG simulated data. Each stage result is cached on disk under a key built from
+- the keys of the upstream stages,
+- the content hashes of the input files the stage reads,
+- the stage parameters,
+- the source of the stage function's module (an analysis script or a czechfoi module),
+- the sources of the czechfoi package, whose helpers (kernels, collapse, cohort, ...) the stages call,
+so only stages whose key changed are recomputed. Changing a plot title only reruns the plot stage;
+changing LAG_DAYS reruns the intervals and everything downstream of them. Editing a script reruns
+its stages, editing a czechfoi module reruns all stages.
+
+Usage (from the 'Py Scripts' folder):
+    python -m czechfoi.pipeline                                  # all analyses, real + simulated data
+    python -m czechfoi.pipeline --analyses FW FZ --datasets real
+    python -m czechfoi.pipeline --param lag_days=14 --param "FW.title=My title"
+    python -m czechfoi.pipeline --list                           # show stages and cache state
+    python -m czechfoi.pipeline --jobs 4                         # batch mode, analyses in parallel
+    python -m czechfoi.pipeline --jobs 0 --cpus 8                # all of an 8-core budget, BLAS threads included
+    python -m czechfoi.pipeline --load-workers 0                 # parse the input CSVs on all cores
+    python -m czechfoi.pipeline --preview 0.05                   # quick run on a weighted 5% sample
+    python -m czechfoi.pipeline --dry-run                        # predicted rows / peak memory per stage
+    python -m czechfoi.pipeline --memory-limit-mb 8000           # FZ/FP/ZI out of core if they would not fit
+    python -m czechfoi.pipeline --slim-html --report             # shared plotly.js, one report of all figures
+
+Batch mode (--jobs N) loads and derives each input once in the main process and then runs the
+independent analysis branches (e.g. FW on real data, FZ on simulated data, FJ) in N worker
+processes. Workers started with fork share the derived data in memory; otherwise they read the
+cached derive stage instead of parsing the CSV again. The workers come from czechfoi.scheduler:
+--cpus caps the jobs, the parse workers and their BLAS threads together, and the branches are packed
+by their predicted memory (czechfoi.estimate) into the memory budget (--memory-limit-mb, default
+80% of RAM), so the heaviest branches, e.g. FJ, do not run side by side.
+
+The derive stage returns a czechfoi.cohort.Cohort: the age selections of CA, FW and FY are views of
+it, and columns such as end_day are derived once and reused by every analysis in the same process.
+
+Preview mode (--preview FRACTION) inserts a 'preview' stage after each derive stage that keeps a
+deterministic stratified sample with sampling weights (see czechfoi.data.preview_sample). All
+analyses run unchanged on it with the weights honoured; output files get a ' PREVIEW' suffix and
+plot titles a 'PREVIEW' prefix, so they never overwrite or pass for the full results.
+
+Dry run (--dry-run) and memory limit (--memory-limit-mb): before anything is loaded, each input is
+summarized in one streamed pass and the rows and peak memory of the large stages are predicted
+(see czechfoi.estimate). With a limit, FZ, FP and ZI analyses predicted to exceed it are built in
+their out-of-core form (chunked counts instead of person-day rows or per-day loops); if another
+analysis would exceed it, the run stops before it starts.
+
+Slim HTML (--slim-html) writes every figure with one shared plotly.js in the results folder and
+compact trace data (see czechfoi.figures); --report adds a final stage that collects all figures of
+the run into one page. Curves are thinned before plotting unless --full-curves is given. The
+HTML mode and the curve compression are part of the key of the stages that write HTML.
+
+Wall time, CPU time, peak RSS and row counts of every stage that ran are printed at the end and
+written to <cache dir>/run-record.json (see czechfoi.instrument).
+"""
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT_DIR = os.path.dirname(SCRIPTS_DIR)
+
+DATA_DIR = os.path.join(ROOT_DIR, "Terra")
+RESULTS_DIR = os.path.join(ROOT_DIR, "Plot Results")
+CACHE_DIR = os.path.join(ROOT_DIR, ".pipeline_cache")
+
+REAL_CSV = "Vesely_106_202403141131_AG70.csv"
+SIM_CSV = "FG) case3_sim_deaths_sim_real_doses_with_constraint.csv"
+
+# Datasets: input file name and the stem used in the output file names
+DATASETS = {
+    'real': dict(csv=REAL_CSV, stem="Vesely_106_202403141131_AG70"),
+    'sim': dict(csv=SIM_CSV, stem="case3_sim_deaths_sim_real_doses_with_constraint AG70"),
+}
+
+ANALYSES = ['FG', 'CA', 'FS', 'FW', 'FX', 'FY', 'FZ', 'FP', 'ZI', 'FJ']
+FINAL_GROUPS = ('html',)    # Stages that run after all analyses, also in batch mode (the report)
+REPORT_NAME = "CzechFOI report"
+REPORT_TITLE = "CzechFOI analyses: real vs FG simulated data"
+
+# Script file, result folder and output base names (real data, simulated data) per analysis
+SCRIPTS = {
+    'FG': dict(script="FG) simulate deaths doses curves.py"),
+    'CA': dict(script="CA) KM vx uvx.py", folder="CA) KM vx uvx",
+               real="CA) real data {stem}", sim="CA-FG) {stem}"),
+    'FS': dict(script="FS) TTE.py", folder="FS) TTE",
+               real="FS) {stem} TTE", sim="FS-FG) {stem} TTE"),
+    'FW': dict(script="FW) cox time-varying.py", folder="FW) cox time-varying",
+               real="FW) {stem} cox time-varying", sim="FW-FG) {stem} cox time-varying"),
+    'FX': dict(script="FX) TTE Per Dose.py", folder="FX) TTE per Dose",
+               real="FX) {stem} TTE", sim="FX-FG) {stem} TTE"),
+    'FY': dict(script="FY) cox time-varying per dose.py", folder="FY) cox time-varying per Dose",
+               real="FY) real data {stem} cox time-varying per dose", sim="FY-FG) {stem} cox time-varying per dose"),
+    'FZ': dict(script="FZ) poisson.py", folder="FZ) poisson",
+               real="FZ) real data {stem} poisson", sim="FZ-FG) {stem} poisson"),
+    'FP': dict(script="FP) poisson speedup.py", folder="FP) poisson speedup",
+               real="FP) real data {stem} poisson", sim="FP-FG) {stem} poisson"),
+    'ZI': dict(script="ZI) vx uvx norm.py", folder="ZI) vx uvx norm",
+               real="ZI) real data {stem}", sim="ZI-FG) {stem}"),
+    'FJ': dict(script="FJ) plot_death_rate_diff_age70_sim_vs_real.py",
+               folder="FJ) bias vs observed vs adjusted KM death rate"),
+}
+
+_scripts = {}
+
+def load_script(code):
+    """Import an analysis script by file path (the file names are not valid module names)."""
+    if code not in _scripts:
+        path = os.path.join(SCRIPTS_DIR, SCRIPTS[code]['script'])
+        spec = importlib.util.spec_from_file_location(f"czechfoi_script_{code}", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _scripts[code] = module
+    return _scripts[code]
+
+# === Stages ===
+
+class Stage:
+    """
+    One node of the pipeline DAG.
+
+    func is called as func(*values of deps, **params). Stages listed in 'after' only have to run
+    first (e.g. FG writing the file a load stage reads) and are part of the key, but their value
+    is not passed. 'outputs' are files written by the stage; the stage reruns if any is missing.
+    'log' duplicates stdout to a TXT file while the stage runs. Stages with cache=False (large
+    intermediate tables) are kept in memory only and computed when a downstream stage needs them.
+    """
+    def __init__(self, name, func, deps=(), params=None, after=(), inputs=(), outputs=(), log=None, cache=True):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.params = dict(params or {})
+        self.after = list(after)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.log = log
+        self.cache = cache
+
+    @property
+    def group(self):
+        return self.name.split(':')[0]
+
+def _hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+_source_hashes = {}
+
+def source_hash(path):
+    """Hash of a source file, read once per process"""
+    if path not in _source_hashes:
+        with open(path, "rb") as f:
+            _source_hashes[path] = hashlib.sha256(f.read()).hexdigest()
+    return _source_hashes[path]
+
+def package_hash():
+    """Hash of all czechfoi module sources: a change in any shared helper invalidates the cached stages"""
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    names = sorted(name for name in os.listdir(package_dir) if name.endswith(".py"))
+    return _hash_text("".join(name + source_hash(os.path.join(package_dir, name)) for name in names))
+
+def code_hash(func):
+    """Hash of the code a stage runs: its function's module file and the czechfoi package"""
+    try:
+        own = source_hash(inspect.getsourcefile(func))
+    except (OSError, TypeError):
+        own = _hash_text(f"{func.__module__}.{func.__qualname__}")
+    return _hash_text(own + package_hash())
+
+def batch_group(name):
+    """
+    Independent branch a stage belongs to in batch mode: 'FW:real', 'ZI:sim', 'FJ', ...
+    Shared stages (FG simulation, loading, derivation, preview sample) and the final report return None.
+    """
+    parts = name.split(':')
+    if parts[0] in ('FG', 'load', 'derive', 'preview') + FINAL_GROUPS:
+        return None
+    if parts[0] == 'FJ':
+        return 'FJ'
+    return ':'.join(parts[:2])
+
+# Values of the shared stages, inherited by forked batch workers
+_shared_values = {}
+
+class Pipeline:
+    """
+    Runs stages in dependency order. force is True (rerun everything) or a set of stage names to rerun.
+    spec holds the build_stages arguments and parameter overrides, so batch workers can rebuild the DAG.
+    """
+    def __init__(self, stages, cache_dir=CACHE_DIR, force=False, spec=None):
+        self.stages = {}
+        for stage in stages:
+            self.stages[stage.name] = stage
+        self.cache_dir = cache_dir
+        self.force = force
+        self.spec = spec
+        self.keys = {}
+        self.values = {}
+        self.record = RunRecord()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._file_hash_path = os.path.join(cache_dir, HASH_MEMO)
+
+    # --- keys ---
+
+    def file_hash(self, path):
+        """Content hash of a file, re-hashed only when its size or modification time changes."""
+        return file_hash(path, self._file_hash_path)
+
+    def stage_key(self, stage):
+        description = {
+            'stage': stage.name,
+            'code': code_hash(stage.func),
+            'params': stage.params,
+            'deps': [self.keys[name] for name in stage.deps + stage.after],
+            'inputs': [self.file_hash(path) for path in stage.inputs],
+        }
+        if any(path.endswith('.html') for path in stage.outputs):
+            description['html'] = figures.settings()
+        return _hash_text(json.dumps(description, sort_keys=True, default=repr))
+
+    def _cache_path(self, stage, key):
+        safe = stage.name.replace(':', '-')
+        return os.path.join(self.cache_dir, f"{safe}-{key[:16]}.pkl")
+
+    def is_cached(self, stage, key):
+        if self.force is True or (self.force and stage.name in self.force) or not stage.cache:
+            return False
+        return os.path.exists(self._cache_path(stage, key)) and all(os.path.exists(p) for p in stage.outputs)
+
+    # --- execution ---
+
+    def order(self, targets=None):
+        """Stages in topological order, restricted to the targets and their upstream stages."""
+        names = list(self.stages) if targets is None else list(targets)
+        ordered, seen = [], set()
+
+        def visit(name, path=()):
+            if name in seen:
+                return
+            if name in path:
+                raise ValueError(f"Cycle in pipeline at stage {name}")
+            stage = self.stages[name]
+            for dep in stage.deps + stage.after:
+                visit(dep, path + (name,))
+            seen.add(name)
+            ordered.append(name)
+
+        for name in names:
+            visit(name)
+        return ordered
+
+    def value(self, name):
+        if name not in self.values:
+            stage = self.stages[name]
+            key = self.keys[name]
+            if self.is_cached(stage, key):
+                with open(self._cache_path(stage, key), "rb") as f:
+                    self.values[name] = pickle.load(f)
+            else:
+                self.execute(stage, key)
+        return self.values[name]
+
+    def execute(self, stage, key):
+        args = [self.value(dep) for dep in stage.deps]
+        for path in stage.outputs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        print(f"[run]    {stage.name}")
+        with self.record.stage(stage.name) as timer, tee_output(stage.log):
+            result = stage.func(*args, **stage.params)
+            if hasattr(result, 'shape'):
+                timer.rows = result.shape[0]
+        self.values[stage.name] = result
+        if stage.cache:
+            with open(self._cache_path(stage, key), "wb") as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return result
+
+    def run(self, targets=None, jobs=1, branch_memory=None):
+        """
+        Run the targets (default: all stages), recomputing only invalidated stages.
+        With jobs > 1 the independent analysis branches run in parallel worker processes, packed by
+        branch_memory ({branch: predicted MB}, see batch_memory) into the scheduler's memory budget.
+        """
+        names = self.order(targets)
+        if jobs > 1 and self.spec is not None:
+            final = [name for name in names if name.split(':')[0] in FINAL_GROUPS]
+            shared = [name for name in names if batch_group(name) is None and name not in final]
+            self._run_stages(shared)
+            groups = {}
+            for name in names:
+                if batch_group(name) is not None:
+                    groups.setdefault(batch_group(name), []).append(name)
+            self._run_batch(groups, shared, jobs, branch_memory or {})
+            # The report needs the keys of the branches that ran in the workers
+            for name in names:
+                self.keys.setdefault(name, self.stage_key(self.stages[name]))
+            self._run_stages(final)
+        else:
+            self._run_stages(names)
+
+    def _run_stages(self, names):
+        for name in names:
+            stage = self.stages[name]
+            key = self.keys[name] = self.stage_key(stage)
+            if name in self.values:
+                continue
+            if self.is_cached(stage, key):
+                print(f"[cached] {name}")
+            elif stage.cache:
+                self.value(name)
+
+    def _run_batch(self, groups, shared, jobs, branch_memory):
+        # Hold the derived cohorts in memory once, so forked workers share them instead of
+        # unpickling their own copy; spawned workers fall back to the stage cache
+        _shared_values.clear()
+        for name in shared:
+            if name.startswith(('derive:', 'preview:')):
+                _shared_values[name] = self.value(name)
+
+        force = self.force if self.force is True else set(self.force or ())
+        errors = []
+        tasks = [scheduler.Task(group, _run_batch_group, (self.spec, self.cache_dir, force, group_names, shared),
+                                memory_mb=branch_memory.get(group, 0))
+                 for group, group_names in groups.items()]
+        for task, future in scheduler.run_packed(tasks, workers=jobs):
+            try:
+                self.record.add(future.result())
+                print(f"[done]   {task.name}")
+            except Exception as exc:
+                errors.append(f"{task.name}: {exc!r}")
+        _shared_values.clear()
+        if errors:
+            raise RuntimeError("Batch stages failed:\n" + "\n".join(errors))
+
+    def status(self, targets=None):
+        for name in self.order(targets):
+            stage = self.stages[name]
+            key = self.keys[name] = self.stage_key(stage)
+            state = "cached" if self.is_cached(stage, key) else ("memory" if not stage.cache else "stale")
+            deps = ", ".join(stage.deps + stage.after)
+            print(f"{state:7} {name:28} <- {deps}")
+
+def _run_batch_group(spec, cache_dir, force, names, shared):
+    """Batch worker: rebuild the DAG and run one analysis branch."""
+    figures.configure(**spec['html'])
+    stages = build_stages(**spec['build'])
+    apply_params(stages, spec['params'])
+    force = set(names) if force is True else set(force) - set(shared)
+    pipeline = Pipeline(stages, cache_dir=cache_dir, force=force)
+    pipeline.values.update(_shared_values)
+    # The shared stages already ran in the main process: only their keys are needed here
+    for name in pipeline.order(names):
+        if batch_group(name) is None:
+            pipeline.keys[name] = pipeline.stage_key(pipeline.stages[name])
+    pipeline._run_stages(names)
+    return [timer.as_dict() for timer in pipeline.record.stages]
+
+# === DAG description ===
+
+def pick(value, index):
+    """Element of a tuple-valued stage (e.g. END_MEASURE of chunked.poisson_inputs)"""
+    return value[index]
+
+def build_stages(datasets=('real', 'sim'), analyses=ANALYSES, data_dir=DATA_DIR, results_dir=RESULTS_DIR,
+                 preview=None, chunked_runs=(), report=None):
+    """
+    Describe the stages of the selected analyses on the selected datasets.
+    With preview (a fraction), the analyses read a weighted stratified sample of each dataset.
+    chunked_runs lists FZ/FP/ZI runs ('FZ:real', ...) built from streamed counts instead of the cohort.
+    report (an HTML path, or True for one in results_dir) adds a final page with all figures.
+    """
+    stages = []
+    real_csv = data.resolve_input(os.path.join(data_dir, DATASETS['real']['csv']))
+    sim_csv = os.path.join(data_dir, DATASETS['sim']['csv'])
+    needs_sim = 'sim' in datasets or 'FG' in analyses or 'FJ' in analyses
+    csv_of = {'real': real_csv, 'sim': sim_csv}
+    after_of = {'real': [], 'sim': ['FG:simulate']}
+
+    def add(*args, **kwargs):
+        stage = Stage(*args, **kwargs)
+        stages.append(stage)
+        return stage
+
+    # FG simulated dataset (input for the 'sim' runs and FJ)
+    if needs_sim:
+        fg = load_script('FG')
+        add('FG:simulate', fg.run_all_cases, params=dict(input_csv=real_csv, output_folder=data_dir),
+            inputs=[real_csv], outputs=[sim_csv])
+
+    # Shared loading and derivation per dataset (not needed if all its analyses stream the input)
+    in_memory = [code for code in analyses if code != 'FG']
+    used = {ds for ds in datasets if any(f'{code}:{ds}' not in chunked_runs for code in in_memory)}
+    used |= {'real', 'sim'} if 'FJ' in analyses else set()
+    for ds in used:
+        csv = csv_of[ds]
+        add(f'load:{ds}', data.load_csv, params=dict(path=csv), inputs=[csv], after=after_of[ds])
+        add(f'derive:{ds}', cohort.derive, deps=[f'load:{ds}'],
+            params=dict(max_age=data.MAX_AGE, reference_year=data.REFERENCE_YEAR, start_date=data.START_DATE))
+        if preview:
+            add(f'preview:{ds}', cohort.preview_sample, deps=[f'derive:{ds}'],
+                params=dict(fraction=preview, seed=data.PREVIEW_SEED, min_per_stratum=data.PREVIEW_MIN_PER_STRATUM))
+
+    def cohort_of(ds):
+        return f'preview:{ds}' if preview else f'derive:{ds}'
+
+    # Preview outputs are labelled in the file name and the title
+    tag = " PREVIEW" if preview else ""
+
+    def titled(title):
+        return f"PREVIEW ({preview:g} weighted sample): {title}" if preview else title
+
+    def out(code, ds, suffix):
+        info = SCRIPTS[code]
+        base = info[ds].format(stem=DATASETS[ds]['stem'])
+        return os.path.join(results_dir, info['folder'], base + tag + suffix)
+
+    for ds in datasets:
+        derived = cohort_of(ds)
+
+        if 'CA' in analyses:
+            ca = load_script('CA')
+            add(f'CA:{ds}:cohort', ca.select_ages, deps=[derived], params=dict(ages=ca.AGE_SELECTED), cache=False)
+            add(f'CA:{ds}:km', ca.fit_km_groups, deps=[f'CA:{ds}:cohort'])
+            html = out('CA', ds, ".html")
+            add(f'CA:{ds}:plot', ca.plot_km, deps=[f'CA:{ds}:km'], outputs=[html],
+                params=dict(output_html=html, input_filename=DATASETS[ds]['csv'], ages=ca.AGE_SELECTED,
+                            title=titled(ca.TITLE_TEMPLATE) if preview else None))
+
+        for code, builder, lag_param, km in (('FS', 'build_tte', 'immunity_lag', 'fit_km'),
+                                             ('FX', 'build_tte', 'immunity_lag', 'fit_km_by_dose'),
+                                             ('FW', 'build_intervals', 'lag_days', 'fit_km'),
+                                             ('FY', 'build_intervals', 'lag_days', 'fit_km_by_dose')):
+            if code not in analyses:
+                continue
+            script = load_script(code)
+            selected = derived
+            if hasattr(script, 'select_age'):
+                selected = f'{code}:{ds}:cohort'
+                add(selected, script.select_age, deps=[derived], params=dict(age=script.AGE), cache=False)
+            lag = script.IMMUNITY_LAG if lag_param == 'immunity_lag' else script.LAG_DAYS
+            add(f'{code}:{ds}:end', cohort.end_measure, deps=[selected])
+            # With COLLAPSE only the (much smaller) weighted table is cached, not the full intervals
+            fit_input = f'{code}:{ds}:intervals'
+            add(fit_input, getattr(script, builder), deps=[selected, f'{code}:{ds}:end'],
+                params={lag_param: lag}, cache=not script.COLLAPSE)
+            if script.COLLAPSE:
+                add(f'{code}:{ds}:collapse', collapse.collapse_intervals, deps=[fit_input])
+                fit_input = f'{code}:{ds}:collapse'
+            add(f'{code}:{ds}:cox', script.fit_cox, deps=[fit_input])
+            add(f'{code}:{ds}:km', getattr(script, km), deps=[fit_input])
+            html, txt = out(code, ds, ".html"), out(code, ds, ".TXT")
+            add(f'{code}:{ds}:report', script.report,
+                deps=[f'{code}:{ds}:end', f'{code}:{ds}:cox', f'{code}:{ds}:km'],
+                params=dict(output_html=html, title=titled(script.TITLE)), outputs=[html, txt], log=txt)
+
+        for code in ('FZ', 'FP'):
+            if code not in analyses:
+                continue
+            script = load_script(code)
+            if f'{code}:{ds}' in chunked_runs:
+                # Out of core: Poisson table and KM curves from per-age/day counts (see czechfoi.chunked)
+                reduced = f'{code}:{ds}:chunked'
+                add(reduced, chunked.poisson_inputs, inputs=[csv_of[ds]], after=after_of[ds],
+                    params=dict(path=csv_of[ds], memory_budget_mb=script.MEMORY_BUDGET_MB))
+                add(f'{code}:{ds}:end', pick, deps=[reduced], params=dict(index=0))
+                add(f'{code}:{ds}:aggregate', pick, deps=[reduced], params=dict(index=1))
+                add(f'{code}:{ds}:km', pick, deps=[reduced], params=dict(index=2))
+            else:
+                add(f'{code}:{ds}:end', cohort.end_measure, deps=[derived])
+                add(f'{code}:{ds}:person_days', script.expand_person_days, deps=[derived, f'{code}:{ds}:end'],
+                    cache=False)
+                add(f'{code}:{ds}:aggregate', script.aggregate, deps=[f'{code}:{ds}:person_days'])
+                add(f'{code}:{ds}:km', script.fit_km, deps=[derived, f'{code}:{ds}:end'])
+            add(f'{code}:{ds}:poisson', script.fit_poisson, deps=[f'{code}:{ds}:aggregate'])
+            html, txt = out(code, ds, ".html"), out(code, ds, ".TXT")
+            add(f'{code}:{ds}:report', script.report,
+                deps=[f'{code}:{ds}:end', f'{code}:{ds}:poisson', f'{code}:{ds}:km'],
+                params=dict(output_html=html, title=titled(script.TITLE)),
+                outputs=[html.replace('.html', '_KM_survival.html'), txt], log=txt)
+
+        if 'ZI' in analyses:
+            zi = load_script('ZI')
+            if f'ZI:{ds}' in chunked_runs:
+                add(f'ZI:{ds}:chunked', zi.chunked_counts, inputs=[csv_of[ds]], after=after_of[ds],
+                    params=dict(path=csv_of[ds], memory_budget_mb=zi.MEMORY_BUDGET_MB))
+                add(f'ZI:{ds}:counts', pick, deps=[f'ZI:{ds}:chunked'], params=dict(index=0))
+                add(f'ZI:{ds}:doses', pick, deps=[f'ZI:{ds}:chunked'], params=dict(index=1))
+            else:
+                add(f'ZI:{ds}:end', cohort.end_measure, deps=[derived])
+                add(f'ZI:{ds}:counts', zi.compute_daily_counts, deps=[derived, f'ZI:{ds}:end'])
+                add(f'ZI:{ds}:doses', zi.compute_dose_counts, deps=[derived, f'ZI:{ds}:end'])
+            html = out('ZI', ds, ".html")
+            add(f'ZI:{ds}:plot', zi.plot, deps=[f'ZI:{ds}:counts', f'ZI:{ds}:doses'], outputs=[html],
+                params=dict(output_html=html, title=titled(zi.TITLE)))
+
+    if 'FJ' in analyses:
+        fj = load_script('FJ')
+        for ds in ('sim', 'real'):
+            add(f'FJ:{ds}:prep', fj.preprocess_data, deps=[cohort_of(ds)])
+            add(f'FJ:{ds}:km', fj.km_death_rate_diff, deps=[f'FJ:{ds}:prep'])
+            add(f'FJ:{ds}:rolling', fj.rolling_hr, deps=[f'FJ:{ds}:prep'],
+                params=dict(window_days=fj.ROLLING_WINDOW_DAYS, step_days=fj.ROLLING_STEP_DAYS))
+        add('FJ:real:doses', fj.daily_dose_counts, deps=['FJ:real:prep'])
+        add('FJ:real:replicates', fj.baseline_replicates, deps=['FJ:real:prep'],
+            params=dict(n_replicates=fj.N_REPLICATES, seed=fj.RESIM_SEED))
+        folder = os.path.join(results_dir, SCRIPTS['FJ']['folder'])
+        html = os.path.join(folder, f"AG70_bias_vs_observed_vs_adjusted_KM_death_rate{tag}.html")
+        surv_html = os.path.join(folder, f"AG70_KM_survival_difference{tag}.html")
+        add('FJ:plot', fj.plot_results, deps=['FJ:sim:km', 'FJ:real:km', 'FJ:real:replicates', 'FJ:real:doses',
+                                              'FJ:sim:rolling', 'FJ:real:rolling'],
+            outputs=[html, surv_html],
+            params=dict(output_html=html, output_surv_html=surv_html, sigma=fj.SIGMA,
+                        band_percentiles=fj.BAND_PERCENTILES, window_days=fj.ROLLING_WINDOW_DAYS,
+                        title=titled(fj.TITLE), surv_title=titled(fj.SURV_TITLE)))
+
+    if report:
+        path = report if isinstance(report, str) else os.path.join(results_dir, f"{REPORT_NAME}{tag}.html")
+        plots = [stage for stage in stages if any(p.endswith('.html') for p in stage.outputs)]
+        add('html:report', figures.write_report, after=[stage.name for stage in plots], outputs=[path],
+            params=dict(html_files=[p for stage in plots for p in stage.outputs if p.endswith('.html')],
+                        output_html=path, title=titled(REPORT_TITLE)))
+
+    return stages
+
+def memory_plan(datasets=('real', 'sim'), analyses=ANALYSES, data_dir=DATA_DIR, preview=None, memory_limit_mb=None,
+                cache_dir=None):
+    """
+    Predicted rows and peak memory of the large stages per dataset (see czechfoi.estimate), with the
+    strategy of each analysis under memory_limit_mb. Each input is summarized in one streamed pass;
+    a simulated file that FG has not written yet is estimated from the real data (FG keeps the
+    persons and dose schedules). Preview runs scale the rows and cannot switch to chunked mode.
+    With cache_dir, the summaries are kept there per input content, so a rerun (e.g. a batch run with
+    every stage cached) does not stream the inputs again.
+    """
+    real_csv = data.resolve_input(os.path.join(data_dir, DATASETS['real']['csv']))
+    sim_csv = os.path.join(data_dir, DATASETS['sim']['csv'])
+    summaries = {'real': estimate.summarize_csv(real_csv, cache_dir=cache_dir)}
+    summaries['sim'] = (estimate.summarize_csv(sim_csv, cache_dir=cache_dir) if os.path.exists(sim_csv)
+                        else summaries['real'])
+
+    ages = {code: load_script(code).AGE for code in ('FW', 'FY') if code in analyses}
+    tables = []
+    for ds in ('real', 'sim'):
+        codes = [code for code in analyses if code not in ('FG', 'FJ') and ds in datasets]
+        codes += ['FJ'] if 'FJ' in analyses else []
+        if not codes:
+            continue
+        table = estimate.estimate(summaries[ds], codes, ages, scale=preview or 1.0, memory_limit_mb=memory_limit_mb,
+                                  chunkable=() if preview else estimate.CHUNKABLE)
+        table.insert(0, 'dataset', ds)
+        tables.append(table)
+    if not tables:
+        return pd.DataFrame(columns=['dataset', 'analysis', 'stage', 'rows', 'stage_mb', 'peak_mb', 'strategy'])
+    return pd.concat(tables, ignore_index=True)
+
+def batch_memory(plan):
+    """Predicted MB per batch branch ('FW:real', 'FJ', ...): its largest stage; chunked runs use their chunk budget"""
+    stages = plan[plan['analysis'] != 'load']
+    memory = stages['stage_mb'].where(stages['strategy'] != 'chunked', chunked.MEMORY_BUDGET_MB)
+    branch = stages['analysis'].where(stages['analysis'] == 'FJ', stages['analysis'] + ':' + stages['dataset'])
+    return memory.groupby(branch).max().to_dict()
+
+# === Command line ===
+
+def parse_param(text):
+    """'name=value' or 'CODE.name=value'; values are Python literals or plain strings."""
+    name, _, raw = text.partition('=')
+    try:
+        value = ast.literal_eval(raw)
+    except (ValueError, SyntaxError):
+        value = raw
+    group, _, name = name.rpartition('.')
+    return group or None, name, value
+
+def apply_params(stages, overrides):
+    for group, name, value in overrides:
+        matched = False
+        for stage in stages:
+            if name in stage.params and (group is None or stage.group == group):
+                stage.params[name] = value
+                matched = True
+        if not matched:
+            raise SystemExit(f"No stage has a parameter '{name}'" + (f" in {group}" if group else ""))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the CzechFOI analyses as a cached pipeline.")
+    parser.add_argument('--analyses', nargs='+', default=ANALYSES, choices=ANALYSES)
+    parser.add_argument('--datasets', nargs='+', default=['real', 'sim'], choices=list(DATASETS))
+    parser.add_argument('--data-dir', default=DATA_DIR, help="folder with the input CSV files (Terra)")
+    parser.add_argument('--results-dir', default=RESULTS_DIR, help="folder for the Plot Results tree")
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--param', action='append', default=[], metavar='[CODE.]NAME=VALUE',
+                        help="override a stage parameter, e.g. lag_days=14 or FW.title='...'")
+    parser.add_argument('--force', action='store_true', help="ignore the cache and rerun every stage")
+    parser.add_argument('--list', action='store_true', help="only show the stages and their cache state")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="batch mode: run independent analyses in N worker processes (0 = CPU budget)")
+    parser.add_argument('--load-workers', type=int, default=data.LOAD_WORKERS,
+                        help="parse the input CSVs in N processes (0 = CPU budget); does not affect the cache")
+    parser.add_argument('--cpus', type=int, help="CPU budget shared by all workers and BLAS threads (default: all cores)")
+    parser.add_argument('--preview', type=float, metavar='FRACTION',
+                        help="run on a weighted stratified sample of this fraction (e.g. 0.05), outputs labelled PREVIEW")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only print the predicted rows and peak memory of the large stages")
+    parser.add_argument('--slim-html', action='store_true',
+                        help="HTML with one shared plotly.js in the results folder and compact trace data")
+    parser.add_argument('--report', nargs='?', const=True, metavar='HTML',
+                        help=f"also write all figures into one page (default: '<results dir>/{REPORT_NAME}.html'); implies --slim-html")
+    parser.add_argument('--full-curves', action='store_true',
+                        help="plot every point of the curves (no change-point compression or decimation)")
+    parser.add_argument('--memory-limit-mb', type=float,
+                        help="run FZ/FP/ZI out of core if they would exceed this peak; stop if another analysis would; "
+                             "also the memory budget of the batch workers")
+    args = parser.parse_args(argv)
+    scheduler.configure(cpu_budget=args.cpus, memory_budget_mb=args.memory_limit_mb)
+    data.LOAD_WORKERS = args.load_workers
+    if args.slim_html or args.report:
+        figures.configure(slim=True, plotlyjs_dir=os.path.abspath(args.results_dir))
+    if args.full_curves:
+        figures.configure(compress=False)
+    jobs = scheduler.worker_count(args.jobs)
+    if args.preview is not None and not 0 < args.preview < 1:
+        parser.error("--preview must be a fraction between 0 and 1")
+
+    build = dict(datasets=args.datasets, analyses=args.analyses, data_dir=args.data_dir, results_dir=args.results_dir,
+                 preview=args.preview, report=args.report)
+    plan = None
+    if args.dry_run or args.memory_limit_mb:
+        plan = memory_plan(args.datasets, args.analyses, args.data_dir, args.preview, args.memory_limit_mb,
+                           cache_dir=args.cache_dir)
+        print(estimate.format_table(plan))
+        over = plan[plan['strategy'] == 'over budget']
+        if args.dry_run:
+            return
+        if len(over):
+            raise SystemExit("Predicted peak memory exceeds --memory-limit-mb for: "
+                             + ", ".join(sorted(set(over['analysis'] + ':' + over['dataset'])))
+                             + " (use --preview, a smaller input or a higher limit)")
+        chunked_runs = plan.loc[(plan['strategy'] == 'chunked') & (plan['analysis'] != 'load')]
+        build['chunked_runs'] = sorted(set(chunked_runs['analysis'] + ':' + chunked_runs['dataset']))
+    overrides = [parse_param(p) for p in args.param]
+    stages = build_stages(**build)
+    apply_params(stages, overrides)
+    pipeline = Pipeline(stages, cache_dir=args.cache_dir, force=args.force,
+                        spec=dict(build=build, params=overrides, html=figures.settings()))
+    if args.list:
+        pipeline.status()
+    else:
+        if jobs > 1 and plan is None:
+            plan = memory_plan(args.datasets, args.analyses, args.data_dir, args.preview, cache_dir=args.cache_dir)
+        pipeline.run(jobs=jobs, branch_memory=batch_memory(plan) if jobs > 1 else None)
+        # Timing, CPU, peak memory and row counts of the stages that actually ran
+        if pipeline.record.stages:
+            print(pipeline.record.summary())
+            pipeline.record.write(os.path.join(args.cache_dir, "run-record.json"))
+
+if __name__ == "__main__":
+    main()
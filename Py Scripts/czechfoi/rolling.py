@@ -0,0 +1,150 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from czechfoi.chunked import AgeDayCounts
+from czechfoi.data import WEIGHT_COL
+
+"""
+Vaccinated vs unvaccinated rate ratio in sliding calendar windows, from per-day counts.
+
+With daily risk sets, the Cox partial likelihood of a binary time-varying exposure is close to a
+Poisson model stratified by age and day, and the Mantel-Haenszel estimator over those strata
+needs only sums of per-stratum terms:
+
+    R = D1 * T0 / T,   S = D0 * T1 / T,   V = T1 * T0 * (D1 + D0) / T^2
+
+(D deaths, T persons at risk on the day, 1 = vaccinated, 0 = unvaccinated, T = T0 + T1).
+HR_MH = sum R / sum S, and the Greenland-Robins variance of log HR_MH is sum V / (sum R * sum S).
+
+The terms are summed over ages once per day. A window is then a running sum: moving it by
+'step' days adds the days that enter and subtracts the days that leave (prefix sums, so every
+window costs O(1) instead of a refit on the intervals of its days). The crude IRR of the window
+(pooled deaths / person-days) is summed the same way.
+
+The input is a per-age/day frame as built by AgeDayCounts.daily_counts() or
+CountCube.daily_counts() (pop_* = alive on the day, death_* = deaths on the day).
+
+Usage:
+    windows = rolling_rate_ratio(daily_counts(df, end_measure), window_days=30, step_days=7)
+
+    python -m czechfoi.rolling INPUT_CSV --age 70 --window 30 --step 7   # via the count cube
+"""
+
+WINDOW_DAYS = 30
+STEP_DAYS = 7
+Z_95 = 1.959964
+
+def daily_counts(df, end_measure, lag_days=0):
+    """
+    Per-age/day counts of a cohort (see czechfoi.cohort), vaccinated from first dose day + lag_days
+    on (the exposure_day column of its lag view). A preview sample is counted with its weights.
+    """
+    counts = AgeDayCounts(weighted=WEIGHT_COL in df)
+    lagged = df.view(lag_days=lag_days)
+    counts.add(lagged.assign(first_dose_day=lagged['exposure_day']))
+    return counts.daily_counts(end_measure)
+
+def daily_terms(counts, ages=None):
+    """
+    Mantel-Haenszel terms and crude sums per day, summed over the age strata (ages: an inclusive
+    (first, last) range or None for all). Returns a DataFrame indexed by day.
+    """
+    if ages is not None:
+        counts = counts[counts['age'].between(*ages)]
+    d1 = counts['death_vx'].to_numpy(dtype=float)
+    d0 = counts['death_uvx'].to_numpy(dtype=float)
+    # Persons at risk on the day include those who die on it
+    t1 = counts['pop_vx'].to_numpy(dtype=float) + d1
+    t0 = counts['pop_uvx'].to_numpy(dtype=float) + d0
+    t = t1 + t0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = pd.DataFrame({
+            'day': counts['day'].to_numpy(),
+            'deaths_vx': d1,
+            'deaths_uvx': d0,
+            'person_days_vx': t1,
+            'person_days_uvx': t0,
+            'mh_r': np.where(t > 0, d1 * t0 / t, 0.0),
+            'mh_s': np.where(t > 0, d0 * t1 / t, 0.0),
+            'mh_v': np.where(t > 0, t1 * t0 * (d1 + d0) / t ** 2, 0.0),
+        })
+    return terms.groupby('day').sum()
+
+def rolling_rate_ratio(counts, window_days=WINDOW_DAYS, step_days=STEP_DAYS, ages=None):
+    """
+    Rate ratio (vaccinated / unvaccinated) in windows of window_days days, every step_days days.
+
+    One row per window: first and last day, centre day, deaths and person-days per group, the
+    crude IRR and the Mantel-Haenszel HR (age x day strata) with its 95% CI. Windows without
+    deaths in one of the groups give NaN.
+    """
+    terms = daily_terms(counts, ages)
+    days = terms.index.to_numpy()
+    starts = np.arange(days[0], days[-1] - window_days + 2, step_days)
+    # Prefix sums: window [a, a + w) = cum[a + w] - cum[a], i.e. the days entering minus those leaving
+    cum = np.vstack([np.zeros(terms.shape[1]), terms.to_numpy().cumsum(axis=0)])
+    first = starts - days[0]
+    sums = pd.DataFrame(cum[first + window_days] - cum[first], columns=terms.columns)
+
+    result = pd.DataFrame({
+        'window_start': starts,
+        'window_end': starts + window_days - 1,
+        'day': starts + (window_days - 1) / 2,
+    })
+    for col in ('deaths_vx', 'deaths_uvx', 'person_days_vx', 'person_days_uvx'):
+        result[col] = sums[col].to_numpy()
+    r, s, v = (sums[col].to_numpy() for col in ('mh_r', 'mh_s', 'mh_v'))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        valid = (r > 0) & (s > 0)
+        result['irr'] = np.where(valid, (result['deaths_vx'] / result['person_days_vx'])
+                                 / (result['deaths_uvx'] / result['person_days_uvx']), np.nan)
+        log_hr = np.where(valid, np.log(r / s), np.nan)
+        se = np.where(valid, np.sqrt(v / (r * s)), np.nan)
+    result['hr'] = np.exp(log_hr)
+    result['hr_lower'] = np.exp(log_hr - Z_95 * se)
+    result['hr_upper'] = np.exp(log_hr + Z_95 * se)
+    result['log_hr_se'] = se
+    return result
+
+def adjusted_ratio(real, sim):
+    """
+    Bias-adjusted HR per window: real HR / simulated HR, with the CI from the summed log variances.
+    Both inputs are rolling_rate_ratio() results with the same windows.
+    """
+    merged = real.merge(sim, on=['window_start', 'window_end', 'day'], suffixes=('_real', '_sim'))
+    log_ratio = np.log(merged['hr_real']) - np.log(merged['hr_sim'])
+    se = np.sqrt(merged['log_hr_se_real'] ** 2 + merged['log_hr_se_sim'] ** 2)
+    return pd.DataFrame({
+        'window_start': merged['window_start'],
+        'window_end': merged['window_end'],
+        'day': merged['day'],
+        'hr': np.exp(log_ratio),
+        'hr_lower': np.exp(log_ratio - Z_95 * se),
+        'hr_upper': np.exp(log_ratio + Z_95 * se),
+    })
+
+def main(argv=None):
+    from czechfoi.cube import CUBE_ROOT, CountCube
+    parser = argparse.ArgumentParser(description="Rolling-window vaccinated vs unvaccinated rate ratio from the count cube.")
+    parser.add_argument('input_csv')
+    parser.add_argument('--cube-root', default=CUBE_ROOT)
+    parser.add_argument('--age', nargs='+', type=int, help="age or first and last age")
+    parser.add_argument('--window', type=int, default=WINDOW_DAYS, help="window length in days")
+    parser.add_argument('--step', type=int, default=STEP_DAYS, help="days between window starts")
+    parser.add_argument('--output', help="CSV file for the windows (default: print)")
+    args = parser.parse_args(argv)
+
+    cube = CountCube.for_input(args.input_csv, args.cube_root)
+    ages = (args.age[0], args.age[-1]) if args.age else None
+    result = rolling_rate_ratio(cube.daily_counts(), args.window, args.step, ages)
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print(f"{len(result)} windows saved to {args.output}")
+    else:
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(result.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import concurrent.futures
+import contextlib
+import os
+
+try:
+    import threadpoolctl
+except ImportError:          # optional: without it only workers that load NumPy after starting are pinned
+    threadpoolctl = None
+
+"""
+One CPU and memory budget for every parallel feature: batch analyses, parallel CSV parsing and
+the stratified Cox workers.
+
+Each feature asks for a number of worker processes; worker_count() caps it at CPU_BUDGET, and
+process_pool() starts the workers with their share of the budget as BLAS threads
+(CPU_BUDGET // workers), so N workers times the threads of numpy/statsmodels/lifelines never
+exceed the cores. The thread count is set in the usual environment variables (OMP_NUM_THREADS,
+OPENBLAS_NUM_THREADS, ...) while the workers start, which covers workers that load NumPy
+themselves (spawn, the default on Windows and macOS). Forked workers inherit the BLAS pool of the
+parent; with threadpoolctl installed it is resized in every worker as well.
+
+run_packed() runs tasks with a predicted memory (e.g. from czechfoi.estimate) in such a pool.
+A task starts only when a worker is free and it fits into MEMORY_BUDGET_MB next to the running
+tasks, largest tasks first, so two memory-heavy stages (e.g. the FJ branch and FX on the full
+cohort) do not run at the same time while small ones fill the remaining workers. A task larger
+than the budget runs alone.
+
+Usage (from the 'Py Scripts' folder):
+    scheduler.configure(cpu_budget=8, memory_budget_mb=16000)    # or set CPU_BUDGET / MEMORY_BUDGET_MB
+    with scheduler.process_pool(scheduler.worker_count(4)) as pool:
+        results = list(pool.map(func, items))
+    for task, future in scheduler.run_packed([Task('FW:real', fw, (spec,), memory_mb=900), ...], workers=4):
+        print(task.name, future.result())
+
+    python -m czechfoi.pipeline --jobs 0 --cpus 8 --memory-limit-mb 16000
+"""
+
+CPU_BUDGET = None            # Cores shared by all worker processes and their BLAS threads (None = all cores)
+MEMORY_BUDGET_MB = None      # Memory shared by concurrently running tasks (None = 80% of physical memory)
+MEMORY_FRACTION = 0.8        # Share of physical memory used when MEMORY_BUDGET_MB is None
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def configure(cpu_budget=None, memory_budget_mb=None):
+    """Set the budgets (None keeps the current value) and limit the BLAS threads of this process to the CPU budget"""
+    global CPU_BUDGET, MEMORY_BUDGET_MB
+    if cpu_budget is not None:
+        CPU_BUDGET = cpu_budget
+    if memory_budget_mb is not None:
+        MEMORY_BUDGET_MB = memory_budget_mb
+    if CPU_BUDGET is not None:
+        pin_blas_threads(CPU_BUDGET)
+
+def cpu_budget():
+    return CPU_BUDGET or os.cpu_count() or 1
+
+def memory_budget_mb():
+    """MEMORY_BUDGET_MB, else a share of the physical memory; None if neither is known (no packing)"""
+    if MEMORY_BUDGET_MB is not None:
+        return MEMORY_BUDGET_MB
+    try:
+        return MEMORY_FRACTION * os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except (AttributeError, ValueError, OSError):     # no sysconf (Windows)
+        return None
+
+def worker_count(requested=None):
+    """Workers for a parallel feature: the request (0 or None = the whole budget), at most the CPU budget"""
+    return max(1, min(requested or cpu_budget(), cpu_budget()))
+
+def blas_threads(workers):
+    """BLAS threads per worker, so that workers x threads stays within the CPU budget"""
+    return max(1, cpu_budget() // max(1, workers))
+
+def pin_blas_threads(threads):
+    for name in BLAS_THREAD_VARS:
+        os.environ[name] = str(threads)
+    if threadpoolctl is not None:
+        threadpoolctl.threadpool_limits(threads)
+
+@contextlib.contextmanager
+def _blas_environment(threads):
+    saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARS}
+    os.environ.update({name: str(threads) for name in BLAS_THREAD_VARS})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def _init_worker(threads, initializer, initargs):
+    pin_blas_threads(threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+@contextlib.contextmanager
+def process_pool(workers, initializer=None, initargs=(), threads=None):
+    """
+    ProcessPoolExecutor with 'workers' processes, each limited to 'threads' BLAS threads
+    (default: its share of the CPU budget). initializer(*initargs) runs in every worker after pinning.
+    """
+    threads = threads or blas_threads(workers)
+    with _blas_environment(threads):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                    initargs=(threads, initializer, initargs)) as pool:
+            yield pool
+
+class Task:
+    """A call func(*args) with its predicted peak memory in MB (0 if unknown)"""
+    def __init__(self, name, func, args=(), memory_mb=0.0):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.memory_mb = memory_mb
+
+def run_packed(tasks, workers=None, memory_budget=None):
+    """
+    Run the tasks in a process pool and yield (task, future) as they finish. A task starts when a
+    worker is free and its memory fits next to the running tasks (largest first, budget default
+    memory_budget_mb()); a task that does not fit even alone runs when nothing else does.
+    """
+    pending = sorted(tasks, key=lambda task: -task.memory_mb)
+    if not pending:
+        return
+    budget = memory_budget_mb() if memory_budget is None else memory_budget
+    workers = min(worker_count(workers), len(pending))
+    running = {}
+    with process_pool(workers) as pool:
+        while pending or running:
+            in_use = sum(task.memory_mb for task in running.values())
+            for task in list(pending):
+                if len(running) >= workers:
+                    break
+                if running and budget is not None and in_use + task.memory_mb > budget:
+                    continue
+                running[pool.submit(task.func, *task.args)] = task
+                in_use += task.memory_mb
+                pending.remove(task)
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield running.pop(future), future
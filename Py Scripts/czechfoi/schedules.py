@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from czechfoi.data import DOSE_DAY_COLS
+
+"""
+Dictionary encoding of the dose schedules (the day numbers of doses 1..7 of a person).
+
+The seven dose dates repeat across thousands of people, since the rollout gave the same dates to
+whole age groups. A ScheduleTable keeps every distinct schedule once and stores a schedule ID per
+person, so work that only depends on the schedule (sorting the doses, the last dose day,
+the interval boundaries) is done once per schedule, not once per person. The table of
+day numbers replaces per-person lists of Timestamps (FG).
+
+Usage:
+    schedules = ScheduleTable.from_cohort(df)        # derived frame with the datum_i_day columns
+    last_day = schedules.last_day()[schedules.ids]   # per person, computed per schedule
+"""
+
+MISSING_DAY = 1 << 40                   # Stands for NaN while encoding (sorts after every real day)
+
+class ScheduleTable:
+    """
+    days: (n_schedules, 7) day numbers of doses 1..7, NaN where a dose was not given
+    ids:  (n_persons,) schedule ID of every person, in the row order of the encoded frame
+    """
+    def __init__(self, days, ids):
+        self.days = days
+        self.ids = ids
+
+    @classmethod
+    def encode(cls, dose_days):
+        """Encode an (n_persons, 7) array of dose day numbers (NaN if missing)"""
+        dose_days = np.asarray(dose_days, dtype=float)
+        filled = np.where(np.isnan(dose_days), MISSING_DAY, dose_days).astype(np.int64)
+        table, ids = np.unique(filled, axis=0, return_inverse=True)
+        days = np.where(table == MISSING_DAY, np.nan, table.astype(float))
+        return cls(days, ids.reshape(-1).astype(np.int32))
+
+    @classmethod
+    def from_cohort(cls, df, cols=DOSE_DAY_COLS):
+        """Schedules of a derived frame (see czechfoi.data.derive_days)"""
+        return cls.encode(df[cols].to_numpy(dtype=float))
+
+    def __len__(self):
+        return len(self.days)
+
+    def n_doses(self):
+        """Number of doses per schedule"""
+        return (~np.isnan(self.days)).sum(axis=1)
+
+    def first_day(self):
+        """Day of the earliest dose per schedule, NaN for the schedule without doses"""
+        return np.fmin.reduce(self.days, axis=1)
+
+    def last_day(self):
+        """Day of the latest dose per schedule, NaN for the schedule without doses"""
+        return np.fmax.reduce(self.days, axis=1)
+
+    def person_days(self, ids=None):
+        """(n, 7) dose day numbers of the persons with the given IDs (default: all encoded persons)"""
+        return self.days[self.ids if ids is None else ids]
+
+    def to_frame(self, cols=DOSE_DAY_COLS):
+        """The schedule table as a DataFrame indexed by schedule ID, with the number of persons per schedule"""
+        table = pd.DataFrame(self.days, columns=cols)
+        table['persons'] = np.bincount(self.ids, minlength=len(self))
+        table.index.name = 'schedule_id'
+        return table
@@ -0,0 +1,249 @@
+import argparse
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+from czechfoi import scheduler
+from czechfoi.data import MAX_AGE, REFERENCE_YEAR
+from czechfoi.chunked import DayGrid, MEMORY_BUDGET_MB, reduce_csv
+
+"""
+Age-stratified time-varying Cox model: one baseline hazard per birth year, a shared vaccination effect.
+
+FW fits one age (AGE = 70) at a time; FZ/FP adjust for age with a linear term. Here all ages are
+fitted in one model with a separate baseline hazard per age (= birth year, REFERENCE_YEAR - age),
+so the vaccination HR is compared only within an age. The intervals are FW's: unvaccinated
+from day 0 to first dose + lag (or death/END_MEASURE), vaccinated from there to death/END_MEASURE;
+an interval with start == stop and a death is extended by half a day.
+
+With one binary covariate the partial likelihood only needs, per age and event time, the number
+of unvaccinated and vaccinated intervals at risk and their deaths. RiskSetCounts streams the
+input into these counts (difference arrays on a half-day grid, see czechfoi.chunked.DayGrid).
+Ties are handled with Efron's method, as lifelines does.
+
+The strata are split into groups of about equal numbers of deaths. Each group is held by a worker
+process that returns its strata's score, information and log-likelihood. At every Newton step the
+main process sums the per-stratum contributions into the step of the shared log HR. The same pass
+also moves one log HR per age with that age's own contributions, so the per-age HRs come out of the
+same iterations. The fit is unpenalized (lifelines' FW fit uses penalizer 0.1).
+
+Usage (from the 'Py Scripts' folder):
+    counts = RiskSetCounts(lag_days=0)
+    end = reduce_csv(INPUT_CSV, [counts])
+    fit = fit_stratified(counts.risk_sets(end), workers=4)
+    print(fit.summary()); fit.per_age
+
+    python -m czechfoi.stratified INPUT_CSV --workers 4 --output-csv per_age_hr.csv
+"""
+
+Z_95 = 1.959964
+MAX_STEP = 1.0              # Largest Newton step on the log HR
+MAX_LOG_HR = 15.0           # Per-age log HRs beyond this diverge (no finite estimate in the age)
+TOLERANCE = 1e-9
+MAX_ITERATIONS = 50
+
+class RiskSetCounts:
+    """Intervals at risk and deaths per age and half day, for unvaccinated and vaccinated intervals"""
+    def __init__(self, lag_days=0):
+        self.lag_days = lag_days
+        self.grid = DayGrid(['at_risk_uvx', 'at_risk_vx', 'deaths_uvx', 'deaths_vx'])
+
+    def add(self, chunk):
+        ages = chunk['age'].to_numpy(dtype=np.int64)
+        death = chunk['death_day'].to_numpy(dtype=float)
+        first = chunk['first_dose_day'].to_numpy(dtype=float) + self.lag_days
+        # Times on the half-day grid (2 * day); alive people stay open until END_MEASURE
+        end_day = np.where(np.isnan(death), np.inf, 2 * death)
+        dose = np.where(np.isnan(first), np.inf, 2 * first)
+        dead = ~np.isnan(death)
+
+        # Unvaccinated interval (0, min(end, dose)], at risk on the grid times start < t <= stop
+        unvax_stop = np.minimum(end_day, dose)
+        unvax_event = dead & (end_day <= dose)
+        unvax_stop = np.where(unvax_event & (unvax_stop == 0), 1, unvax_stop)   # death on day 0: stop 0.5
+        self.grid.add_ranges('at_risk_uvx', ages, np.ones(len(ages)), unvax_stop + 1)
+        self.grid.add_points('deaths_uvx', ages[unvax_event], unvax_stop[unvax_event])
+
+        # Vaccinated interval (dose, end] if the dose comes before the end
+        vax = dose < end_day
+        self.grid.add_ranges('at_risk_vx', ages[vax], dose[vax] + 1, end_day[vax] + 1)
+        vax_event = vax & dead
+        self.grid.add_points('deaths_vx', ages[vax_event], end_day[vax_event])
+
+    def risk_sets(self, end_measure):
+        """
+        DataFrame with one row per age and event time: age, time (days), at_risk_uvx, at_risk_vx,
+        deaths_uvx, deaths_vx
+        """
+        last = 2 * end_measure
+        counts = {name: self.grid.counts(name, last, cumulative=name.startswith('at_risk'))
+                  for name in self.grid.arrays}
+        ages, times = np.nonzero(counts['deaths_uvx'] + counts['deaths_vx'])
+        result = pd.DataFrame({'age': ages, 'time': times / 2})
+        for name, array in counts.items():
+            result[name] = array[ages, times]
+        return result
+
+# === Efron score and information per stratum ===
+
+class StratumGroup:
+    """Event-time arrays of some strata, with one row per death for the Efron sums"""
+    def __init__(self, risk_sets, strata):
+        self.strata = np.asarray(strata)
+        rows = risk_sets[risk_sets['age'].isin(self.strata)]
+        self.stratum = np.searchsorted(self.strata, rows['age'].to_numpy())
+        self.y0, self.y1, self.d0, self.d1 = (rows[col].to_numpy(dtype=float) for col in
+                                              ('at_risk_uvx', 'at_risk_vx', 'deaths_uvx', 'deaths_vx'))
+        d = (self.d0 + self.d1).astype(np.int64)
+        self.death_row = np.repeat(np.arange(len(d)), d)
+        # l / d for the l-th of the d deaths at an event time
+        self.fraction = (np.arange(d.sum()) - np.repeat(np.cumsum(d) - d, d)) / np.repeat(d, d)
+
+    def evaluate(self, beta):
+        """Score, information and log-likelihood per stratum at the log HRs beta (one per stratum)"""
+        b = beta[self.stratum]
+        risk = np.exp(b)
+        s0, s1 = self.y0 + self.y1 * risk, self.y1 * risk
+        ds0, ds1 = self.d0 + self.d1 * risk, self.d1 * risk
+        row, fraction = self.death_row, self.fraction
+        denominator = s0[row] - fraction * ds0[row]
+        mean = (s1[row] - fraction * ds1[row]) / denominator
+        n = len(self.strata)
+        score = np.bincount(self.stratum, self.d1, n) - np.bincount(self.stratum[row], mean, n)
+        information = np.bincount(self.stratum[row], mean * (1 - mean), n)
+        loglik = np.bincount(self.stratum, self.d1 * b, n) - np.bincount(self.stratum[row], np.log(denominator), n)
+        return score, information, loglik
+
+_group = None
+
+def _init_worker(group):
+    global _group
+    _group = group
+
+def _evaluate_worker(shared_beta, stratum_beta):
+    return (_group.evaluate(np.full(len(_group.strata), shared_beta)), _group.evaluate(stratum_beta))
+
+def split_strata(risk_sets, n_groups):
+    """Ages split into n_groups contiguous groups with about equal numbers of deaths"""
+    deaths = risk_sets.groupby('age')[['deaths_uvx', 'deaths_vx']].sum().sum(axis=1)
+    bounds = np.searchsorted(deaths.cumsum().to_numpy(), np.linspace(0, deaths.sum(), n_groups + 1)[1:-1])
+    return [group for group in np.split(deaths.index.to_numpy(), bounds) if len(group)]
+
+class StratifiedFit:
+    """Shared and per-age log HRs of a stratified fit"""
+    def __init__(self, beta, information, loglik, iterations, per_age):
+        self.beta = beta
+        self.information = information
+        self.loglik = loglik
+        self.iterations = iterations
+        self.per_age = per_age
+
+    @property
+    def se(self):
+        return 1 / np.sqrt(self.information)
+
+    def hazard_ratio(self):
+        """(HR, lower, upper) of the shared vaccination effect"""
+        return tuple(np.exp(self.beta + np.array([0, -Z_95, Z_95]) * self.se))
+
+    def summary(self):
+        hr, lower, upper = self.hazard_ratio()
+        return (f"Stratified Cox model ({len(self.per_age)} age strata, {self.iterations} Newton steps): "
+                f"vaccinated HR = {hr:.3f} (95% CI: {lower:.3f} - {upper:.3f}), log-likelihood {self.loglik:.2f}")
+
+def fit_stratified(risk_sets, workers=1):
+    """
+    Newton-Raphson fit of the shared log HR and of one log HR per age, with the per-stratum
+    contributions computed in 'workers' processes (in this process for workers=1; 0 = the CPU budget
+    of czechfoi.scheduler, which also caps the workers and their BLAS threads).
+    """
+    workers = scheduler.worker_count(workers)
+    strata = np.sort(risk_sets['age'].unique())
+    groups = split_strata(risk_sets, workers)
+    stratum_groups = [StratumGroup(risk_sets, group) for group in groups]
+    offsets = np.cumsum([0] + [len(group) for group in groups])
+    pools = contextlib.ExitStack()
+    executors = []
+    if workers > 1:
+        threads = scheduler.blas_threads(workers)
+        executors = [pools.enter_context(scheduler.process_pool(1, _init_worker, (group,), threads=threads))
+                     for group in stratum_groups]
+
+    def evaluate(shared_beta, stratum_beta):
+        parts = [stratum_beta[offsets[i]:offsets[i + 1]] for i in range(len(groups))]
+        if executors:
+            futures = [executor.submit(_evaluate_worker, shared_beta, part) for executor, part in zip(executors, parts)]
+            results = [future.result() for future in futures]
+        else:
+            results = [(group.evaluate(np.full(len(group.strata), shared_beta)), group.evaluate(part))
+                       for group, part in zip(stratum_groups, parts)]
+        shared = [np.concatenate([result[0][k] for result in results]) for k in range(3)]
+        per_stratum = [np.concatenate([result[1][k] for result in results]) for k in range(3)]
+        return shared, per_stratum
+
+    # Per-age estimates need deaths in both groups of the age
+    deaths = risk_sets.groupby('age')[['deaths_uvx', 'deaths_vx']].sum().reindex(strata)
+    estimable = (deaths > 0).all(axis=1).to_numpy()
+
+    beta, stratum_beta = 0.0, np.zeros(len(strata))
+    try:
+        for iteration in range(1, MAX_ITERATIONS + 1):
+            (score, information, loglik), (s_score, s_information, _) = evaluate(beta, stratum_beta)
+            step = np.clip(score.sum() / information.sum(), -MAX_STEP, MAX_STEP)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                s_step = np.where(estimable & (s_information > 0), np.clip(s_score / s_information, -MAX_STEP, MAX_STEP), 0)
+            beta += step
+            stratum_beta += s_step
+            diverging = np.abs(stratum_beta) > MAX_LOG_HR
+            if abs(step) < TOLERANCE and np.all((np.abs(s_step) < TOLERANCE) | diverging):
+                break
+        (score, information, loglik), (_, s_information, _) = evaluate(beta, stratum_beta)
+        # E.g. all deaths of an age among the vaccinated: the likelihood keeps rising as the HR grows;
+        # no information: at every death only one group was at risk
+        estimable &= ~diverging & (s_information > 0)
+    finally:
+        pools.close()
+
+    with np.errstate(divide='ignore'):
+        s_se = np.where(estimable, 1 / np.sqrt(s_information), np.nan)
+    s_beta = np.where(estimable, stratum_beta, np.nan)
+    per_age = pd.DataFrame({
+        'age': strata,
+        'birth_year': REFERENCE_YEAR - strata,
+        'deaths_uvx': deaths['deaths_uvx'].to_numpy(),
+        'deaths_vx': deaths['deaths_vx'].to_numpy(),
+        'hr': np.exp(s_beta),
+        'hr_lower': np.exp(s_beta - Z_95 * s_se),
+        'hr_upper': np.exp(s_beta + Z_95 * s_se),
+    })
+    return StratifiedFit(beta, information.sum(), loglik.sum(), iteration, per_age)
+
+def fit_csv(path, lag_days=0, workers=1, ages=(0, MAX_AGE), memory_budget_mb=MEMORY_BUDGET_MB):
+    """Stream the input into risk-set counts and fit the stratified model over the given age range"""
+    counts = RiskSetCounts(lag_days)
+    end_measure = reduce_csv(path, [counts], memory_budget_mb)
+    risk_sets = counts.risk_sets(end_measure)
+    return fit_stratified(risk_sets[risk_sets['age'].between(*ages)], workers)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Age-stratified time-varying Cox model over all ages.")
+    parser.add_argument('input_csv')
+    parser.add_argument('--age', nargs='+', type=int, help="age or first and last age (default: all)")
+    parser.add_argument('--lag-days', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help="processes accumulating the strata (0 = CPU budget)")
+    parser.add_argument('--memory-budget-mb', type=int, default=MEMORY_BUDGET_MB)
+    parser.add_argument('--output-csv', help="CSV file for the per-age HRs")
+    args = parser.parse_args(argv)
+
+    ages = (args.age[0], args.age[-1]) if args.age else (0, MAX_AGE)
+    fit = fit_csv(args.input_csv, args.lag_days, args.workers, ages, args.memory_budget_mb)
+    print(fit.summary())
+    if args.output_csv:
+        fit.per_age.to_csv(args.output_csv, index=False)
+        print(f"Per-age HRs saved to {args.output_csv}")
+    else:
+        print(fit.per_age.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
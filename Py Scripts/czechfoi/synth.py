@@ -0,0 +1,125 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from czechfoi.data import START_DATE, REFERENCE_YEAR, MAX_AGE, DOSE_COLS, NEEDED_COLS
+
+"""
+Synthetic cohorts with the schema of the Czech FOI export (Rok_narozeni, DatumUmrti, Datum_1..7).
+
+Used to benchmark the analyses without the Vesely_106 file. The distributions are rough but shaped
+like the real data, so the stages see realistic row counts:
+- ages follow a Czech-like population pyramid (or a single age, e.g. 70 as in the AG70 export),
+- deaths follow Gompertz mortality with winter / COVID wave peaks over the observation window,
+- vaccination uptake rises with age, the first dose follows the age-priority rollout from
+  December 2020, dose 2 about 5 weeks later and boosters months apart; no doses after death.
+
+Generation is chunked, so 10M-row files can be written on a laptop:
+    python -m czechfoi.synth 1M synthetic_1M.csv [--age 70] [--seed 0]
+"""
+
+END_DATE = pd.Timestamp('2024-03-14')    # Export date of the FOI data: end of the observation window
+ROLLOUT_START = pd.Timestamp('2020-12-27')
+SYNTH_SEED = 0
+CHUNK_ROWS = 1_000_000
+
+# Relative population size per age decade (0-9, 10-19, ..., 110-113)
+AGE_PYRAMID = [1.10, 1.05, 1.00, 1.25, 1.55, 1.30, 1.25, 1.05, 0.40, 0.08, 0.002, 0.0001]
+
+# Annual death hazard exp(GOMPERTZ_A + GOMPERTZ_B * age), at least MIN_HAZARD
+GOMPERTZ_A = -10.2
+GOMPERTZ_B = 0.094
+MIN_HAZARD = 0.0003
+
+# Share of vaccinated people with 1..7 doses
+DOSE_COUNT_PROBS = [0.06, 0.32, 0.38, 0.14, 0.07, 0.02, 0.01]
+
+def parse_rows(text):
+    """'100k', '1M', '10M' or a plain number -> number of rows"""
+    text = str(text).strip().lower()
+    factor = {'k': 1_000, 'm': 1_000_000}.get(text[-1:], 1)
+    return int(float(text[:-1] if factor > 1 else text) * factor)
+
+def _hazard_profile(n_days):
+    """Relative daily hazard over the window: winter seasonality plus the 2020/21 COVID waves"""
+    day = np.arange(n_days)
+    seasonal = 1 + 0.15 * np.cos(2 * np.pi * (day - 15) / 365.25)
+    waves = 0.6 * np.exp(-((day - 320) / 30) ** 2) + 0.4 * np.exp(-((day - 430) / 35) ** 2)
+    return seasonal + waves
+
+def generate_cohort(n_rows, seed=SYNTH_SEED, age=None, end_date=END_DATE):
+    """
+    DataFrame with Rok_narozeni, DatumUmrti and Datum_1..7 as datetime64 columns (NaT if missing).
+    age=None samples ages from AGE_PYRAMID, otherwise all rows get that age.
+    """
+    rng = np.random.default_rng(seed)
+    n_days = (end_date - START_DATE).days + 1
+
+    # Ages and birth years
+    if age is None:
+        weights = np.repeat(AGE_PYRAMID, 10)[:MAX_AGE + 1]
+        ages = rng.choice(MAX_AGE + 1, size=n_rows, p=weights / weights.sum())
+    else:
+        ages = np.full(n_rows, age)
+
+    # Deaths: invert the cumulative hazard at an Exp(1) draw
+    annual_hazard = np.maximum(np.exp(GOMPERTZ_A + GOMPERTZ_B * ages), MIN_HAZARD)
+    cumulative = np.cumsum(_hazard_profile(n_days)) / 365.25
+    death_day = np.searchsorted(cumulative, rng.exponential(size=n_rows) / annual_hazard).astype(float)
+    death_day[death_day >= n_days] = np.nan
+
+    # Vaccination: uptake by age, rollout by age priority, then dose intervals
+    uptake = np.clip(0.2 + 0.6 * (ages - 12) / 60, 0, 0.85)
+    uptake[ages < 12] = 0.03
+    vaccinated = rng.random(n_rows) < uptake
+    n_doses = np.where(vaccinated, rng.choice(np.arange(1, 8), size=n_rows, p=DOSE_COUNT_PROBS), 0)
+
+    rollout = (ROLLOUT_START - START_DATE).days
+    first = rollout + np.clip(80 - ages, 0, 70) * 2.5 + rng.gamma(2.0, 20.0, size=n_rows)
+    late = rng.random(n_rows) < 0.1
+    first[late] += rng.uniform(0, 400, size=late.sum())
+
+    gaps = np.empty((n_rows, len(DOSE_COLS)))
+    gaps[:, 0] = first
+    gaps[:, 1] = 21 + rng.gamma(2.0, 7.0, size=n_rows)
+    gaps[:, 2] = 150 + rng.gamma(3.0, 20.0, size=n_rows)
+    gaps[:, 3:] = 120 + rng.gamma(3.0, 30.0, size=(n_rows, len(DOSE_COLS) - 3))
+    dose_days = np.floor(np.cumsum(gaps, axis=1))
+
+    last_day = np.fmin(death_day, n_days - 1)
+    given = (np.arange(len(DOSE_COLS)) < n_doses[:, None]) & (dose_days <= last_day[:, None])
+    dose_days[~given] = np.nan
+
+    def to_dates(days):
+        return START_DATE + pd.to_timedelta(days, unit='D')
+
+    df = pd.DataFrame({'Rok_narozeni': REFERENCE_YEAR - ages, 'DatumUmrti': to_dates(death_day)})
+    for i, col in enumerate(DOSE_COLS):
+        df[col] = to_dates(dose_days[:, i])
+    return df[NEEDED_COLS]
+
+def write_synthetic_csv(path, n_rows, seed=SYNTH_SEED, age=None, chunk_rows=CHUNK_ROWS):
+    """Write a synthetic cohort in chunks, with dates formatted like the FOI export (YYYY-MM-DD)."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    seeds = np.random.SeedSequence(seed).spawn(-(-n_rows // chunk_rows))
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        for i, chunk_seed in enumerate(seeds):
+            rows = min(chunk_rows, n_rows - i * chunk_rows)
+            chunk = generate_cohort(rows, seed=chunk_seed, age=age)
+            chunk.to_csv(f, index=False, header=(i == 0), date_format='%Y-%m-%d')
+    return path
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a synthetic FOI-shaped cohort CSV.")
+    parser.add_argument('rows', help="number of rows, e.g. 100k, 1M, 10M")
+    parser.add_argument('output_csv')
+    parser.add_argument('--age', type=int, default=None, help="single age for all rows (default: population pyramid)")
+    parser.add_argument('--seed', type=int, default=SYNTH_SEED)
+    args = parser.parse_args(argv)
+    write_synthetic_csv(args.output_csv, parse_rows(args.rows), seed=args.seed, age=args.age)
+    print(f"Saved {args.output_csv}")
+
+if __name__ == "__main__":
+    main()